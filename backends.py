@@ -0,0 +1,239 @@
+import os
+import shutil
+import sys
+import torch
+from torch import nn
+from transformers import AutoModelForCausalLM
+from transformers.pytorch_utils import Conv1D
+
+from inference import next_token_probs
+
+# "eager" runs the model as saved by fine_tune.py, "int8" quantizes its linear layers when loading, and
+# "torchscript" / "onnx" run a graph exported from it ahead of time (see export_model).
+BACKENDS = ("eager", "int8", "torchscript", "onnx")
+EXPORTED_BACKENDS = ("torchscript", "onnx")
+EXPORT_FILENAMES = {"torchscript" : "model.pt", "onnx" : "model.onnx"}
+
+
+def conv1d_as_linear(layer:Conv1D) -> nn.Linear:
+    """
+    The nn.Linear layer equivalent to a transformers Conv1D layer (used by GPT).
+
+    Conv1D is a linear layer with its weight stored transposed, which torch's quantization doesn't recognize.
+
+    Input:
+        - layer: The Conv1D layer.
+
+    Output:
+        - linear: The nn.Linear layer.
+    """
+    in_features, out_features = layer.weight.shape
+    linear = nn.Linear(in_features, out_features, device="meta")
+    linear.weight = nn.Parameter(layer.weight.detach().t().contiguous())
+    linear.bias = nn.Parameter(layer.bias.detach())
+    return linear
+
+
+def quantize_int8(model:nn.Module) -> nn.Module:
+    """
+    Dynamic int8 quantization of a model's linear layers: weights are stored in int8 (a quarter of the memory) and
+    the matrix multiplications run in int8, with activations quantized on the fly.
+
+    LoRA adapters (see lora.py) stay in float, so adapters can still be swapped into a quantized base model.
+    An output layer tied to the token embeddings (like GPT's) is left alone: quantizing it would keep a second
+    copy of the embeddings, and it would no longer see the custom token rows an adapter swaps in.
+
+    Layers are converted one at a time, so at most one layer's float copy exists on top of the model.
+
+    Input:
+        - model: The model (modified in place).
+
+    Output:
+        - model: The quantized model.
+    """
+    output_embeddings = model.get_output_embeddings()
+    tied = output_embeddings is not None and output_embeddings.weight is model.get_input_embeddings().weight
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if (isinstance(child, Conv1D)):
+                child = conv1d_as_linear(child)
+            if (type(child) is nn.Linear and not (tied and child is output_embeddings)):
+                child.qconfig = torch.ao.quantization.default_dynamic_qconfig
+                setattr(parent, name, torch.ao.nn.quantized.dynamic.Linear.from_float(child))
+    return model
+
+
+class LogitsModule(nn.Module):
+    """
+    Forward pass of a causal LM returning only the logits, which is the graph that gets exported.
+    """
+
+    def __init__(self, model:nn.Module) -> None:
+        super().__init__()
+        self.model = model
+        return
+
+
+    def forward(self, input_ids:"torch.Tensor", attention_mask:"torch.Tensor", position_ids:"torch.Tensor") -> "torch.Tensor":
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, use_cache=False,
+                          return_dict=False)[0]
+
+
+def export_model(model_dir:str, backend:str, out_dir:str=None) -> str:
+    """
+    Exports a saved model to a TorchScript or ONNX graph.
+
+    Input:
+        - model_dir: Folder of the saved model (e.g. models/gpt/matthew/model).
+        - backend: "torchscript" or "onnx".
+        - out_dir: Folder to write the graph and the model's config to (defaults to {model_dir}_{backend}).
+
+    Output:
+        - out_dir: Folder the export was written to.
+    """
+    if (backend not in EXPORTED_BACKENDS):
+        raise ValueError(f"Can only export to {EXPORTED_BACKENDS}, not {backend}")
+    out_dir = out_dir if out_dir is not None else f"{model_dir.rstrip('/')}_{backend}"
+    os.makedirs(out_dir, exist_ok=True)
+
+    model = AutoModelForCausalLM.from_pretrained(model_dir)
+    model.eval()
+    module = LogitsModule(model)
+    input_ids = torch.arange(8).unsqueeze(0)
+    example = (input_ids, torch.ones_like(input_ids), torch.arange(8).unsqueeze(0))
+
+    with torch.no_grad():
+        if (backend == "torchscript"):
+            torch.jit.save(torch.jit.trace(module, example, check_trace=False), f"{out_dir}/{EXPORT_FILENAMES[backend]}")
+        else:
+            names = ["input_ids", "attention_mask", "position_ids"]
+            dynamic_axes = {name : {0 : "batch", 1 : "sequence"} for name in names + ["logits"]}
+            torch.onnx.export(module, example, f"{out_dir}/{EXPORT_FILENAMES[backend]}", input_names=names, output_names=["logits"],
+                              dynamic_axes=dynamic_axes, dynamo=False)
+
+    shutil.copy(f"{model_dir}/config.json", f"{out_dir}/config.json")
+    return out_dir
+
+
+class ExportedCausalLM:
+    """
+    Runs an exported graph (see export_model) with the parts of the transformers generate API the bot uses.
+
+    The exported graph has no key/value cache, so every step re-encodes the whole sequence, like GPT 1 does in
+    transformers anyway.
+    """
+
+    def __init__(self, export_dir:str, backend:str) -> None:
+        """
+        Constructor.
+
+        Input:
+            - export_dir: Folder written by export_model.
+            - backend: "torchscript" or "onnx".
+        """
+        self.backend = backend
+        self.device = torch.device("cpu")
+        self.mimic_supports_kv_cache = False
+        filename = f"{export_dir}/{EXPORT_FILENAMES[backend]}"
+        if (backend == "torchscript"):
+            self.module = torch.jit.load(filename)
+            self.module.eval()
+        else:
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(filename, providers=["CPUExecutionProvider"])
+        return
+
+
+    def logits(self, input_ids:"torch.Tensor", attention_mask:"torch.Tensor") -> "torch.Tensor":
+        """
+        Logits of every position (left padding is skipped over by the position ids, like generate does).
+
+        Input:
+            - input_ids: Token ids, shape (batch, sequence).
+            - attention_mask: 1 for tokens, 0 for padding.
+
+        Output:
+            - logits: Shape (batch, sequence, vocab).
+        """
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        if (self.backend == "torchscript"):
+            with torch.no_grad():
+                return self.module(input_ids, attention_mask, position_ids)
+        inputs = {"input_ids" : input_ids.numpy(), "attention_mask" : attention_mask.numpy(), "position_ids" : position_ids.numpy()}
+        return torch.from_numpy(self.session.run(None, inputs)[0])
+
+
+    def generate(self, input_ids:"torch.Tensor", attention_mask:"torch.Tensor"=None, max_new_tokens:int=20, min_new_tokens:int=0,
+                 do_sample:bool=False, temperature:float=1.0, top_k:int=0, top_p:float=1.0, pad_token_id:int=None,
+                 eos_token_id:list=None, **kwargs) -> "torch.Tensor":
+        """
+        Generates like transformers' generate: greedy or sampled, stopping each sequence at an eos token.
+
+        Input:
+            - input_ids: Prompts (left padded), shape (batch, sequence).
+            - attention_mask: 1 for tokens, 0 for padding.
+            - max_new_tokens, min_new_tokens, do_sample, temperature, top_k, top_p, pad_token_id, eos_token_id: As in generate.
+            - kwargs: Other generate settings, ignored.
+
+        Output:
+            - sequences: Prompts followed by the generated tokens (pad_token_id after a sequence finished).
+        """
+        attention_mask = attention_mask if attention_mask is not None else torch.ones_like(input_ids)
+        eos_token_id = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id or [])
+        unfinished = torch.ones(input_ids.shape[0], dtype=torch.bool)
+
+        for step in range(max_new_tokens):
+            logits = self.logits(input_ids, attention_mask)[:, -1, :].float()
+            if (step < min_new_tokens and eos_token_id):
+                logits[:, eos_token_id] = float("-inf")
+
+            if (do_sample):
+                next_tokens = torch.multinomial(next_token_probs(logits, temperature, top_k, top_p), 1).squeeze(1)
+            else:
+                next_tokens = logits.argmax(dim=-1)
+            if (pad_token_id is not None):
+                next_tokens = torch.where(unfinished, next_tokens, torch.full_like(next_tokens, pad_token_id))
+
+            input_ids = torch.cat([input_ids, next_tokens.unsqueeze(1)], dim=1)
+            attention_mask = torch.cat([attention_mask, unfinished.long().unsqueeze(1)], dim=1)
+            if (eos_token_id):
+                unfinished &= ~torch.isin(next_tokens, torch.tensor(eos_token_id))
+                if (not unfinished.any()):
+                    break
+
+        return input_ids
+
+
+def load_model(model_dir:str, backend:str="eager") -> object:
+    """
+    Loads a saved model with one of the inference backends.
+
+    Input:
+        - model_dir: Folder of the saved model (e.g. models/gpt/matthew/model).
+        - backend: One of BACKENDS. The exported backends need export_model to have been run on model_dir.
+
+    Output:
+        - model: Object with the generate API, in eval mode.
+    """
+    if (backend in EXPORTED_BACKENDS):
+        return ExportedCausalLM(f"{model_dir.rstrip('/')}_{backend}", backend)
+
+    model = AutoModelForCausalLM.from_pretrained(model_dir)
+    model.eval()
+    if (backend == "int8"):
+        model = quantize_int8(model)
+    return model
+
+
+def main():
+    # Usage: python backends.py export models/gpt/matthew/model [torchscript|onnx]
+    if (len(sys.argv) < 3 or sys.argv[1] != "export"):
+        print("Usage: python backends.py export <model_dir> [torchscript|onnx]")
+        return
+    backends = sys.argv[3:] if len(sys.argv) > 3 else EXPORTED_BACKENDS
+    for backend in backends:
+        print(f"Exported {sys.argv[2]} to {export_model(sys.argv[2], backend)}")
+
+
+if (__name__ == "__main__"):
+    main()
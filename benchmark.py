@@ -0,0 +1,278 @@
+from transformers import OpenAIGPTLMHeadModel
+import gc
+import itertools
+import os
+import time
+import torch
+
+from backends import load_model, BACKENDS, EXPORTED_BACKENDS
+from fine_tune import build_token_cache, create_data_loader, enable_packed_attention
+from inference import DEFAULT_GENERATION_KWARGS, stop_token_ids
+from metrics import current_rss_mb
+from model_cache import ModelCache, folder_size_bytes, model_size_bytes
+from speculative import speculative_generate
+from utils import create_tokenizer, iter_jsonl, BOS, SEP
+
+
+def benchmark_padding(cache_dir:str, model:"OpenAIGPTLMHeadModel", pad_token_id:int, batch_size:int=8, num_steps:int=20,
+                      padding_modes:tuple=("max_length", "longest", "bucketed", "packed")) -> dict:
+    """
+    Compares training throughput of the padding modes of fine_tune.create_data_loader.
+
+    Runs num_steps training steps (forward, backward and optimizer step) per mode and counts the real
+    (non-padding) tokens and examples processed, which is what matters for how long an epoch takes.
+
+    Input:
+        - cache_dir: Token cache built by fine_tune.build_token_cache.
+        - model: Model to train. Note its weights are updated.
+        - pad_token_id: Id of the padding token.
+        - batch_size: Examples (or packed blocks) per batch.
+        - num_steps: Training steps timed per mode.
+        - padding_modes: Modes to compare.
+
+    Output:
+        - results: Dictionary mapping padding mode to its measurements.
+    """
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    model.train()
+
+    results = {}
+    for padding in padding_modes:
+        data_loader = create_data_loader(cache_dir, pad_token_id, batch_size=batch_size, padding=padding)
+        num_examples = len(data_loader.dataset.dataset) if padding == "packed" else len(data_loader.dataset)
+        if (padding == "packed"):
+            enable_packed_attention(model)
+
+        step_count = 0
+        real_tokens = 0
+        total_tokens = 0
+        examples = 0
+        start = time.perf_counter()
+        while (step_count < num_steps):
+            for batch in data_loader:
+                if (step_count == num_steps):
+                    break
+                labels = batch.pop("labels")
+                optimizer.zero_grad()
+                loss = model(**batch, labels=labels).loss
+                loss.backward()
+                optimizer.step()
+
+                step_count += 1
+                real_tokens += int(batch["attention_mask"].sum())
+                total_tokens += batch["input_ids"].numel()
+                if ("position_ids" in batch):
+                    examples += int(((batch["position_ids"] == 0) & (batch["attention_mask"] == 1)).sum())
+                else:
+                    examples += len(batch["input_ids"])
+        elapsed = time.perf_counter() - start
+
+        results[padding] = {
+            "seconds" : elapsed,
+            "examples_per_second" : examples / elapsed,
+            "real_tokens_per_second" : real_tokens / elapsed,
+            "padding_fraction" : 1 - real_tokens / total_tokens,
+            "estimated_epoch_seconds" : num_examples * elapsed / examples,
+        }
+
+    return results
+
+
+def benchmark_decode_steps(model:"AutoModelForCausalLM", tokenizer:"AutoTokenizer", prompts:list, 
+                           generation_kwargs:dict=DEFAULT_GENERATION_KWARGS) -> dict:
+    """
+    Compares reply latency when generation stops at the end tokens (see inference.stop_token_ids) with always
+    generating max_new_tokens tokens, like the bot used to.
+
+    Input:
+        - model: Model to generate with.
+        - tokenizer: Its tokenizer.
+        - prompts: Prompts to reply to, formatted like inference.format_prompt.
+        - generation_kwargs: Settings passed to generate.
+
+    Output:
+        - results: Dictionary mapping "full_length" and "stop_at_eos" to their measurements.
+    """
+    model.eval()
+    max_new_tokens = generation_kwargs["max_new_tokens"]
+    modes = {
+        # Stop tokens can't end generation before max_new_tokens, so every reply pays for all the steps.
+        "full_length" : {"min_new_tokens" : max_new_tokens},
+        "stop_at_eos" : {},
+    }
+
+    results = {}
+    for mode, mode_kwargs in modes.items():
+        steps = []
+        start = time.perf_counter()
+        for prompt in prompts:
+            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+            with torch.no_grad():
+                outputs = model.generate(input_ids, pad_token_id=tokenizer.pad_token_id, eos_token_id=stop_token_ids(tokenizer),
+                                         **generation_kwargs, **mode_kwargs)
+            steps.append(outputs.shape[1] - input_ids.shape[1])
+        elapsed = time.perf_counter() - start
+
+        results[mode] = {
+            "average_decode_steps" : sum(steps) / len(steps),
+            "seconds_per_reply" : elapsed / len(prompts),
+        }
+
+    return results
+
+
+def benchmark_backends(model_dir:str, tokenizer:"AutoTokenizer", prompts:list, backends:tuple=BACKENDS, 
+                       num_new_tokens:int=32) -> dict:
+    """
+    Compares the inference backends of backends.py on a saved model: load time, memory and latency per token.
+
+    Memory is reported as the size of the weights in memory (the size of the exported file for exported backends)
+    and as how much the process grew by loading the model and generating with it. The latter is only indicative:
+    safetensors weights are memory-mapped and freed memory isn't always returned to the OS.
+
+    Every backend generates num_new_tokens tokens greedily for each prompt. How many of those tokens are the same
+    as eager's shows how much quantization changes the model's output. Exported backends that haven't been
+    exported for model_dir are skipped.
+
+    Input:
+        - model_dir: Folder of the saved model.
+        - tokenizer: Its tokenizer.
+        - prompts: Prompts to generate from.
+        - backends: Backends to compare (eager should come first, it is the baseline for agreement).
+        - num_new_tokens: Tokens generated per prompt.
+
+    Output:
+        - results: Dictionary mapping backend to its measurements.
+    """
+    results = {}
+    eager_tokens = None
+    for backend in backends:
+        if (backend in EXPORTED_BACKENDS and not os.path.isdir(f"{model_dir.rstrip('/')}_{backend}")):
+            print(f"Skipping {backend}, export it first with: python backends.py export {model_dir} {backend}")
+            continue
+
+        gc.collect()
+        rss_before = current_rss_mb()
+        start = time.perf_counter()
+        model = load_model(model_dir, backend)
+        load_seconds = time.perf_counter() - start
+
+        generated = []
+        start = time.perf_counter()
+        for prompt in prompts:
+            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+            with torch.no_grad():
+                outputs = model.generate(input_ids, attention_mask=torch.ones_like(input_ids), do_sample=False,
+                                         max_new_tokens=num_new_tokens, min_new_tokens=num_new_tokens,
+                                         pad_token_id=tokenizer.pad_token_id, eos_token_id=stop_token_ids(tokenizer))
+            generated.append(outputs[0, input_ids.shape[1] : ])
+        elapsed = time.perf_counter() - start
+        rss_after = current_rss_mb()
+
+        if (backend in EXPORTED_BACKENDS):
+            weights_bytes = folder_size_bytes(f"{model_dir.rstrip('/')}_{backend}")
+        else:
+            weights_bytes = model_size_bytes(model)
+
+        tokens = torch.cat(generated)
+        if (eager_tokens is None):
+            eager_tokens = tokens
+        results[backend] = {
+            "load_seconds" : load_seconds,
+            "weights_mb" : weights_bytes / (1024 * 1024),
+            "rss_increase_mb" : rss_after - rss_before,
+            "ms_per_token" : elapsed / len(tokens) * 1000,
+            "greedy_agreement" : float((tokens == eager_tokens).float().mean()),
+        }
+        del model
+
+    return results
+
+
+def benchmark_speculative(model:"AutoModelForCausalLM", draft_model:"AutoModelForCausalLM", tokenizer:"AutoTokenizer", prompts:list,
+                          generation_kwargs:dict=DEFAULT_GENERATION_KWARGS, num_draft_tokens:tuple=(2, 4, 6)) -> dict:
+    """
+    Compares reply latency of speculative decoding with a draft model (see speculative.py) with plain generation.
+
+    Input:
+        - model: Model to generate with.
+        - draft_model: Its draft model.
+        - tokenizer: Their tokenizer.
+        - prompts: Prompts to reply to, formatted like inference.format_prompt.
+        - generation_kwargs: Settings passed to generate.
+        - num_draft_tokens: Numbers of tokens drafted per step to try.
+
+    Output:
+        - results: Dictionary mapping "generate" and "speculative_{n}" to their measurements.
+    """
+    model.eval()
+    draft_model.eval()
+    generation_kwargs = {**generation_kwargs, "pad_token_id" : tokenizer.pad_token_id, "eos_token_id" : stop_token_ids(tokenizer)}
+    prompt_ids = [tokenizer.encode(prompt) for prompt in prompts]
+
+    results = {}
+    num_tokens = 0
+    start = time.perf_counter()
+    for input_ids in prompt_ids:
+        with torch.no_grad():
+            outputs = model.generate(torch.tensor([input_ids]), **generation_kwargs)
+        num_tokens += outputs.shape[1] - len(input_ids)
+    elapsed = time.perf_counter() - start
+    results["generate"] = {"seconds_per_reply" : elapsed / len(prompts), "ms_per_token" : elapsed / num_tokens * 1000}
+
+    for n in num_draft_tokens:
+        stats = {}
+        num_tokens = 0
+        start = time.perf_counter()
+        for input_ids in prompt_ids:
+            num_tokens += len(speculative_generate(model, draft_model, input_ids, num_draft_tokens=n, stats=stats, **generation_kwargs))
+        elapsed = time.perf_counter() - start
+        results[f"speculative_{n}"] = {"seconds_per_reply" : elapsed / len(prompts), "ms_per_token" : elapsed / num_tokens * 1000,
+                                       "acceptance_rate" : stats.get("accepted", 0) / max(stats.get("drafted", 0), 1)}
+
+    return results
+
+
+def main():
+    username = ...
+    model_string = "openai-gpt"
+
+    tokenizer = create_tokenizer(model_string)
+    cache_dir = build_token_cache(f"../messages/user_messages/{username}.jsonl", tokenizer)
+
+    model = OpenAIGPTLMHeadModel.from_pretrained(model_string)
+    model.resize_token_embeddings(len(tokenizer))
+
+    results = benchmark_padding(cache_dir, model, tokenizer.pad_token_id)
+    baseline = results["max_length"]["estimated_epoch_seconds"]
+    for padding, result in results.items():
+        print(f"{padding:>10}: {result['examples_per_second']:8.1f} examples/s, {result['real_tokens_per_second']:9.1f} real tokens/s, "
+              f"{result['padding_fraction'] * 100:5.1f}% padding, epoch {result['estimated_epoch_seconds']:8.1f}s "
+              f"({baseline / result['estimated_epoch_seconds']:.1f}x)")
+
+    # Reply latency of the fine-tuned model, prompted with contexts from the training data.
+    persona = ModelCache().get(username)
+    contexts = (x["context"] for x in iter_jsonl(f"../messages/user_messages/{username}.jsonl") if x["context"].strip())
+    prompts = [f"{BOS} " + context + f" {SEP} " for context in itertools.islice(contexts, 20)]
+    results = benchmark_decode_steps(persona.model, persona.tokenizer, prompts, {**DEFAULT_GENERATION_KWARGS, **persona.generation_kwargs})
+    for mode, result in results.items():
+        print(f"{mode:>11}: {result['average_decode_steps']:6.1f} decode steps, {result['seconds_per_reply']:6.3f}s per reply")
+
+    # Inference backends, see backends.py.
+    results = benchmark_backends(f"models/gpt/{username}/model", persona.tokenizer, prompts)
+    for backend, result in results.items():
+        print(f"{backend:>11}: loaded in {result['load_seconds']:6.2f}s, {result['weights_mb']:7.1f} MB weights "
+              f"(+{result['rss_increase_mb']:.1f} MB RSS), "
+              f"{result['ms_per_token']:7.2f} ms/token, {result['greedy_agreement'] * 100:5.1f}% same tokens as eager")
+
+    # Speculative decoding, if a draft model was trained (fine_tune.py's draft_layers).
+    if (persona.draft_model is not None):
+        results = benchmark_speculative(persona.model, persona.draft_model, persona.tokenizer, prompts,
+                                        {**DEFAULT_GENERATION_KWARGS, **persona.generation_kwargs})
+        for mode, result in results.items():
+            print(f"{mode:>14}: {result['seconds_per_reply']:6.3f}s per reply, {result['ms_per_token']:7.2f} ms/token"
+                  + (f", {result['acceptance_rate'] * 100:5.1f}% of drafted tokens accepted" if "acceptance_rate" in result else ""))
+
+
+if (__name__ == "__main__"):
+    main()
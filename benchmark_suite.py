@@ -0,0 +1,246 @@
+from transformers import OpenAIGPTConfig, OpenAIGPTLMHeadModel
+import asyncio
+import discord
+import json
+import platform
+import sys
+import tempfile
+import time
+import torch
+from torch.utils.data import DataLoader
+
+from fine_tune import build_token_cache, create_data_loader, fine_tune, MimicDataset
+from frankenstein import MimicBot
+from pre_process_text import break_into_conversations, process_msg_texts, split_into_user_context
+from synthetic_corpus import make_channel_messages, write_channel
+from utils import read_columnar_store, read_json, write_json, create_tokenizer
+
+RESULTS_FILE = "bench_results.json"
+
+# A stage is flagged as a regression when it gets this much slower than the baseline.
+REGRESSION_THRESHOLD = 1.2
+
+
+def timed(function, *args, **kwargs) -> tuple:
+    """
+    Runs a function once.
+
+    Output:
+        - result: What the function returned.
+        - seconds: How long it took.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_pipeline(work_dir:str, tokenizer:"AutoTokenizer", num_messages:int=20000, seed:int=0, batch_size:int=8,
+                       num_train_steps:int=3) -> tuple:
+    """
+    Times each stage of the training pipeline on a synthetic corpus (see synthetic_corpus.py): breaking the
+    channel into conversations, preprocessing message text, building context + response pairs, iterating
+    MimicDataset, building the token cache and training steps of fine_tune().
+
+    Input:
+        - work_dir: Folder the synthetic message store and token cache are written to.
+        - tokenizer: Tokenizer made by utils.create_tokenizer.
+        - num_messages: Size of the synthetic corpus.
+        - seed: Seed of the synthetic corpus.
+        - batch_size: Examples per training batch.
+        - num_train_steps: Training steps run (the first one, which warms up, isn't timed).
+
+    Output:
+        - results: Dictionary mapping stage to its measurements (always including "seconds").
+        - examples: Context + response pairs of the most active author (dictionaries, see split_into_user_context).
+    """
+    results = {}
+    messages, seconds = timed(make_channel_messages, num_messages, seed=seed)
+    results["make_channel_messages"] = {"seconds" : seconds, "messages_per_second" : num_messages / seconds}
+
+    _, seconds = timed(write_channel, messages, "synthetic", work_dir)
+    results["write_channel"] = {"seconds" : seconds, "messages_per_second" : num_messages / seconds}
+
+    convos, seconds = timed(break_into_conversations, messages)
+    results["break_into_conversations"] = {"seconds" : seconds, "messages_per_second" : num_messages / seconds,
+                                           "conversations" : len(convos)}
+
+    store = read_columnar_store("synthetic", work_dir)
+    _, seconds = timed(break_into_conversations, store)
+    results["break_into_conversations_columnar"] = {"seconds" : seconds, "messages_per_second" : num_messages / seconds}
+
+    _, seconds = timed(process_msg_texts, messages)
+    results["process_msg_text"] = {"seconds" : seconds, "messages_per_second" : num_messages / seconds}
+
+    author_data = {}
+    start = time.perf_counter()
+    for convo in convos:
+        for author, lines in split_into_user_context(convo, tokenizer).items():
+            author_data.setdefault(author, []).extend(lines)
+    seconds = time.perf_counter() - start
+    num_examples = sum(len(x) for x in author_data.values())
+    results["split_into_user_context"] = {"seconds" : seconds, "conversations_per_second" : len(convos) / seconds,
+                                          "examples" : num_examples}
+
+    # The rest of the pipeline trains one persona, the author with the most examples.
+    author = max(author_data, key=lambda x: len(author_data[x]))
+    jsonl_filename = f"{work_dir}/{author}.jsonl"
+    with open(jsonl_filename, 'w') as fp:
+        fp.writelines(author_data[author])
+    examples = [json.loads(line) for line in author_data[author]]
+
+    dataset = MimicDataset([x["train"] for x in examples], tokenizer)
+    start = time.perf_counter()
+    for i in range(len(dataset)):
+        dataset[i]
+    seconds = time.perf_counter() - start
+    results["mimic_dataset_iteration"] = {"seconds" : seconds, "examples_per_second" : len(dataset) / seconds}
+
+    cache_dir, seconds = timed(build_token_cache, jsonl_filename, tokenizer, cache_folder=f"{work_dir}/cache")
+    results["build_token_cache"] = {"seconds" : seconds, "examples_per_second" : len(dataset) / seconds}
+
+    torch.manual_seed(seed)
+    config = OpenAIGPTConfig(vocab_size=len(tokenizer), n_positions=512, n_embd=128, n_layer=2, n_head=2)
+    model = OpenAIGPTLMHeadModel(config)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    data_loader = create_data_loader(cache_dir, tokenizer.pad_token_id, batch_size=batch_size)
+    batches = [batch for batch, _ in zip(data_loader, range(num_train_steps))]
+
+    # batch_size=None hands the prepared batches to fine_tune() as they are.
+    fine_tune(DataLoader(batches[ : 1], batch_size=None), model, optimizer, num_epochs=1, device=torch.device("cpu"))
+    _, seconds = timed(fine_tune, DataLoader(batches[1 : ], batch_size=None), model, optimizer, num_epochs=1, device=torch.device("cpu"))
+    num_tokens = sum(int(x["attention_mask"].sum()) for x in batches[1 : ])
+    results["fine_tune_step"] = {"seconds" : seconds / max(len(batches) - 1, 1), "tokens_per_second" : num_tokens / seconds}
+
+    return results, examples
+
+
+def benchmark_bot(model_folder:str, tokenizer:"AutoTokenizer", prompts:list, max_new_tokens:int=32, seed:int=0) -> dict:
+    """
+    Times MimicBot's replies (queueing, generation and decoding, without discord) with a tiny randomly initialized
+    persona, one message at a time and all at once.
+
+    Input:
+        - model_folder: Folder the persona is written to.
+        - tokenizer: Tokenizer made by utils.create_tokenizer.
+        - prompts: Messages sent to the bot.
+        - max_new_tokens: Length cap of the replies (the model is untrained, so it rarely ends a reply itself).
+        - seed: Seed of the model's weights and of sampling.
+
+    Output:
+        - results: Dictionary mapping "bot_load", "bot_sequential" and "bot_concurrent" to their measurements.
+    """
+    torch.manual_seed(seed)
+    config = OpenAIGPTConfig(vocab_size=len(tokenizer), n_positions=512, n_embd=128, n_layer=2, n_head=2)
+    OpenAIGPTLMHeadModel(config).save_pretrained(f"{model_folder}/tiny/model")
+    tokenizer.save_pretrained(f"{model_folder}/tiny/tokenizer")
+    write_json({"max_new_tokens" : max_new_tokens, "min_new_tokens" : max_new_tokens}, f"{model_folder}/tiny/generation.json")
+
+    async def run() -> dict:
+        bot = MimicBot(discord.Intents.default(), model_folder=model_folder, max_pending=len(prompts) + 1)
+        await bot.load()
+        try:
+            # Loading the persona is timed on its own, not as part of the first reply.
+            _, load_seconds = timed(bot.model_cache.get, "tiny")
+
+            latencies = []
+            for i, prompt in enumerate(prompts):
+                start = time.perf_counter()
+                await bot.scheduler.submit(i, "tiny", i, prompt)
+                latencies.append(time.perf_counter() - start)
+
+            # New channels, so the prompts are as long as in the sequential run.
+            start = time.perf_counter()
+            channel_ids = [len(prompts) + i for i in range(len(prompts))]
+            await asyncio.gather(*[bot.scheduler.submit(x, "tiny", x, prompt) for x, prompt in zip(channel_ids, prompts)])
+            concurrent_seconds = time.perf_counter() - start
+        finally:
+            await bot.scheduler.stop()
+
+        latencies.sort()
+        return {
+            "bot_load" : {"seconds" : load_seconds},
+            "bot_sequential" : {"seconds" : sum(latencies) / len(latencies), "p50_seconds" : latencies[len(latencies) // 2],
+                                "max_seconds" : latencies[-1]},
+            "bot_concurrent" : {"seconds" : concurrent_seconds, "replies_per_second" : len(prompts) / concurrent_seconds},
+        }
+
+    return asyncio.run(run())
+
+
+def run_suite(model_string:str="openai-gpt", num_messages:int=20000, num_prompts:int=16, seed:int=0) -> dict:
+    """
+    Runs every benchmark on a synthetic corpus and a tiny model, so runs on the same machine can be compared.
+
+    Input:
+        - model_string: Pretrained model whose tokenizer is used (only the tokenizer, the models are tiny).
+        - num_messages: Size of the synthetic corpus.
+        - num_prompts: Messages sent to the bot.
+        - seed: Seed of the corpus and models.
+
+    Output:
+        - results: Dictionary with the settings and machine of the run ("config") and the measurements of each stage.
+    """
+    tokenizer = create_tokenizer(model_string)
+    results = {"config" : {"model_string" : model_string, "num_messages" : num_messages, "num_prompts" : num_prompts, "seed" : seed,
+                           "torch" : torch.__version__, "num_threads" : torch.get_num_threads(), "machine" : platform.node(),
+                           "time" : time.time()}}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        stage_results, examples = benchmark_pipeline(work_dir, tokenizer, num_messages, seed)
+        results.update(stage_results)
+
+        # Prompt the bot with responses from the training data.
+        prompts = [x["response"] for x in examples[ : num_prompts]]
+        results.update(benchmark_bot(f"{work_dir}/models", tokenizer, prompts, seed=seed))
+
+    return results
+
+
+def compare_results(baseline:dict, results:dict, threshold:float=REGRESSION_THRESHOLD) -> dict:
+    """
+    Compares the time of each stage with a baseline run.
+
+    Input:
+        - baseline: Results of an earlier run_suite.
+        - results: Results of this run.
+        - threshold: Ratio of seconds above which a stage counts as a regression.
+
+    Output:
+        - comparison: Dictionary mapping each stage in both runs to (baseline seconds, seconds, ratio, regressed).
+    """
+    comparison = {}
+    for stage, result in results.items():
+        if (stage == "config" or stage not in baseline):
+            continue
+        ratio = result["seconds"] / baseline[stage]["seconds"]
+        comparison[stage] = (baseline[stage]["seconds"], result["seconds"], ratio, ratio > threshold)
+    return comparison
+
+
+def main():
+    # Usage: python benchmark_suite.py [results.json] [baseline_results.json]
+    results_file = sys.argv[1] if len(sys.argv) > 1 else RESULTS_FILE
+    baseline = read_json(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    results = run_suite()
+    write_json(results, results_file)
+    print(f"Results written to {results_file}")
+
+    if (baseline is not None and baseline["config"]["num_messages"] != results["config"]["num_messages"]):
+        print("Warning: the baseline was run on a corpus of a different size")
+    comparison = compare_results(baseline, results) if baseline is not None else {}
+    for stage, result in results.items():
+        if (stage == "config"):
+            continue
+        line = f"{stage:>34}: {result['seconds']:9.4f}s"
+        if (stage in comparison):
+            baseline_seconds, _, ratio, regressed = comparison[stage]
+            line += f"  (baseline {baseline_seconds:9.4f}s, {ratio:5.2f}x{', REGRESSION' if regressed else ''})"
+        print(line)
+
+    if (any(x[3] for x in comparison.values())):
+        sys.exit(1)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,173 @@
+from collections import OrderedDict, deque
+import threading
+import torch
+
+
+def supports_kv_cache(model:"torch.nn.Module") -> bool:
+    """
+    Whether a model returns its keys/values for reuse (GPT 2 does, the GPT 1 implementation in transformers doesn't).
+
+    The answer is found with a one token forward pass and remembered on the model.
+
+    Input:
+        - model: The model.
+
+    Output:
+        - supported: True if past_key_values can be passed back into the model.
+    """
+    if (not hasattr(model, "mimic_supports_kv_cache")):
+        with torch.no_grad():
+            outputs = model(input_ids=torch.zeros((1, 1), dtype=torch.long, device=model.device), use_cache=True)
+        past_key_values = getattr(outputs, "past_key_values", None)
+        model.mimic_supports_kv_cache = (past_key_values is not None and hasattr(past_key_values, "crop")
+                                         and past_key_values.get_seq_length() > 0)
+    return model.mimic_supports_kv_cache
+
+
+class Conversation:
+    """
+    The recent turns of one channel's conversation with one persona, as token ids, and the model's keys/values
+    for them.
+
+    The context of a prompt is "[BOS] {turn} {turn} ...", like the multi-turn contexts the model was trained on
+    (see pre_process_text.split_into_user_context). Turns only get appended until the context no longer fits in
+    max_context_tokens, so the keys/values of one prompt's context stay valid for the next and only the new turns
+    need encoding. Once the oldest turns have to be dropped the context changes and the cache is rebuilt.
+
+    A conversation advances one message and reply at a time (the message's turn, generation, the reply's turn), as
+    the cached keys/values are those of the context at the last reply. Replying to two messages of a channel in one
+    go would generate both replies from the same context and append the turns out of order.
+    """
+
+    def __init__(self, bos_token_id:int, max_context_tokens:int=256) -> None:
+        """
+        Constructor.
+
+        Input:
+            - bos_token_id: Id of the [BOS] token starting every context.
+            - max_context_tokens: Most tokens of context in a prompt.
+        """
+        self.bos_token_id = bos_token_id
+        self.max_context_tokens = max_context_tokens
+        self.turns = deque()
+        self.num_tokens = 1
+
+        # Keys/values of the first cached_length tokens of context_ids(), None if nothing is cached.
+        self.past_key_values = None
+        self.cached_length = 0
+        return
+
+
+    def add_turn(self, token_ids:list) -> None:
+        """
+        Appends a turn (a message or a reply) to the conversation, dropping the oldest turns that no longer fit.
+
+        Input:
+            - token_ids: Token ids of the turn.
+        """
+        # A turn that doesn't fit on its own is cut down to its end, which is closest to the reply.
+        token_ids = list(token_ids)[-(self.max_context_tokens - 1) : ]
+        self.turns.append(token_ids)
+        self.num_tokens += len(token_ids)
+        while (self.num_tokens > self.max_context_tokens):
+            self.num_tokens -= len(self.turns.popleft())
+
+            # The start of the context changed, so the cached keys/values (and positions) are no longer valid.
+            self.past_key_values = None
+            self.cached_length = 0
+        return
+
+
+    def context_ids(self) -> list:
+        """
+        Token ids of the context: [BOS] and the turns that fit.
+
+        Output:
+            - token_ids: List of token ids.
+        """
+        return [self.bos_token_id] + [x for turn in self.turns for x in turn]
+
+
+class ConversationCache:
+    """
+    Conversation state of the most recently active (channel, persona) pairs, least recently used ones are forgotten.
+
+    Keys/values take memory (for GPT 2, roughly 36 KB per token of context), so max_conversations bounds how many
+    are kept. Safe to use from several threads, but a Conversation itself must only be used by one thread at a
+    time (the bot uses each persona's model lock for that).
+    """
+
+    def __init__(self, max_conversations:int=32, max_context_tokens:int=256) -> None:
+        """
+        Constructor.
+
+        Input:
+            - max_conversations: Most conversations kept.
+            - max_context_tokens: Most tokens of context per conversation, see Conversation.
+        """
+        self.max_conversations = max_conversations
+        self.max_context_tokens = max_context_tokens
+        self.conversations = OrderedDict()
+        self.lock = threading.Lock()
+        return
+
+
+    def get(self, channel_id:object, name:str, bos_token_id:int) -> Conversation:
+        """
+        Gets the conversation of a channel with a persona, starting a new one if there is none.
+
+        Input:
+            - channel_id: ID of the channel.
+            - name: Name of the persona.
+            - bos_token_id: Id of the persona's [BOS] token.
+
+        Output:
+            - conversation: The Conversation.
+        """
+        key = (channel_id, name)
+        with self.lock:
+            if (key in self.conversations):
+                self.conversations.move_to_end(key)
+                return self.conversations[key]
+
+            conversation = Conversation(bos_token_id, self.max_context_tokens)
+            self.conversations[key] = conversation
+            if (len(self.conversations) > self.max_conversations):
+                self.conversations.popitem(last=False)
+            return conversation
+
+
+def generate_with_cache(model:"torch.nn.Module", conversation:Conversation, prompt_ids:list, generation_kwargs:dict) -> list:
+    """
+    Generates a reply to a conversation, encoding only the part of the prompt that isn't cached yet.
+
+    Afterwards, the conversation's cache holds the keys/values of its whole context (but not the end of the prompt
+    or the reply, which aren't part of the next context in the same form).
+
+    Input:
+        - model: Model supporting past_key_values (see supports_kv_cache).
+        - conversation: The conversation, with the new message already added as a turn.
+        - prompt_ids: Token ids appended to the context to make the prompt (the [SEP] token).
+        - generation_kwargs: Settings passed to generate.
+
+    Output:
+        - reply_ids: Token ids generated, including the stop token if one was generated.
+    """
+    context_ids = conversation.context_ids()
+    input_ids = torch.tensor([context_ids + prompt_ids], device=model.device)
+
+    # generate updates the cache in place, so it is only handed back to the conversation once generation succeeded.
+    past_key_values = conversation.past_key_values
+    conversation.past_key_values = None
+    conversation.cached_length = 0
+    with torch.no_grad():
+        outputs = model.generate(input_ids, attention_mask=torch.ones_like(input_ids), past_key_values=past_key_values,
+                                 use_cache=True, return_dict_in_generate=True, **generation_kwargs)
+
+    # Keep only the context's part of the cache for the next turn.
+    past_key_values = outputs.past_key_values
+    # A negative count crops from the end (cropping to a positive length is deprecated).
+    past_key_values.crop(len(context_ids) - past_key_values.get_seq_length())
+    conversation.past_key_values = past_key_values
+    conversation.cached_length = len(context_ids)
+    return outputs.sequences[0, input_ids.shape[1] : ].tolist()
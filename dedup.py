@@ -0,0 +1,241 @@
+import json
+import os
+import re
+import zlib
+import numpy as np
+
+from utils import create_tokenizer, iter_jsonl, write_json, GIF_TOKEN, IMG_TOKEN, LINK_TOKEN
+
+FOLDER = "messages/user_messages"
+FILTERED_FOLDER = FOLDER + "/filtered"
+
+# Responses made of only these tokens (e.g. "[IMG]. ") carry no text to learn from.
+MEDIA_TOKENS = frozenset([GIF_TOKEN, IMG_TOKEN, LINK_TOKEN])
+
+# MinHash values are computed modulo this (Mersenne) prime, small enough that a * hash fits in 64 bits.
+MERSENNE_PRIME = (1 << 31) - 1
+
+word_re = re.compile(r"\[[a-z]+\]|:[^\s:]+:|@\S+|[\w']+", re.IGNORECASE)
+
+
+def normalize_response(response:str) -> list:
+    """
+    Words of a response, ignoring case, punctuation and spacing (the periods joining messages in particular).
+
+    Input:
+        - response: Response of a training pair (output of pre_process_text.split_into_user_context).
+
+    Output:
+        - words: List of words. Special tokens, emotes and mentions are kept whole.
+    """
+    return [word if word.upper() in MEDIA_TOKENS else word.lower() for word in word_re.findall(response)]
+
+
+def low_signal_reason(words:list, drop_media_only:bool=True, min_words:int=1, max_repeated_word_fraction:float=0.6,
+                      max_word_length:int=40) -> str:
+    """
+    Checks a response against the low-signal filters.
+
+    Input:
+        - words: Normalized words of the response (see normalize_response).
+        - drop_media_only: Drop responses that are only images, GIFs and links.
+        - min_words: Drop responses with fewer words.
+        - max_repeated_word_fraction: Drop responses of 5 or more words where one word makes up more than this
+                                      fraction of them (e.g. "lol lol lol lol lol"). None to disable.
+        - max_word_length: Drop responses with a longer word (key smashes, "hahahahaha..."). None to disable.
+
+    Output:
+        - reason: Name of the first filter the response fails, None if it passes all of them.
+    """
+    if (len(words) < min_words):
+        return "too_short"
+    if (drop_media_only and words and all(word in MEDIA_TOKENS for word in words)):
+        return "media_only"
+    if (max_repeated_word_fraction is not None and len(words) >= 5):
+        if (max(words.count(word) for word in set(words)) > max_repeated_word_fraction * len(words)):
+            return "repeated_word"
+    if (max_word_length is not None and any(len(word) > max_word_length for word in words)):
+        return "long_word"
+    return None
+
+
+class MinHashLSH:
+    """
+    Finds near-duplicate texts in a stream: each text is compared with every text kept before it in constant time.
+
+    Texts are sets of word shingles (runs of shingle_size words). The MinHash signature of a set is the minimum
+    of num_perm random hash functions over its shingles; two signatures agree on a hash function with probability
+    equal to the Jaccard similarity of the sets. Signatures are split into num_bands bands, and only texts whose
+    signatures are identical in at least one band (likely above the threshold) are compared, by the fraction of
+    hash functions they agree on.
+
+    Memory grows with the number of texts kept: their signatures plus one bucket per band.
+    """
+
+    def __init__(self, num_perm:int=64, num_bands:int=16, threshold:float=0.6, shingle_size:int=3, seed:int=0) -> None:
+        """
+        Constructor.
+
+        Input:
+            - num_perm: Number of hash functions in a signature.
+            - num_bands: Number of bands (num_perm must be a multiple). More bands find pairs of lower similarity.
+            - threshold: Estimated Jaccard similarity from which a text is a duplicate of an earlier one.
+            - shingle_size: Number of words per shingle.
+            - seed: Seed of the hash functions.
+        """
+        if (num_perm % num_bands != 0):
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of num_bands ({num_bands})")
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.num_bands = num_bands
+        self.rows = num_perm // num_bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+
+        self.buckets = [{} for _ in range(num_bands)]
+        self.signatures = []
+        return
+
+
+    def signature(self, words:list) -> "np.ndarray":
+        """
+        MinHash signature of a text.
+
+        Input:
+            - words: Words of the text.
+
+        Output:
+            - signature: Array of num_perm hash values (uint64).
+        """
+        size = min(self.shingle_size, len(words))
+        shingles = {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+        hashes = np.fromiter((zlib.crc32(x.encode("utf-8")) for x in shingles), dtype=np.uint64, count=len(shingles)) % np.uint64(MERSENNE_PRIME)
+        return ((hashes[:, None] * self.a + self.b) % np.uint64(MERSENNE_PRIME)).min(axis=0)
+
+
+    def add(self, words:list) -> bool:
+        """
+        Checks whether a text is a near-duplicate of one added before, and keeps it for later texts if it isn't.
+
+        Input:
+            - words: Words of the text.
+
+        Output:
+            - is_duplicate: True if the text is a near-duplicate (it is then not kept).
+        """
+        signature = self.signature(words)
+        band_keys = [signature[band * self.rows : (band + 1) * self.rows].tobytes() for band in range(self.num_bands)]
+
+        checked = set()
+        for band, key in enumerate(band_keys):
+            idx = self.buckets[band].get(key)
+            if (idx is not None and idx not in checked):
+                checked.add(idx)
+                if ((self.signatures[idx] == signature).mean() >= self.threshold):
+                    return True
+
+        idx = len(self.signatures)
+        self.signatures.append(signature)
+        for band, key in enumerate(band_keys):
+            self.buckets[band].setdefault(key, idx)
+        return False
+
+
+def filter_training_file(in_filename:str, out_filename:str, tokenizer:"AutoTokenizer"=None, min_dedup_words:int=5,
+                         num_perm:int=64, num_bands:int=16, threshold:float=0.6, batch_size:int=1000, **filter_kwargs) -> dict:
+    """
+    Streams a user's training pairs through the low-signal filters and near-duplicate removal.
+
+    Pairs are read and written one at a time, so memory doesn't depend on the size of the file (besides the
+    MinHash index of the distinct responses, see MinHashLSH). Near-duplicates are found among responses of at
+    least min_dedup_words words, which is where copypasta is; the first occurrence is kept. Shorter responses
+    ("lol", "same") are too alike to tell repeats from genuine replies, so they are only subject to the filters.
+
+    Input:
+        - in_filename: The user's .jsonl file (output of pre_process_text.py).
+        - out_filename: Where the kept pairs are written.
+        - tokenizer: Tokenizer the model is trained with, to report the number of tokens kept (epoch time is
+                     proportional to it). Without one, characters are counted instead.
+        - min_dedup_words: Responses with fewer words aren't checked for near-duplicates.
+        - num_perm, num_bands, threshold: MinHash settings, see MinHashLSH.
+        - batch_size: Number of kept pairs tokenized at once.
+        - filter_kwargs: Settings of the low-signal filters, see low_signal_reason.
+
+    Output:
+        - report: Dictionary with the number of pairs and tokens read and kept, and of pairs dropped by each filter.
+    """
+    lsh = MinHashLSH(num_perm, num_bands, threshold)
+    report = {"pairs_in" : 0, "pairs_out" : 0, "tokens_in" : 0, "tokens_out" : 0, "dropped" : {"near_duplicate" : 0}}
+
+    def count_tokens(texts:list) -> int:
+        if (tokenizer is None):
+            return sum(len(x) for x in texts)
+        return sum(len(x) for x in tokenizer(texts)["input_ids"])
+
+    # Written to a temporary file and renamed at the end, so fine_tune.py never reads a half-written file.
+    tmp_filename = out_filename + ".tmp"
+    texts_in = []
+    texts_out = []
+    with open(tmp_filename, 'w') as out_fp:
+        for pair in iter_jsonl(in_filename):
+            report["pairs_in"] += 1
+            texts_in.append(pair["train"])
+
+            words = normalize_response(pair["response"])
+            reason = low_signal_reason(words, **filter_kwargs)
+            if (reason is None and len(words) >= min_dedup_words and lsh.add(words)):
+                reason = "near_duplicate"
+
+            if (reason is not None):
+                report["dropped"][reason] = report["dropped"].get(reason, 0) + 1
+            else:
+                out_fp.write(json.dumps(pair) + "\n")
+                report["pairs_out"] += 1
+                texts_out.append(pair["train"])
+
+            if (len(texts_in) == batch_size):
+                report["tokens_in"] += count_tokens(texts_in)
+                texts_in = []
+            if (len(texts_out) == batch_size):
+                report["tokens_out"] += count_tokens(texts_out)
+                texts_out = []
+
+    report["tokens_in"] += count_tokens(texts_in) if texts_in else 0
+    report["tokens_out"] += count_tokens(texts_out) if texts_out else 0
+    os.replace(tmp_filename, out_filename)
+    return report
+
+
+def main(model_string:str="openai-gpt", folder:str=FOLDER, out_folder:str=FILTERED_FOLDER, **filter_kwargs):
+    """
+    Filters every user's training pairs (see filter_training_file), writing them to out_folder for fine_tune.py,
+    and reports how much smaller each training set got.
+
+    Input:
+        - model_string: Pretrained model whose tokenizer counts the tokens (None to count characters).
+        - folder: Folder of the per-author .jsonl files written by pre_process_text.py.
+        - out_folder: Folder the filtered files are written to.
+        - filter_kwargs: Settings passed on to filter_training_file.
+    """
+    tokenizer = create_tokenizer(model_string) if model_string is not None else None
+    os.makedirs(out_folder, exist_ok=True)
+    unit = "tokens" if tokenizer is not None else "characters"
+
+    reports = {}
+    for filename in sorted(os.listdir(folder)):
+        if (not filename.endswith(".jsonl")):
+            continue
+        author = filename[ : -len(".jsonl")]
+        report = filter_training_file(f"{folder}/{filename}", f"{out_folder}/{filename}", tokenizer, **filter_kwargs)
+        reports[author] = report
+
+        dropped = ", ".join(f"{count} {reason}" for reason, count in report["dropped"].items() if count > 0)
+        print(f"{author}: kept {report['pairs_out']}/{report['pairs_in']} pairs, {report['tokens_out']}/{report['tokens_in']} {unit} "
+              f"({report['tokens_out'] / max(report['tokens_in'], 1) * 100:.1f}% of the epoch time). Dropped: {dropped or 'nothing'}")
+
+    write_json(reports, f"{out_folder}/report.json")
+
+
+if (__name__ == "__main__"):
+    main()
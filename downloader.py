@@ -1,30 +1,41 @@
-import requests
+import aiohttp
+import asyncio
 import json 
-import time
-from utils import load_secrets, write_json
+import os
+from rate_limit import RateLimiter
+from utils import load_secrets, read_json, iter_jsonl, write_json_atomic, message_store_paths, compact_message_store
 
+API_BASE = "https://discord.com/api/v8"
+MESSAGES_ROUTE = "GET /channels/{channel_id}/messages"
 
-def get_messages(channel_id:str, num_messages:int=100, before_message_id:str=None, headers:dict=None) -> dict:
+
+async def get_messages(session:"aiohttp.ClientSession", rate_limiter:RateLimiter, channel_id:str, num_messages:int=100, 
+                       before_message_id:str=None, after_message_id:str=None, api_base:str=API_BASE) -> list:
     """
     Scrapes messages from a discord channel.
 
     Modified from code in Codium's Youtube Video: https://youtu.be/xh28F6f-Cds
 
     Input:
+        - session: Pooled (keep-alive) aiohttp session. Carries the authorization headers.
+        - rate_limiter: Rate limit scheduler shared by all requests.
         - channel_id: The channel ID of the channel to scrape.
         - num_messages: How many messages to request.
         - before_message_id: Message ID of the last message scraped (for pagination)
-        - headers: Dictionary of header information. 
+        - after_message_id: Only request messages newer than this message ID (for syncing new messages)
+        - api_base: Base URL of the discord API (overridden to point at fake_discord.py for testing).
     
     Output:
         - res_json: The JSON containing the message response from the discord API.
     """
+    params = {"limit" : num_messages}
+    if (before_message_id is not None):
+        params["before"] = before_message_id
+    if (after_message_id is not None):
+        params["after"] = after_message_id
 
-    if (before_message_id is None):
-        response = requests.get(f"https://discord.com/api/v8/channels/{channel_id}/messages?limit={num_messages}", headers=headers)
-    else:
-        response = requests.get(f"https://discord.com/api/v8/channels/{channel_id}/messages?limit={num_messages}&before={before_message_id}", headers=headers)
-    res_json = json.loads(response.text)
+    res_json = await rate_limiter.request(session, "GET", f"{api_base}/channels/{channel_id}/messages", 
+                                          route=MESSAGES_ROUTE, major=channel_id, params=params)
     return res_json
 
 
@@ -61,37 +72,241 @@ def parse_message(res_message:dict) -> dict:
     return message
 
 
-def main():
-    secrets = load_secrets()
-    channel_id = secrets["channels"]["main"]
-    headers = secrets["headers"]
+def load_checkpoint(checkpoint_filename:str) -> dict:
+    """
+    Loads the scrape checkpoint for a channel, or a fresh one if the channel was never scraped.
+
+    Input:
+        - checkpoint_filename: Path to the checkpoint file.
+    
+    Output:
+        - checkpoint: Dictionary with the pagination cursor ("before_message_id"), the size of the
+                      message store when the cursor was saved ("offset"), whether the scrape
+                      reached the start of the channel ("complete") and the newest message 
+                      in the store ("newest_message_id", used by sync_channel).
+    """
+    checkpoint = {"before_message_id" : None, "offset" : 0, "complete" : False, "newest_message_id" : None}
+    if (os.path.exists(checkpoint_filename)):
+        checkpoint.update(read_json(checkpoint_filename))
+    return checkpoint
+
+
+def append_page(store_fp:"io.TextIOWrapper", messages:list) -> int:
+    """
+    Appends a page of parsed messages to a message store and makes sure it reached the disk.
+
+    Input:
+        - store_fp: File object of the message store, opened for appending.
+        - messages: Parsed messages to write.
+    
+    Output:
+        - offset: Size of the store after the write.
+    """
+    store_fp.writelines(json.dumps(message) + "\n" for message in messages)
+    store_fp.flush()
+    os.fsync(store_fp.fileno())
+    return store_fp.tell()
 
-    final_out_json = []
-    message_id = None 
+
+async def scrape_channel(session:"aiohttp.ClientSession", rate_limiter:RateLimiter, channel_id:str, channel_name:str, 
+                         folder:str="messages", api_base:str=API_BASE) -> int:
+    """
+    Scrapes a channel page by page, streaming messages to its append-only .jsonl store.
+
+    After every page the pagination cursor is saved to a checkpoint file, so a crashed or
+    interrupted scrape resumes where it stopped instead of starting over. Only one page of 
+    messages is ever held in memory.
+
+    Input:
+        - session: Pooled (keep-alive) aiohttp session.
+        - rate_limiter: Rate limit scheduler shared by all channels.
+        - channel_id: The channel ID of the channel to scrape.
+        - channel_name: Name of the channel, used to name the store and checkpoint files.
+        - folder: Folder the message store and checkpoint are written to.
+        - api_base: Base URL of the discord API.
+    
+    Output:
+        - num_scraped: Number of messages written by this call.
+          (writes to {folder}/{channel_name}.jsonl and {folder}/{channel_name}.checkpoint.json)
+    """
+    store_filename, checkpoint_filename = message_store_paths(channel_name, folder)
+    checkpoint = load_checkpoint(checkpoint_filename)
+    if (checkpoint["complete"]):
+        print(f"Channel {channel_name} already fully scraped.")
+        return 0
 
     iter_count = 0
-    try:
-        while True:
-            # Sleep one second per 100 messages. Proactive rate limiting.
-            time.sleep(1)
+    num_scraped = 0
+    with open(store_filename, 'a') as store_fp:
+        # A crash between appending a page and saving the checkpoint leaves a page the cursor doesn't know about.
+        # Drop it so it isn't duplicated when the page is fetched again.
+        store_fp.truncate(checkpoint["offset"])
+        store_fp.seek(checkpoint["offset"])
 
+        while True:
             # Scrape 100 messages from discord API, paginating after last message.
-            out_json = get_messages(channel_id, before_message_id=message_id, headers=headers)            
-            for res_message in out_json:
-                final_out_json.append(parse_message(res_message))
-            
+            out_json = await get_messages(session, rate_limiter, channel_id, before_message_id=checkpoint["before_message_id"], 
+                                          api_base=api_base)
+            if (not isinstance(out_json, list)):
+                raise RuntimeError(f"Unexpected response from discord API: {out_json}")
+
+            # An empty page means we've paginated back to the first message in the channel.
+            if (len(out_json) == 0):
+                checkpoint["complete"] = True
+                await asyncio.to_thread(write_json_atomic, checkpoint, checkpoint_filename)
+                break
+
+            # Disk writes happen off the event loop so the other channels keep scraping meanwhile.
+            parsed_messages = [parse_message(res_message) for res_message in out_json]
+            checkpoint["offset"] = await asyncio.to_thread(append_page, store_fp, parsed_messages)
+
             # Last message id (used for pagination on next request above)
-            message_id = out_json[-1]["id"]
+            checkpoint["before_message_id"] = out_json[-1]["id"]
+            if (checkpoint["newest_message_id"] is None):
+                checkpoint["newest_message_id"] = out_json[0]["id"]
+            await asyncio.to_thread(write_json_atomic, checkpoint, checkpoint_filename)
 
+            num_scraped += len(out_json)
             iter_count += 1
             if (iter_count % 100 == 0):
-                print(f"Finished iteration: {iter_count}")
-    except Exception as e:
-        print(f"caught exception: {e}")
-    finally:
-        write_json(final_out_json, "messages/messages.json")
+                print(f"{channel_name}: Finished iteration: {iter_count}")
+
+    return num_scraped
+
+
+async def sync_channel(session:"aiohttp.ClientSession", rate_limiter:RateLimiter, channel_id:str, channel_name:str, 
+                       folder:str="messages", api_base:str=API_BASE) -> int:
+    """
+    Fetches only the messages sent since the newest message in a channel's store and appends them to it.
+
+    Pages forward with after= from the newest snowflake recorded in the checkpoint, so a refresh costs
+    one request per 100 new messages instead of re-walking the whole history. The existing store is 
+    never rewritten; its columnar copy is deduplicated and sorted (see utils.compact_message_store).
+
+    Input:
+        - session: Pooled (keep-alive) aiohttp session.
+        - rate_limiter: Rate limit scheduler shared by all channels.
+        - channel_id: The channel ID of the channel to sync.
+        - channel_name: Name of the channel, used to name the store and checkpoint files.
+        - folder: Folder the message store and checkpoint are written to.
+        - api_base: Base URL of the discord API.
+    
+    Output:
+        - num_synced: Number of new messages written.
+    """
+    store_filename, checkpoint_filename = message_store_paths(channel_name, folder)
+    checkpoint = load_checkpoint(checkpoint_filename)
+
+    # Checkpoints written before syncing existed don't know the newest message. Recover it from the store once.
+    if (checkpoint["newest_message_id"] is None and os.path.exists(store_filename)):
+        newest_id = max((int(message["id"]) for message in iter_jsonl(store_filename)), default=None)
+        checkpoint["newest_message_id"] = None if newest_id is None else str(newest_id)
+
+    # Nothing scraped yet, so there is nothing to sync from. scrape_channel handles this case.
+    if (checkpoint["newest_message_id"] is None):
+        return 0
+
+    num_synced = 0
+    with open(store_filename, 'a') as store_fp:
+        store_fp.truncate(checkpoint["offset"])
+        store_fp.seek(checkpoint["offset"])
+
+        while True:
+            out_json = await get_messages(session, rate_limiter, channel_id, after_message_id=checkpoint["newest_message_id"], 
+                                          api_base=api_base)
+            if (not isinstance(out_json, list)):
+                raise RuntimeError(f"Unexpected response from discord API: {out_json}")
+            if (len(out_json) == 0):
+                break
+
+            # Keep the page newest first, like the pages written by scrape_channel.
+            out_json.sort(key=lambda x: int(x["id"]), reverse=True)
+            parsed_messages = [parse_message(res_message) for res_message in out_json]
+            checkpoint["offset"] = await asyncio.to_thread(append_page, store_fp, parsed_messages)
+            checkpoint["newest_message_id"] = out_json[0]["id"]
+            await asyncio.to_thread(write_json_atomic, checkpoint, checkpoint_filename)
+
+            num_synced += len(out_json)
+            if (len(out_json) < 100):
+                break
+
+    return num_synced
+
+
+async def update_channel(session:"aiohttp.ClientSession", rate_limiter:RateLimiter, channel_id:str, channel_name:str, 
+                         folder:str="messages", api_base:str=API_BASE, sync:bool=True) -> int:
+    """
+    Brings a channel's store up to date: finishes (or starts) the backwards scrape, then syncs new messages.
+
+    Input:
+        - session: Pooled (keep-alive) aiohttp session.
+        - rate_limiter: Rate limit scheduler shared by all channels.
+        - channel_id: The channel ID of the channel.
+        - channel_name: Name of the channel, used to name the store and checkpoint files.
+        - folder: Folder the message store and checkpoint are written to.
+        - api_base: Base URL of the discord API.
+        - sync: Whether to also fetch messages newer than the newest one in the store.
+    
+    Output:
+        - num_scraped: Number of messages written.
+    """
+    num_scraped = await scrape_channel(session, rate_limiter, channel_id, channel_name, folder, api_base)
+    if (sync):
+        num_scraped += await sync_channel(session, rate_limiter, channel_id, channel_name, folder, api_base)
+    return num_scraped
+
+
+async def scrape_all_channels(channels:dict, headers:dict, folder:str="messages", api_base:str=API_BASE, 
+                              rate_limiter:RateLimiter=None, max_connections:int=10, sync:bool=True) -> dict:
+    """
+    Scrapes every channel concurrently over a single pooled keep-alive HTTP client.
+
+    Input:
+        - channels: Dictionary mapping channel name to channel ID (the "channels" section of the secrets file).
+        - headers: Dictionary of header information. 
+        - folder: Folder the message stores and checkpoints are written to.
+        - api_base: Base URL of the discord API.
+        - rate_limiter: Rate limit scheduler. A new one is created if not given.
+        - max_connections: Size of the HTTP connection pool.
+        - sync: Whether to also fetch messages sent since the newest message in each store.
+    
+    Output:
+        - results: Dictionary mapping channel name to the number of messages scraped, or to the
+                   exception that stopped that channel's scrape.
+    """
+    if (rate_limiter is None):
+        rate_limiter = RateLimiter()
+
+    connector = aiohttp.TCPConnector(limit=max_connections, keepalive_timeout=60)
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        channel_names = list(channels.keys())
+        outcomes = await asyncio.gather(
+            *[update_channel(session, rate_limiter, channels[name], name, folder, api_base, sync) for name in channel_names],
+            return_exceptions=True
+        )
+
+    return dict(zip(channel_names, outcomes))
+
+
+def main():
+    secrets = load_secrets()
+    headers = secrets["headers"]
+
+    # Progress is checkpointed after every page, so rerunning after a failure resumes the scrape.
+    # Channels that were already fully scraped only fetch the messages sent since the last run.
+    results = asyncio.run(scrape_all_channels(secrets["channels"], headers))
+    for channel_name, outcome in results.items():
+        if (isinstance(outcome, Exception)):
+            print(f"{channel_name}: caught exception: {outcome}")
+        else:
+            print(f"{channel_name}: scraped {outcome} messages")
+
+        # Refresh the columnar copy of the store that pre_process_text.py reads.
+        store_filename, _ = message_store_paths(channel_name)
+        if (os.path.exists(store_filename)):
+            num_messages = compact_message_store(channel_name)
+            print(f"{channel_name}: {num_messages} messages in columnar store")
 
 
 if __name__ == "__main__":
     main()
-
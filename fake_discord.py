@@ -0,0 +1,216 @@
+from aiohttp import web
+import asyncio
+import random
+import shutil
+import tempfile
+import time
+
+from downloader import scrape_all_channels
+from rate_limit import RateLimiter
+from utils import read_jsonl, message_store_paths, DISCORD_EPOCH
+
+
+def make_channel_messages(channel_index:int, num_messages:int, start_ms:int=1700000000000) -> list:
+    """
+    Creates fake raw API messages for a channel, newest first (the order the API returns them in).
+
+    Input:
+        - channel_index: Index of the channel, mixed into the snowflakes so ids are unique across channels.
+        - num_messages: How many messages to create.
+        - start_ms: Unix time (ms) of the first message.
+
+    Output:
+        - messages: List of raw message dictionaries, in the same schema as the discord API.
+    """
+    messages = []
+    for i in range(num_messages):
+        timestamp_ms = start_ms + i * 30000
+        snowflake = ((timestamp_ms - DISCORD_EPOCH) << 22) | (channel_index << 12) | (i % 4096)
+        author_num = i % 3
+        messages.append({
+            "id" : str(snowflake),
+            "content" : f"fake message {i}",
+            "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp_ms / 1000)) + f".{timestamp_ms % 1000:03d}000+00:00",
+            "type" : 0,
+            "author" : {"id" : str(1000 + author_num), "username" : f"user{author_num}", "global_name" : f"User {author_num}"},
+            "mentions" : [],
+            "mention_everyone" : False,
+        })
+    messages.reverse()
+    return messages
+
+
+class FakeDiscord:
+    """
+    Local stand-in for the discord message history endpoint, with discord-style per-channel rate limits.
+
+    Every channel is its own bucket allowing bucket_limit requests per bucket_window seconds. Responses carry
+    the same X-RateLimit-* headers as discord, and requests over the limit get a 429 with Retry-After.
+    A fraction of requests can also be 429'd at random (spurious_429_rate) to exercise the retry path.
+    """
+
+    def __init__(self, channels:dict, bucket_limit:int=5, bucket_window:float=1.0, spurious_429_rate:float=0.0,
+                 latency:float=0.0) -> None:
+        """
+        Constructor.
+
+        Input:
+            - channels: Dictionary mapping channel ID to its raw messages (newest first).
+            - bucket_limit: Requests allowed per channel per window.
+            - bucket_window: Length of a rate limit window in seconds.
+            - spurious_429_rate: Probability of 429'ing a request that is within the limits.
+            - latency: Seconds of simulated server latency per request.
+        """
+        self.channels = channels
+        self.bucket_limit = bucket_limit
+        self.bucket_window = bucket_window
+        self.spurious_429_rate = spurious_429_rate
+        self.latency = latency
+        self.buckets = {}
+
+        self.num_requests = 0
+        self.num_429 = 0
+        self.num_limit_violations = 0
+
+        self.app = web.Application()
+        self.app.router.add_get("/api/v8/channels/{channel_id}/messages", self.handle_messages)
+        return
+
+
+    def _rate_limit_headers(self, bucket:dict, now:float) -> dict:
+        reset_after = max(0.0, bucket["reset_at"] - now)
+        return {
+            "X-RateLimit-Limit" : str(self.bucket_limit),
+            "X-RateLimit-Remaining" : str(bucket["remaining"]),
+            "X-RateLimit-Reset" : f"{time.time() + reset_after:.3f}",
+            "X-RateLimit-Reset-After" : f"{reset_after:.3f}",
+            "X-RateLimit-Bucket" : "fake-messages-bucket",
+        }
+
+
+    async def handle_messages(self, request:"web.Request") -> "web.Response":
+        self.num_requests += 1
+        channel_id = request.match_info["channel_id"]
+        if (channel_id not in self.channels):
+            return web.json_response({"message" : "Unknown Channel", "code" : 10003}, status=404)
+
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(channel_id, {"remaining" : self.bucket_limit, "reset_at" : now + self.bucket_window})
+        if (now >= bucket["reset_at"]):
+            bucket["remaining"] = self.bucket_limit
+            bucket["reset_at"] = now + self.bucket_window
+
+        over_limit = bucket["remaining"] <= 0
+        if (over_limit or random.random() < self.spurious_429_rate):
+            self.num_429 += 1
+            self.num_limit_violations += int(over_limit)
+            retry_after = max(bucket["reset_at"] - now, 0.05)
+            headers = self._rate_limit_headers(bucket, now)
+            headers["Retry-After"] = f"{retry_after:.3f}"
+            body = {"message" : "You are being rate limited.", "retry_after" : retry_after, "global" : False}
+            return web.json_response(body, status=429, headers=headers)
+
+        bucket["remaining"] -= 1
+        if (self.latency > 0):
+            await asyncio.sleep(self.latency)
+
+        limit = min(int(request.query.get("limit", 50)), 100)
+        messages = self.channels[channel_id]
+        start = 0
+        if ("before" in request.query):
+            before = int(request.query["before"])
+            start = next((i for i, message in enumerate(messages) if int(message["id"]) < before), len(messages))
+        elif ("after" in request.query):
+            # Like discord: the oldest messages after the given id, still returned newest first.
+            after = int(request.query["after"])
+            num_newer = next((i for i, message in enumerate(messages) if int(message["id"]) <= after), len(messages))
+            start = max(0, num_newer - limit)
+            return web.json_response(messages[start : num_newer], headers=self._rate_limit_headers(bucket, now))
+
+        return web.json_response(messages[start : start + limit], headers=self._rate_limit_headers(bucket, now))
+
+
+    async def start(self, host:str="127.0.0.1", port:int=0) -> str:
+        """
+        Starts serving in the background on the running event loop.
+
+        Input:
+            - host: Interface to bind to.
+            - port: Port to bind to (0 picks a free port).
+
+        Output:
+            - api_base: Base URL to pass to the downloader in place of the discord API.
+        """
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{bound_port}/api/v8"
+
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+        return
+
+
+async def run_benchmark(num_channels:int=4, messages_per_channel:int=2000, bucket_limit:int=5, bucket_window:float=1.0,
+                        spurious_429_rate:float=0.05, latency:float=0.01) -> dict:
+    """
+    Scrapes a fake server end to end and reports throughput and rate limit behavior.
+
+    Input:
+        - num_channels: Number of channels to serve.
+        - messages_per_channel: Messages in each channel.
+        - bucket_limit, bucket_window, spurious_429_rate, latency: See FakeDiscord.
+
+    Output:
+        - report: Dictionary of benchmark results.
+    """
+    channels = {}
+    channel_names = {}
+    for channel_index in range(num_channels):
+        channel_id = str(900000 + channel_index)
+        channels[channel_id] = make_channel_messages(channel_index, messages_per_channel)
+        channel_names[f"channel{channel_index}"] = channel_id
+
+    server = FakeDiscord(channels, bucket_limit, bucket_window, spurious_429_rate, latency)
+    api_base = await server.start()
+    folder = tempfile.mkdtemp()
+    rate_limiter = RateLimiter()
+    try:
+        start = time.perf_counter()
+        results = await scrape_all_channels(channel_names, {"authorization" : "fake"}, folder=folder,
+                                            api_base=api_base, rate_limiter=rate_limiter)
+        elapsed = time.perf_counter() - start
+
+        # Every message should be in the store exactly once.
+        all_complete = True
+        for channel_name, channel_id in channel_names.items():
+            stored_ids = [x["id"] for x in read_jsonl(message_store_paths(channel_name, folder)[0])]
+            all_complete &= stored_ids == [x["id"] for x in channels[channel_id]]
+    finally:
+        await server.stop()
+        shutil.rmtree(folder)
+
+    num_messages = sum(x for x in results.values() if isinstance(x, int))
+    return {
+        "messages" : num_messages,
+        "seconds" : elapsed,
+        "messages_per_second" : num_messages / elapsed,
+        "requests" : server.num_requests,
+        "429_responses" : server.num_429,
+        "limit_violations" : server.num_limit_violations,
+        "all_messages_stored" : all_complete,
+        "errors" : {name : str(x) for name, x in results.items() if isinstance(x, Exception)},
+    }
+
+
+def main():
+    report = asyncio.run(run_benchmark())
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if (__name__ == "__main__"):
+    main()
@@ -1,8 +1,20 @@
-from transformers import OpenAIGPTLMHeadModel, AutoTokenizer
+from transformers import OpenAIGPTLMHeadModel
+import functools
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
 import torch
-from torch.utils.data import DataLoader, Dataset
+import torch.utils.checkpoint
+from torch.utils.data import DataLoader, Dataset, Sampler
+import time
 import tqdm
-from utils import read_jsonl, BOS, SEP, EOS, PAD, VALID_EMOTES, IMG_TOKEN, GIF_TOKEN, LINK_TOKEN
+from lora import add_lora, lora_parameter_groups, save_adapter
+from metrics import MetricsLogger, PhaseTimer, peak_rss_mb
+from utils import read_json, write_json, iter_jsonl, create_tokenizer, MAX_SEQUENCE_LENGTH
+
+TOKEN_CACHE_FOLDER = "cache/tokens"
 
 
 class MimicDataset(Dataset):
@@ -15,7 +27,7 @@ class MimicDataset(Dataset):
 
     def __getitem__(self, idx):
         train_text = self.raw_strings[idx]
-        tokenized = self.tokenizer(train_text, return_tensors="pt", padding='max_length', max_length=512, truncation=True)
+        tokenized = self.tokenizer(train_text, return_tensors="pt", padding='max_length', max_length=MAX_SEQUENCE_LENGTH, truncation=True)
         input_ids = tokenized.input_ids.squeeze()
         
         # Leaving for reference, but official docs for fine-tuning GPT 2 use same input_ids as label
@@ -30,33 +42,389 @@ class MimicDataset(Dataset):
 
 
 
-def create_tokenizer(model_string : str) -> "AutoTokenizer":
+def tokenizer_fingerprint(tokenizer:"AutoTokenizer") -> str:
+    """
+    Hash identifying everything about a tokenizer that affects the token ids it produces.
+
+    Input:
+        - tokenizer: The tokenizer.
+
+    Output:
+        - fingerprint: Hex digest.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(type(tokenizer).__name__.encode())
+    hasher.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    hasher.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+def file_sha256(filename:str) -> str:
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def build_token_cache(jsonl_filename:str, tokenizer:"AutoTokenizer", max_length:int=MAX_SEQUENCE_LENGTH, 
+                      cache_folder:str=TOKEN_CACHE_FOLDER, batch_size:int=1000) -> str:
+    """
+    Tokenizes the "train" strings of a user's .jsonl file once and stores the token ids on disk.
+
+    The cache is keyed by the tokenizer fingerprint, the hash of the .jsonl file and max_length, so it is
+    reused across epochs and reruns and rebuilt automatically when any of them changes.
+    Token ids of all examples are concatenated in tokens.bin (int32), with offsets.npy marking where each
+    example starts.
+
+    Input:
+        - jsonl_filename: Path of the user's .jsonl file (output of pre_process_text.py).
+        - tokenizer: Tokenizer the model is trained with.
+        - max_length: Examples are truncated to this many tokens, like MimicDataset does.
+        - cache_folder: Folder the caches are kept in.
+        - batch_size: Number of examples tokenized at once.
+
+    Output:
+        - cache_dir: Directory of the cache (see TokenCacheDataset).
+    """
+    key = hashlib.sha256(f"{tokenizer_fingerprint(tokenizer)}-{file_sha256(jsonl_filename)}-{max_length}".encode()).hexdigest()
+    cache_dir = f"{cache_folder}/{key[:24]}"
+    if (os.path.exists(cache_dir + "/meta.json")):
+        return cache_dir
+
+    # Build in a temporary directory and rename at the end, so a half-built cache is never used.
+    tmp_dir = cache_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    offsets = [0]
+    def write_batch(texts:list, tokens_fp:"io.BufferedWriter") -> None:
+        for input_ids in tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]:
+            tokens_fp.write(np.asarray(input_ids, dtype=np.int32).tobytes())
+            offsets.append(offsets[-1] + len(input_ids))
+        return 
+
+    with open(tmp_dir + "/tokens.bin", 'wb') as tokens_fp:
+        texts = []
+        for x in iter_jsonl(jsonl_filename):
+            texts.append(x["train"])
+            if (len(texts) == batch_size):
+                write_batch(texts, tokens_fp)
+                texts = []
+        if (len(texts) > 0):
+            write_batch(texts, tokens_fp)
+
+    np.save(tmp_dir + "/offsets.npy", np.array(offsets, dtype=np.int64))
+    write_json({"source" : jsonl_filename, "num_examples" : len(offsets) - 1, "num_tokens" : offsets[-1],
+                "max_length" : max_length, "pad_token_id" : tokenizer.pad_token_id}, tmp_dir + "/meta.json")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+    return cache_dir
+
+
+class TokenCacheDataset(Dataset):
+    """
+    Dataset reading pre-tokenized examples from a cache built by build_token_cache.
+
+    The token ids are memory-mapped, and each item is a view into the map (no tokenization and no copy).
+    Items are not padded; use pad_to_max_length or pad_to_longest in the DataLoader (see create_data_loader).
+    """
+
+    def __init__(self, cache_dir:str):
+        self.cache_dir = cache_dir
+        self.meta = read_json(cache_dir + "/meta.json")
+        self.offsets = np.load(cache_dir + "/offsets.npy")
+        self.tokens = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self) -> "np.ndarray":
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        # Mapped lazily so DataLoader workers each map the file instead of receiving a pickled copy.
+        # Copy-on-write mode gives torch a writable array without reading the file into memory.
+        if (self.tokens is None):
+            self.tokens = np.memmap(self.cache_dir + "/tokens.bin", dtype=np.int32, mode='c') if self.meta["num_tokens"] > 0 else np.zeros(0, dtype=np.int32)
+
+        return {
+            "input_ids" : torch.from_numpy(self.tokens[self.offsets[idx] : self.offsets[idx + 1]]),
+        }
+
+
+def pad_to_max_length(batch:list, pad_token_id:int, max_length:int=MAX_SEQUENCE_LENGTH) -> dict:
+    """
+    Collate function padding every example to max_length, the same as MimicDataset does.
+
+    Input:
+        - batch: List of items from TokenCacheDataset.
+        - pad_token_id: Id of the padding token.
+        - max_length: Length to pad to.
+
+    Output:
+        - batch: Dictionary with "input_ids", "attention_mask" and "labels" of shape (batch size, max_length).
+                 Padding is masked out of the attention and the loss (label -100).
     """
-    Helper function to create tokenizer and add any new vocab. 
+    input_ids = torch.full((len(batch), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), max_length), dtype=torch.long)
+    labels = torch.full((len(batch), max_length), -100, dtype=torch.long)
+    for i, item in enumerate(batch):
+        length = len(item["input_ids"])
+        input_ids[i, : length] = item["input_ids"]
+        attention_mask[i, : length] = 1
+        labels[i, : length] = item["labels"] if "labels" in item else item["input_ids"]
+    
+    batch_out = {"input_ids" : input_ids, "attention_mask" : attention_mask, "labels" : labels}
+
+    # Packed examples restart their positions at every example boundary.
+    if ("position_ids" in batch[0]):
+        batch_out["position_ids"] = torch.zeros((len(batch), max_length), dtype=torch.long)
+        for i, item in enumerate(batch):
+            batch_out["position_ids"][i, : len(item["position_ids"])] = item["position_ids"]
+
+    return batch_out
+
+
+def pad_to_longest(batch:list, pad_token_id:int) -> dict:
+    """
+    Collate function padding only to the longest example in the batch (dynamic padding).
 
     Input:
-        - model_string: The name of the pretrained model whose tokenizer should be loaded.
+        - batch: List of items from TokenCacheDataset or PackedDataset.
+        - pad_token_id: Id of the padding token.
+
+    Output:
+        - batch: Same as pad_to_max_length, with the length of the longest example.
     """
+    return pad_to_max_length(batch, pad_token_id, max(len(item["input_ids"]) for item in batch))
 
-    tokenizer = AutoTokenizer.from_pretrained(model_string)
 
-    # https://stackoverflow.com/questions/76198051/how-to-add-new-tokens-to-an-existing-huggingface-tokenizer
-    new_vocab = [IMG_TOKEN, GIF_TOKEN, LINK_TOKEN] + VALID_EMOTES
-    new_tokens = set(new_vocab) - set(tokenizer.vocab.keys())
-    tokenizer.add_tokens(list(new_tokens))
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler grouping examples of similar length, so dynamic padding adds little padding.
+
+    Indices are shuffled, split into buckets of batch_size * bucket_batches examples, sorted by length within
+    each bucket and cut into batches. The order of the batches is then shuffled again, so batches are still
+    random across the dataset.
+    """
+
+    def __init__(self, lengths:"np.ndarray", batch_size:int, bucket_batches:int=50, shuffle:bool=True, seed:int=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
 
-    # We can add these special tokens to the vocabulary and the embeddings of the model:
-    tokenizer.add_special_tokens({
-        'pad_token': PAD, 
-        'sep_token' : SEP, 
-        'bos_token' : BOS,
-        'eos_token' : EOS
-    })
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
 
-    return tokenizer
+        batches = []
+        for bucket_start in range(0, len(indices), self.bucket_size):
+            bucket = indices[bucket_start : bucket_start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches += [bucket[i : i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size)]
 
+        if (self.shuffle):
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter(batches)
 
-def fine_tune(data_loader, model, optimizer, num_epochs, device):
+
+class PackedDataset(Dataset):
+    """
+    Packs several [BOS] ... [EOS] examples back to back into blocks of up to block_size tokens.
+
+    Examples are never split across blocks. Within a block, position ids restart at every example and the
+    first token of each example is left out of the loss (it would otherwise be predicted from the previous
+    example). The model must be trained with enable_packed_attention, so tokens only attend to their own example
+    and each example is trained on exactly as if it were alone in its sequence.
+    """
+
+    def __init__(self, dataset:TokenCacheDataset, block_size:int=MAX_SEQUENCE_LENGTH):
+        self.dataset = dataset
+        self.block_size = block_size
+
+        # Greedy packing in dataset order: start a new block whenever the next example doesn't fit.
+        self.blocks = []
+        block_start = 0
+        block_tokens = 0
+        for idx, length in enumerate(dataset.lengths()):
+            if (block_tokens + length > block_size and idx > block_start):
+                self.blocks.append((block_start, idx))
+                block_start = idx
+                block_tokens = 0
+            block_tokens += length
+        if (len(dataset) > block_start):
+            self.blocks.append((block_start, len(dataset)))
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def lengths(self) -> "np.ndarray":
+        offsets = self.dataset.offsets
+        return np.array([min(offsets[stop] - offsets[start], self.block_size) for start, stop in self.blocks])
+
+    def __getitem__(self, idx):
+        start, stop = self.blocks[idx]
+        examples = [self.dataset[i]["input_ids"] for i in range(start, stop)]
+        input_ids = torch.cat(examples).long()[: self.block_size]
+        position_ids = torch.cat([torch.arange(len(x)) for x in examples])[: self.block_size]
+        labels = input_ids.clone()
+        labels[position_ids == 0] = -100
+
+        return {"input_ids" : input_ids, "position_ids" : position_ids, "labels" : labels}
+
+
+def create_data_loader(cache_dir:str, pad_token_id:int, batch_size:int=8, padding:str="bucketed", 
+                       block_size:int=MAX_SEQUENCE_LENGTH) -> "DataLoader":
+    """
+    Creates the training DataLoader for a token cache.
+
+    Input:
+        - cache_dir: Token cache built by build_token_cache.
+        - pad_token_id: Id of the padding token.
+        - batch_size: Examples (or packed blocks) per batch.
+        - padding: One of
+            - "max_length": every example padded to block_size (the original setup).
+            - "longest": padded to the longest example in the (random) batch.
+            - "bucketed": like "longest", with batches of examples of similar length (LengthBucketSampler).
+            - "packed": examples packed into blocks of block_size tokens (PackedDataset), padded to the longest block.
+        - block_size: Maximum sequence length.
+
+    Output:
+        - data_loader: The DataLoader.
+    """
+    dataset = TokenCacheDataset(cache_dir)
+
+    if (padding == "max_length"):
+        collate_fn = functools.partial(pad_to_max_length, pad_token_id=pad_token_id, max_length=block_size)
+        return DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
+
+    collate_fn = functools.partial(pad_to_longest, pad_token_id=pad_token_id)
+    if (padding == "longest"):
+        return DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
+    elif (padding == "bucketed"):
+        return DataLoader(dataset, batch_sampler=LengthBucketSampler(dataset.lengths(), batch_size), collate_fn=collate_fn)
+    elif (padding == "packed"):
+        return DataLoader(PackedDataset(dataset, block_size), batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
+
+    raise ValueError(f"Unknown padding mode: {padding}")
+
+
+def enable_gradient_checkpointing(model:"OpenAIGPTLMHeadModel") -> None:
+    """
+    Recomputes each transformer block's activations during the backward pass instead of storing them.
+
+    Caps activation memory at roughly one block's worth per layer boundary, for about one extra forward pass of compute.
+    Uses the transformers implementation when the model has one (GPT 1 doesn't), otherwise wraps each block.
+
+    Input:
+        - model: The model.
+    """
+    if (model.supports_gradient_checkpointing):
+        model.gradient_checkpointing_enable()
+        return
+
+    for block in model.transformer.h:
+        block_forward = block.forward
+
+        def checkpointed_forward(*args, block_forward=block_forward, **kwargs):
+            if (not torch.is_grad_enabled()):
+                return block_forward(*args, **kwargs)
+            return torch.utils.checkpoint.checkpoint(block_forward, *args, use_reentrant=False, **kwargs)
+
+        block.forward = checkpointed_forward
+    return 
+
+
+def packed_attention_mask(position_ids:"torch.Tensor", attention_mask:"torch.Tensor", dtype:"torch.dtype") -> "torch.Tensor":
+    """
+    Block-diagonal attention mask of packed sequences (see PackedDataset): each token may only attend to the
+    tokens of its own example that aren't padding. The causal part is left to the model.
+
+    Input:
+        - position_ids: Position ids of shape (batch size, length), restarting at 0 at every example.
+        - attention_mask: Padding mask of shape (batch size, length), or None.
+        - dtype: Data type of the mask.
+
+    Output:
+        - mask: Additive mask of shape (batch size, 1, length, length), 0 where attention is allowed.
+    """
+    example_ids = (position_ids == 0).cumsum(dim=-1)
+    allowed = example_ids[:, :, None] == example_ids[:, None, :]
+    if (attention_mask is not None):
+        allowed = allowed & attention_mask[:, None, :].bool()
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=position_ids.device).masked_fill(~allowed, torch.finfo(dtype).min)
+    return mask[:, None]
+
+
+def enable_packed_attention(model:"OpenAIGPTLMHeadModel") -> None:
+    """
+    Makes the model attend within each example of packed batches (see PackedDataset), so a packed example gets
+    the same loss as it would alone in its sequence.
+
+    GPT 1 only takes a padding mask, which it expands to (batch size, 1, 1, length) before its blocks. When the
+    model is called with position_ids, a hook builds the block-diagonal mask from them (see packed_attention_mask)
+    and each block is given that mask instead. Calls without position_ids (e.g. other padding modes) are unchanged.
+
+    Input:
+        - model: The model.
+    """
+    transformer = model.transformer
+    if (hasattr(transformer, "packed_attention_mask")):
+        return
+    transformer.packed_attention_mask = None
+
+    def build_mask(module, args, kwargs):
+        position_ids = kwargs.get("position_ids")
+        module.packed_attention_mask = None if position_ids is None else \
+            packed_attention_mask(position_ids, kwargs.get("attention_mask"), model.dtype)
+
+    # Blocks are called as block(hidden_states, attention_mask, ...). The mask is passed on as an argument, so
+    # gradient checkpointing recomputes the block with the same mask.
+    def use_mask(module, args, kwargs):
+        if (transformer.packed_attention_mask is None):
+            return None
+        return (args[0], transformer.packed_attention_mask) + args[2:], kwargs
+
+    transformer.register_forward_pre_hook(build_mask, with_kwargs=True)
+    for block in transformer.h:
+        block.register_forward_pre_hook(use_mask, with_kwargs=True)
+    return 
+
+
+def create_draft_model(model_string:str, vocab_size:int, num_layers:int=2) -> "OpenAIGPTLMHeadModel":
+    """
+    Creates a small draft model for speculative decoding (see speculative.py): the pretrained model cut down to
+    its first num_layers layers. It shares the pretrained embeddings (and so the tokenizer), and is fine-tuned
+    on the same user's data as the full model, so it guesses most of the full model's tokens at a fraction of
+    the cost.
+
+    Input:
+        - model_string: The name of the pretrained model.
+        - vocab_size: Size of the vocabulary with the custom tokens (len(tokenizer)).
+        - num_layers: Number of transformer layers kept.
+
+    Output:
+        - model: The draft model.
+    """
+    model = OpenAIGPTLMHeadModel.from_pretrained(model_string)
+    model.resize_token_embeddings(vocab_size)
+    model.transformer.h = model.transformer.h[ : num_layers]
+    model.config.n_layer = num_layers
+    return model
+
+
+def fine_tune(data_loader, model, optimizer, num_epochs, device, grad_accum_steps:int=1, bf16:bool=False, 
+              gradient_checkpointing:bool=False, num_threads:int=None, metrics_file:str=None, profile_steps:tuple=None,
+              profile_dir:str="profiles"):
     """
     Fine tunes model using traditional training loop for maximum control.
 
@@ -66,36 +434,119 @@ def fine_tune(data_loader, model, optimizer, num_epochs, device):
         - optimizer: Optimizer for training
         - num_epochs : Number of epochs for training
         - device: Needed for pushing vectors to GPU
+        - grad_accum_steps: Number of batches whose gradients are summed before each optimizer step
+                            (effective batch size = batch size * grad_accum_steps).
+        - bf16: Run the forward pass under bfloat16 autocast (works on CPU as well as GPU).
+        - gradient_checkpointing: Trade compute for activation memory (see enable_gradient_checkpointing).
+        - num_threads: Number of threads torch uses for intra-op parallelism (defaults to torch's choice).
+        - metrics_file: Path of a .jsonl file to append per-step metrics to (time spent loading data, in the forward
+                        pass, backward pass and optimizer, real tokens/sec, loss, peak RSS) and per-epoch summaries.
+        - profile_steps: Optional (first_step, num_steps) window of global steps to record with torch.profiler.
+        - profile_dir: Folder the profiler's chrome traces are written to.
     
     Output:
         - model: Fine-tuned model.
     """
+    if (num_threads is not None):
+        torch.set_num_threads(num_threads)
+    if (gradient_checkpointing):
+        enable_gradient_checkpointing(model)
+    if (isinstance(data_loader.dataset, PackedDataset)):
+        enable_packed_attention(model)
+
+    metrics = MetricsLogger(metrics_file)
+    metrics.log("config", num_epochs=num_epochs, batch_size=data_loader.batch_size, grad_accum_steps=grad_accum_steps, bf16=bf16,
+                gradient_checkpointing=gradient_checkpointing, num_threads=torch.get_num_threads(), device=str(device))
+    timer = PhaseTimer(torch.cuda.synchronize if device.type == "cuda" else None)
+
+    profiler = None
+    if (profile_steps is not None):
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler = torch.profiler.profile(
+            schedule=torch.profiler.schedule(wait=max(profile_steps[0] - 1, 0), warmup=min(profile_steps[0], 1), active=profile_steps[1],
+                                             repeat=1),
+            on_trace_ready=lambda prof: prof.export_chrome_trace(f"{profile_dir}/trace_{prof.step_num}.json"),
+            record_shapes=True, profile_memory=True
+        )
+        profiler.start()
 
     model.train()
+    global_step = 0
     for epoch in range(num_epochs):
         total_loss = 0
-        for batch in tqdm.tqdm(data_loader):
-            input_ids = batch["input_ids"].to(device)
+        epoch_tokens = 0
+        epoch_start = time.perf_counter()
+        optimizer.zero_grad()
+        timer.reset()
+        for step, batch in enumerate(tqdm.tqdm(data_loader)):
+            inputs = {key : value.to(device) for key, value in batch.items()}
+            num_tokens = int(inputs["attention_mask"].sum()) if "attention_mask" in inputs else inputs["input_ids"].numel()
+            timer.lap("data")
             
-            # Forward pass with custom masks
-            optimizer.zero_grad()
-            outputs = model(input_ids, labels=input_ids)
+            # Forward pass with custom masks. Batches from the collate functions carry labels with padding 
+            # masked out (-100); plain input_ids are their own labels.
+            labels = inputs.pop("labels", inputs["input_ids"])
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+                outputs = model(**inputs, labels=labels)
 
             loss = outputs.loss
             total_loss += loss.item()
-
-            # Backward pass and optimization
-            loss.backward()
-            optimizer.step()
+            timer.lap("forward")
+
+            # Backward pass, optimizing once every grad_accum_steps batches (and at the end of the epoch).
+            (loss / grad_accum_steps).backward()
+            timer.lap("backward")
+            if ((step + 1) % grad_accum_steps == 0 or step + 1 == len(data_loader)):
+                optimizer.step()
+                optimizer.zero_grad()
+            timer.lap("optimizer")
+
+            phases = timer.reset()
+            step_seconds = sum(phases.values())
+            epoch_tokens += num_tokens
+            metrics.log("step", epoch=epoch, step=global_step, loss=loss.item(), tokens=num_tokens, 
+                        tokens_per_second=num_tokens / step_seconds, step_seconds=step_seconds,
+                        **{f"{phase}_seconds" : seconds for phase, seconds in phases.items()}, peak_rss_mb=peak_rss_mb())
+            if (profiler is not None):
+                profiler.step()
+            global_step += 1
 
         average_loss = total_loss / len(data_loader)
+        epoch_seconds = time.perf_counter() - epoch_start
+        metrics.log("epoch", epoch=epoch, average_loss=average_loss, seconds=epoch_seconds, tokens=epoch_tokens, 
+                    tokens_per_second=epoch_tokens / epoch_seconds, peak_rss_mb=peak_rss_mb())
         print(f"Epoch {epoch + 1}/{num_epochs}, Average Loss: {average_loss}")
 
+    if (profiler is not None):
+        profiler.stop()
+    metrics.close()
+
     return model 
 
 
 
-def main():
+def main(padding:str="bucketed", batch_size:int=8, grad_accum_steps:int=1, num_epochs:int=3, learning_rate:float=1e-5,
+         bf16:bool=False, gradient_checkpointing:bool=False, num_threads:int=None, metrics_file:str=None, profile_steps:tuple=None,
+         lora_rank:int=None, lora_alpha:float=16, lora_learning_rate:float=1e-3, draft_layers:int=None,
+         data_folder:str="../messages/user_messages"):
+    """
+    Fine-tunes a model on one user's messages.
+
+    Input:
+        - padding: How batches are padded (see create_data_loader).
+        - batch_size: Examples per batch.
+        - grad_accum_steps, bf16, gradient_checkpointing, num_threads, metrics_file, profile_steps: See fine_tune().
+        - num_epochs: Number of epochs for training.
+        - learning_rate: Learning rate of the optimizer.
+        - lora_rank: If set, the base model is frozen and only LoRA adapters of this rank (plus the embeddings of
+                     the custom tokens) are trained and saved, see lora.py.
+        - lora_alpha: Scaling of the LoRA adapters.
+        - lora_learning_rate: Learning rate of the optimizer when training LoRA adapters.
+        - draft_layers: If set, a draft model with this many layers is also trained, which the bot uses to reply
+                        faster with speculative decoding (see create_draft_model).
+        - data_folder: Folder of the users' .jsonl files, e.g. "../messages/user_messages/filtered" to train on the
+                       output of dedup.py.
+    """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
@@ -105,23 +556,44 @@ def main():
     # Curate Tokenizer and Dataset.
     tokenizer = create_tokenizer(model_string)
 
-    train_data = [x["train"] for x in read_jsonl(f"../messages/user_messages/{username}.jsonl")]
-    user_dataset = MimicDataset(train_data, tokenizer)
-    data_loader = DataLoader(user_dataset, batch_size=8, shuffle=True)
+    # Tokenized once and cached on disk, later epochs and reruns read token ids straight from the cache.
+    # Batches are padded to their longest example, with examples of similar length batched together.
+    cache_dir = build_token_cache(f"{data_folder}/{username}.jsonl", tokenizer)
+    data_loader = create_data_loader(cache_dir, tokenizer.pad_token_id, batch_size=batch_size, padding=padding)
 
     # Define Model
     model = OpenAIGPTLMHeadModel.from_pretrained(model_string)
+    base_vocab_size = model.get_input_embeddings().weight.shape[0]
     model.resize_token_embeddings(len(tokenizer))
+    if (lora_rank is not None):
+        add_lora(model, rank=lora_rank, alpha=lora_alpha, base_vocab_size=base_vocab_size)
     model.to(device)
 
     # Fine Tuning
-    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
-    model = fine_tune(data_loader, model, optimizer, num_epochs=3, device=device)
-
-    # Saving results
-    model.save_pretrained(f"models/gpt/{username}/model")
+    if (lora_rank is not None):
+        optimizer = torch.optim.AdamW(lora_parameter_groups(model), lr=lora_learning_rate)
+    else:
+        optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+    model = fine_tune(data_loader, model, optimizer, num_epochs=num_epochs, device=device, grad_accum_steps=grad_accum_steps, 
+                      bf16=bf16, gradient_checkpointing=gradient_checkpointing, num_threads=num_threads, 
+                      metrics_file=metrics_file, profile_steps=profile_steps)
+
+    # Saving results (only the adapter when training LoRA, the base model is shared by every user)
+    if (lora_rank is not None):
+        save_adapter(model, f"models/gpt/{username}/adapter", model_string)
+    else:
+        model.save_pretrained(f"models/gpt/{username}/model")
     tokenizer.save_pretrained(f"models/gpt/{username}/tokenizer")
 
+    # The draft model is trained on the same data, after the full model so they aren't in memory together.
+    if (draft_layers is not None):
+        del model, optimizer
+        draft_model = create_draft_model(model_string, len(tokenizer), draft_layers).to(device)
+        optimizer = torch.optim.AdamW(draft_model.parameters(), lr=learning_rate)
+        draft_model = fine_tune(data_loader, draft_model, optimizer, num_epochs=num_epochs, device=device, grad_accum_steps=grad_accum_steps,
+                                bf16=bf16, num_threads=num_threads, metrics_file=metrics_file)
+        draft_model.save_pretrained(f"models/gpt/{username}/draft")
+
     return 
 
 
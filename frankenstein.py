@@ -1,8 +1,16 @@
+import asyncio
 import discord
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import time
+import traceback
 
-from pre_process_text import process_msg_text
-from utils import load_secrets, BOS, SEP, EOS
+from utils import load_secrets
+
+# torch and transformers (through conversation, inference, model_cache and speculative) take seconds to import,
+# they are imported by MimicBot.load while the client connects rather than here.
+
+# Messages to unknown personas look for newly trained ones at most this often (scanning the model folder
+# runs on the event loop, and anyone can send "$anything").
+PERSONA_RESCAN_SECONDS = 30
 
 
 class MimicBot(discord.Client):
@@ -12,59 +20,316 @@ class MimicBot(discord.Client):
     Mixed with this Minimal Bot in [the discordpy docs](https://discordpy.readthedocs.io/en/stable/quickstart.html#a-minimal-bot).
     """
 
-    def __init__(self, intents : "discord.Intents", username:str, model_prompt:str) -> None:
+    def __init__(self, intents : "discord.Intents", model_prompt:str="$", model_folder:str=None,
+                 memory_budget_mb:float=2048, metrics_file:str=None, num_workers:int=2, max_pending:int=32, 
+                 max_pending_per_channel:int=4, timeout:float=60, max_batch_size:int=8, batch_window:float=0.02, max_context_tokens:int=256,
+                 max_conversations:int=32, backend:str="eager", num_draft_tokens:int=4, warm_up_personas:list=None) -> None:
         """
         Constructor. 
 
         Input:
             - intents: discord intents object with message content set to True.
-            - username: Username of model to load.
+            - model_prompt: Prefix of messages to the bot, followed by the name of the persona (e.g. "$matthew").
+            - model_folder: Folder with one folder per trained persona (see fine_tune.py), model_cache.MODEL_FOLDER if None.
+            - memory_budget_mb: Memory the loaded models may use in total, see model_cache.ModelCache.
+            - metrics_file: Path of a .jsonl file to log model loads, evictions, generation and startup times to.
+            - num_workers: Replies generated at the same time, see inference.InferenceScheduler.
+            - max_pending: Most messages waiting for a reply before the bot starts turning them away.
+            - max_pending_per_channel: Most messages of one channel waiting for a reply, so one busy channel can't fill
+                                       the whole queue.
+            - timeout: Seconds after which the bot gives up on a reply.
+            - max_batch_size: Most messages to the same persona generated together.
+            - batch_window: Seconds a message waits for others to the same persona to generate together with.
+            - max_context_tokens: Most tokens of the conversation in a channel the bot reads before replying.
+            - max_conversations: Most conversations (channel and persona pairs) the bot remembers.
+            - backend: How the models are run ("eager", "int8", "torchscript" or "onnx"), see backends.py.
+            - num_draft_tokens: Tokens proposed per step by the draft models of personas that have one, see speculative.py.
+            - warm_up_personas: Personas loaded once connected, so their first reply doesn't wait for their model
+                                (None for every persona, as long as they fit in memory_budget_mb, [] for none).
         """
         super().__init__(intents=intents)
-        self.username = username
         self.model_prompt = model_prompt
+        self.model_folder = model_folder
+        self.memory_budget_mb = memory_budget_mb
+        self.metrics_file = metrics_file
+        self.backend = backend
+        self.num_draft_tokens = num_draft_tokens
+        self.warm_up_personas = warm_up_personas
+        self.scheduler_kwargs = {"num_workers" : num_workers, "max_pending" : max_pending,
+                                 "max_pending_per_channel" : max_pending_per_channel, "timeout" : timeout,
+                                 "max_batch_size" : max_batch_size, "batch_window" : batch_window}
+        self.max_context_tokens = max_context_tokens
+        self.max_conversations = max_conversations
+
+        # Created by load. Messages to the bot wait for loaded to be set.
+        self.model_cache = None
+        self.personas = set()
+        self.personas_scanned_at = 0.0
+        self.conversations = None
+        self.scheduler = None
+        self.loaded = asyncio.Event()
+        self.startup_task = None
+
+        # Seconds each phase of the startup took (see __report_startup), measured from here.
+        self.created_at = time.perf_counter()
+        self.startup_seconds = {}
+        return
+
+
+    def __create_runtime(self) -> None:
+        """
+        Imports the modules that need torch and transformers and creates the model cache, conversations and
+        scheduler. Blocking, ran in a thread by load.
+        """
+        start = time.perf_counter()
+        from conversation import ConversationCache
+        from inference import InferenceScheduler
+        from model_cache import ModelCache, MODEL_FOLDER
+        # Imported here rather than by the first reply (see __get_model_outputs).
+        import speculative
+        self.startup_seconds["import_seconds"] = time.perf_counter() - start
+
+        # Models are loaded the first time someone talks to their persona (or by warm_up), not up front.
+        model_folder = self.model_folder if self.model_folder is not None else MODEL_FOLDER
+        self.model_cache = ModelCache(model_folder, self.memory_budget_mb, self.metrics_file, self.backend)
+        self.personas = set(self.model_cache.available())
+        self.personas_scanned_at = time.monotonic()
+
+        # Recent messages and replies of each channel, so replies follow the conversation (see conversation.py).
+        self.conversations = ConversationCache(self.max_conversations, self.max_context_tokens)
 
-        self.tokenizer = AutoTokenizer.from_pretrained(f"models/gpt2/{username}/tokenizer")
-        self.model = AutoModelForCausalLM.from_pretrained(f"models/gpt2/{username}/model")
+        # Generation runs in worker threads, off the event loop, so the client keeps up with the gateway meanwhile.
+        self.scheduler = InferenceScheduler(self.__respond, metrics_file=self.metrics_file, **self.scheduler_kwargs)
+        return
+
+
+    async def load(self) -> None:
+        """
+        Imports torch and transformers (in a thread, so the event loop keeps running) and starts the generation
+        workers. Does nothing if already loaded.
+        """
+        if (self.loaded.is_set()):
+            return
+        await asyncio.to_thread(self.__create_runtime)
+        await self.scheduler.start()
+        self.loaded.set()
         return 
+
+
+    async def setup_hook(self) -> None:
+        """
+        Ran once before connecting to discord. Starts loading in the background, so connecting doesn't wait for it.
+        """
+        self.startup_task = asyncio.create_task(self.__start())
+        return
+
+
+    async def __start(self) -> None:
+        """
+        Loads the bot, then warms up the personas once connected and reports how long starting took.
+        """
+        try:
+            await self.load()
+        except Exception:
+            # The bot can't reply to anything without its models, stop rather than stay online doing nothing.
+            traceback.print_exc()
+            await self.close()
+            return
+
+        await self.wait_until_ready()
+        self.__report_startup(await self.warm_up())
+        return
+
+
+    async def close(self) -> None:
+        if (self.startup_task is not None and not self.startup_task.done() and self.startup_task is not asyncio.current_task()):
+            self.startup_task.cancel()
+        if (self.loaded.is_set()):
+            await self.scheduler.stop()
+        await super().close()
+        return
+
+
+    def __warm_up_persona(self, name:str) -> None:
+        """
+        Loads a persona and generates a token with its model (and draft model), so its first reply doesn't wait for
+        the model to load nor pay for the first, slowest, forward pass. Blocking, ran by the scheduler's workers.
+
+        Input:
+            - name: Name of the persona.
+        """
+        import torch
+
+        with self.model_cache.use(name) as persona:
+            input_ids = torch.tensor([[persona.tokenizer.bos_token_id, persona.tokenizer.sep_token_id]])
+            for model in (persona.model, persona.draft_model):
+                if (model is not None):
+                    with torch.no_grad():
+                        model.generate(input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=1, do_sample=False,
+                                       pad_token_id=persona.tokenizer.pad_token_id)
+        return
+
+
+    async def warm_up(self) -> list:
+        """
+        Loads the personas of warm_up_personas one at a time, on the generation workers. Stops at the first persona
+        that doesn't fit in what is left of the memory budget (see model_cache.ModelCache.estimate_size), as loading
+        it would unload personas loaded before.
+
+        Output:
+            - names: Personas warmed up.
+        """
+        start = time.perf_counter()
+        names = self.warm_up_personas if self.warm_up_personas is not None else sorted(self.personas)
+        warmed_up = []
+        for name in names:
+            if (name not in self.personas):
+                print(f"Can't warm up {name}, there is no persona with that name in {self.model_cache.folder}")
+                continue
+            if (self.model_cache.cached_bytes + self.model_cache.estimate_size(name) > self.model_cache.memory_budget):
+                break
+            num_evictions = self.model_cache.num_evictions
+            await asyncio.get_running_loop().run_in_executor(self.scheduler.executor, self.__warm_up_persona, name)
+            warmed_up.append(name)
+
+            # The estimate comes from the files on disk, the models may have turned out bigger.
+            if (self.model_cache.num_evictions > num_evictions):
+                break
+
+        self.startup_seconds["warm_up_seconds"] = time.perf_counter() - start
+        return warmed_up
+
+
+    def __report_startup(self, warmed_up:list) -> None:
+        """
+        Prints how long each phase of the startup took and logs it to the metrics file.
+
+        Input:
+            - warmed_up: Personas warmed up (see warm_up).
+        """
+        self.startup_seconds["total_seconds"] = time.perf_counter() - self.created_at
+        times = self.startup_seconds
+        print(f"Ready {times['total_seconds']:.1f}s after starting: connected after {times['connect_seconds']:.1f}s, "
+              f"imported torch and transformers in {times['import_seconds']:.1f}s (while connecting), "
+              f"warmed up {len(warmed_up)} personas in {times['warm_up_seconds']:.1f}s")
+        self.model_cache.metrics.log("startup", warmed_up=warmed_up, **times)
+        return
     
 
-    def __get_model_output(self, message_text:str) -> str:
+    def __parse_prompt(self, content:str) -> tuple:
         """
-        Function to get model output from an input string. 
+        Splits a message to the bot into the persona's name and the message text.
 
         Input:
-            - message_text : The text of the message received.
-        
+            - content: Content of the message received.
+
         Output:
-            - model_response : The output of the model.
-        """
-
-        # Use pre-processing function to ensure same preprocessing as the model was trained on.
-        msg_formatted = {"content" : message_text, "mentions" : [] }
-        preprocessed_message = process_msg_text(msg_formatted)
-
-        # Format input as the text before the separator token so the model only needs to predict the response
-        # NOTE: A ternary is used to add a period at the end of the prompt text. Empirically better performance
-        preprocessed_message = f"{BOS} " + preprocessed_message + '.' if preprocessed_message[-1] != '.' else "" +  f" {SEP} "
-
-        # Tokenize preprocessed message and get response. Model params are hard-coded for now.
-        inputs = self.tokenizer(preprocessed_message, return_tensors="pt").input_ids
-        outputs = self.model.generate(inputs, 
-                                    max_new_tokens=200, 
-                                    do_sample=True, 
-                                    top_p=0.97, 
-                                    top_k=150,
-                                    temperature=1.0
-                                    )
-        decoded_output = self.tokenizer.batch_decode(outputs, skip_special_tokens=False)[0]
+            - name: Name of the persona, or None if the message isn't to a persona.
+            - message_text: The rest of the message.
+        """
+        if (not content.startswith(self.model_prompt)):
+            return None, content
+
+        name, _, message_text = content[len(self.model_prompt) : ].partition(" ")
+        if (name not in self.personas):
+            # Pick up personas trained since the bot started.
+            if (time.monotonic() - self.personas_scanned_at < PERSONA_RESCAN_SECONDS):
+                return None, content
+            self.personas = set(self.model_cache.available())
+            self.personas_scanned_at = time.monotonic()
+            if (name not in self.personas):
+                return None, content
+        return name, message_text
+
+
+    def __get_model_outputs(self, persona:"model_cache.Persona", conversations:list) -> list:
+        """
+        Function to get model outputs for conversations (ending in the messages received). 
+
+        Models that can reuse their keys/values (see conversation.supports_kv_cache) only encode what was said
+        since their last reply in the channel, one conversation at a time. Other models (like GPT 1) re-encode
+        each conversation at every step: with a draft model they generate one conversation at a time with
+        speculative decoding (see speculative.py), which checks several tokens per re-encoding, otherwise all of
+        them are generated together in one batch.
+
+        Input:
+            - persona: Persona (tokenizer and model) to respond as.
+            - conversations : The conversations to reply to.
         
-        # We only want the model's response (after SEP token). Including prompt is redundant.
-        first_sep_id = decoded_output.find(f"{SEP}")
-        end_id = decoded_output.find(f"{EOS}")
-        model_response = decoded_output[first_sep_id + len(SEP): end_id].replace("<unk>", "'")
+        Output:
+            - reply_ids : The token ids of the model's reply in each conversation, without the stop token.
+        """
+        import torch
+        from conversation import generate_with_cache, supports_kv_cache
+        from inference import DEFAULT_GENERATION_KWARGS, stop_token_ids
+        from speculative import speculative_generate
+
+        # Generation of a response stops at the first [EOS] or [SEP] instead of always running max_new_tokens steps.
+        stop_ids = stop_token_ids(persona.tokenizer)
+        generation_kwargs = {**DEFAULT_GENERATION_KWARGS, **persona.generation_kwargs, 
+                             "pad_token_id" : persona.tokenizer.pad_token_id, "eos_token_id" : stop_ids}
+
+        # The prompt is the conversation followed by the separator token, so the model only needs to predict the response
+        sep_ids = [persona.tokenizer.sep_token_id]
+        if (supports_kv_cache(persona.model)):
+            outputs = [generate_with_cache(persona.model, conversation, sep_ids, generation_kwargs) for conversation in conversations]
+        elif (persona.draft_model is not None):
+            outputs = [speculative_generate(persona.model, persona.draft_model, conversation.context_ids() + sep_ids, 
+                                            num_draft_tokens=self.num_draft_tokens, **generation_kwargs) for conversation in conversations]
+        else:
+            # Prompts are padded on the left so every prompt ends right where generation starts.
+            prompts = [conversation.context_ids() + sep_ids for conversation in conversations]
+            length = max(len(x) for x in prompts)
+            input_ids = torch.tensor([[persona.tokenizer.pad_token_id] * (length - len(x)) + x for x in prompts])
+            attention_mask = torch.tensor([[0] * (length - len(x)) + [1] * len(x) for x in prompts])
+            with torch.no_grad():
+                outputs = persona.model.generate(input_ids, attention_mask=attention_mask, **generation_kwargs)[:, length : ].tolist()
+
+        # We only want the model's response (the new tokens). Including prompt is redundant.
+        # What follows the stop token is padding of responses that finished before the rest of the batch.
+        reply_ids = []
+        for output in outputs:
+            end_id = next((i for i, x in enumerate(output) if x in stop_ids), len(output))
+            reply_ids.append(output[ : end_id])
+
+        return reply_ids
 
-        return model_response
+
+    def __respond(self, name:str, requests:list) -> list:
+        """
+        Generates a persona's replies to a batch of messages. Blocking, ran by the scheduler's worker threads.
+
+        Each conversation is advanced once per batch: the scheduler never batches two messages from one channel
+        (see inference.InferenceScheduler), as the second reply has to follow the first.
+
+        Input:
+            - name: Name of the persona.
+            - requests: List of (channel_id, message_text) tuples, one per message received, from different channels.
+
+        Output:
+            - model_responses: The output of the model for each message.
+        """
+        from inference import format_turn
+
+        channel_ids = [channel_id for channel_id, _ in requests]
+        if (len(set(channel_ids)) != len(channel_ids)):
+            raise ValueError(f"A batch can only hold one message per channel, got channels {channel_ids}")
+
+        with self.model_cache.use(name) as persona:
+            # Use pre-processing function to ensure same preprocessing as the model was trained on.
+            conversations = []
+            for channel_id, message_text in requests:
+                conversation = self.conversations.get(channel_id, name, persona.tokenizer.bos_token_id)
+                conversation.add_turn(persona.tokenizer.encode(format_turn(message_text), add_special_tokens=False))
+                conversations.append(conversation)
+
+            # Tokenize preprocessed messages and get responses, with the persona's settings (see model_cache.Persona).
+            model_responses = []
+            for conversation, reply_ids in zip(conversations, self.__get_model_outputs(persona, conversations)):
+                conversation.add_turn(reply_ids)
+                model_responses.append(persona.tokenizer.decode(reply_ids, skip_special_tokens=False).replace("<unk>", "'"))
+
+            return model_responses
 
 
     async def on_ready(self) -> None:
@@ -77,6 +342,8 @@ class MimicBot(discord.Client):
         Output:
             - None (prints to console)
         """
+        # on_ready runs again after reconnecting, only the first connection is part of the startup.
+        self.startup_seconds.setdefault("connect_seconds", time.perf_counter() - self.created_at)
         print(f'Logged on as {self.user}!')
         return 
     
@@ -93,12 +360,24 @@ class MimicBot(discord.Client):
         Output:
             - None (sends message through discord library functionality)
         """
+        if (not message.content.startswith(self.model_prompt)):
+            return
 
-        if (message.content.startswith(self.model_prompt)):
-            # Remove the model prompt of the string.
-            message_text = message.content[len(self.model_prompt) : ]
+        # Messages sent while the bot is still loading are answered once it is done.
+        await self.loaded.wait()
+        from inference import QueueFullError
 
-            model_response = self.__get_model_output(message_text)
+        name, message_text = self.__parse_prompt(message.content)
+        if (name is not None):
+            try:
+                async with message.channel.typing():
+                    model_response = await self.scheduler.submit(message.channel.id, name, message.channel.id, message_text)
+            except QueueFullError:
+                await message.channel.send(f"@{message.author} I'm busy right now, try again in a bit.")
+                return
+            except asyncio.TimeoutError:
+                await message.channel.send(f"@{message.author} Sorry, that took too long.")
+                return
 
             await message.channel.send(f"@{message.author} {model_response}")
         
@@ -107,16 +386,24 @@ class MimicBot(discord.Client):
 def main():
     secrets = load_secrets()
 
-    # Set the username of the model to load.
-    username = ... 
+    # Set the prompt token (preceed message to bot with this sequence and a persona's name to get that model to read it)
+    model_prompt = "$"
 
-    # Set the prompt token (preceed message to bot with this sequence to get model to read it)
-    model_prompt = f"${username}"
+    # Most memory the loaded models may use, least recently used models are unloaded to stay under it.
+    memory_budget_mb = 2048
+
+    # How the models are run: "eager" (as saved), "int8" (quantized when loaded) or "torchscript" / "onnx"
+    # (exported ahead of time with `python backends.py export models/gpt/{username}/model`).
+    backend = "eager"
     
+    # Personas loaded right after connecting, e.g. ["matthew"] (None for as many as fit in memory_budget_mb).
+    warm_up_personas = None
+
     intents = discord.Intents.default()
     intents.message_content = True
 
-    client = MimicBot(intents=intents, username=username, model_prompt=model_prompt)
+    client = MimicBot(intents=intents, model_prompt=model_prompt, memory_budget_mb=memory_budget_mb, metrics_file="bot_metrics.jsonl",
+                      backend=backend, warm_up_personas=warm_up_personas)
     client.run(secrets["bot_token"])
 
 
@@ -0,0 +1,301 @@
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import time
+import torch
+
+from metrics import MetricsLogger
+from pre_process_text import process_msg_text
+from utils import BOS, SEP, EOS
+
+# Generation settings of every persona, unless overridden by its generation.json (see model_cache.Persona).
+DEFAULT_GENERATION_KWARGS = {
+    "max_new_tokens" : 200,
+    "do_sample" : True,
+    "top_p" : 0.97,
+    "top_k" : 150,
+    "temperature" : 1.0,
+}
+
+
+def format_turn(message_text:str) -> str:
+    """
+    Formats a message like a turn in the context of a training example.
+
+    Input:
+        - message_text: The text of the message received.
+
+    Output:
+        - turn: The preprocessed message.
+    """
+    # Use pre-processing function to ensure same preprocessing as the model was trained on.
+    preprocessed_message = process_msg_text({"content" : message_text, "mentions" : []})
+
+    # NOTE: A period is added at the end of the prompt text. Empirically better performance
+    if (not preprocessed_message.endswith('.')):
+        preprocessed_message += '.'
+    return preprocessed_message + " "
+
+
+def format_prompt(message_text:str) -> str:
+    """
+    Formats a message like the context of a training example, so the model only needs to predict the response.
+
+    Input:
+        - message_text: The text of the message received.
+
+    Output:
+        - prompt: "[BOS] {message} [SEP] "
+    """
+    return f"{BOS} " + format_turn(message_text) + f"{SEP} "
+
+
+def stop_token_ids(tokenizer:"AutoTokenizer") -> list:
+    """
+    Tokens that end a response: [EOS], which ends every training example, and [SEP], which only ever follows a context.
+
+    Input:
+        - tokenizer: Tokenizer made by utils.create_tokenizer.
+
+    Output:
+        - token_ids: Ids to pass to generate as eos_token_id.
+    """
+    return tokenizer.convert_tokens_to_ids([EOS, SEP])
+
+
+def next_token_probs(logits:"torch.Tensor", temperature:float=1.0, top_k:int=0, top_p:float=1.0) -> "torch.Tensor":
+    """
+    The distribution generate samples the next token from: temperature, then top-k, then top-p (nucleus) filtering,
+    in the same order as the transformers logits warpers.
+
+    Input:
+        - logits: Logits of the next token, shape (batch, vocab).
+        - temperature, top_k, top_p: Sampling settings (top_k=0 and top_p=1.0 disable filtering).
+
+    Output:
+        - probs: Probabilities of the next token, shape (batch, vocab).
+    """
+    logits = logits.float() / temperature
+    if (top_k and top_k < logits.shape[-1]):
+        kth_largest = torch.topk(logits, top_k, dim=-1).values[..., -1:]
+        logits = logits.masked_fill(logits < kth_largest, float("-inf"))
+    if (top_p < 1.0):
+        sorted_logits, sorted_indices = torch.sort(logits, dim=-1)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+
+        # Drop the least likely tokens whose total probability is at most 1 - top_p, always keeping the most likely.
+        remove = cumulative_probs <= (1 - top_p)
+        remove[..., -1] = False
+        logits = logits.masked_fill(remove.scatter(-1, sorted_indices, remove), float("-inf"))
+    return logits.softmax(dim=-1)
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a request is submitted while the scheduler (or the request's channel) already has the maximum
+    number of requests waiting.
+    """
+    pass
+
+
+class GenerationRequest:
+    """
+    A request waiting for (or being run by) a worker.
+    """
+
+    def __init__(self, channel_id:object, batch_key:object, args:tuple, future:"asyncio.Future") -> None:
+        self.channel_id = channel_id
+        self.batch_key = batch_key
+        self.args = args
+        self.future = future
+        self.submitted_at = time.perf_counter()
+        return
+
+
+class InferenceScheduler:
+    """
+    Runs blocking generation in a pool of worker threads so the discord event loop stays responsive.
+
+    Requests wait in one queue per channel and workers take them from the channels in turn, so a busy channel
+    can't starve the others. The number of waiting requests is bounded: once full, submit raises QueueFullError
+    right away instead of letting the backlog (and the reply latency) grow without limit. Requests that aren't
+    answered within timeout seconds are given up on.
+
+    Requests with the same batch key (e.g. the same persona) are generated together: once a worker takes a
+    request it waits until batch_window seconds after that request arrived and then also takes up to
+    max_batch_size - 1 other waiting requests with the same key. One batched call uses the CPU much better
+    than several small ones, at the cost of a few milliseconds of queueing. A batch holds at most one request per
+    channel: a channel's later requests (e.g. to a persona whose reply depends on its previous one, see
+    conversation.py) wait for the next batch.
+
+    Threads are used rather than processes because the models (see model_cache.py) are shared between workers;
+    torch releases the GIL while it computes.
+    """
+
+    def __init__(self, generate, num_workers:int=2, max_pending:int=32, max_pending_per_channel:int=4, timeout:float=60,
+                 max_batch_size:int=8, batch_window:float=0.02, metrics_file:str=None) -> None:
+        """
+        Constructor.
+
+        Input:
+            - generate: Blocking function run by the workers. Called with a batch key and a list with the arguments
+                        of each request passed to submit, it returns a list with the result of each request.
+            - num_workers: Number of batches generated at the same time.
+            - max_pending: Most requests waiting across all channels.
+            - max_pending_per_channel: Most requests waiting per channel.
+            - timeout: Seconds a request may take in total (waiting plus generating).
+            - max_batch_size: Most requests generated in one call.
+            - batch_window: Seconds a request waits for others to batch with (0 to only batch requests that are
+                            already waiting).
+            - metrics_file: Path of a .jsonl file to log the queueing and generation time of each batch to.
+        """
+        self.generate = generate
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.max_pending_per_channel = max_pending_per_channel
+        self.timeout = timeout
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.metrics = MetricsLogger(metrics_file)
+
+        # Maps channel ID to its deque of waiting requests, in the order the channels get their turn.
+        self.channels = OrderedDict()
+        self.num_pending = 0
+        self.workers = []
+        self.executor = None
+        self.not_empty = None
+        return
+
+
+    async def start(self) -> None:
+        """
+        Starts the workers on the running event loop.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="generate")
+        self.not_empty = asyncio.Condition()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+        return
+
+
+    async def stop(self) -> None:
+        """
+        Stops the workers, failing any requests still waiting.
+        """
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+        for requests in self.channels.values():
+            for request in requests:
+                if (not request.future.done()):
+                    request.future.cancel()
+        self.channels.clear()
+        self.num_pending = 0
+        self.executor.shutdown(wait=False)
+        return
+
+
+    def _next_request(self) -> GenerationRequest:
+        # Takes the oldest request of the channel whose turn it is, then sends that channel to the back of the line.
+        channel_id, requests = next(iter(self.channels.items()))
+        request = requests.popleft()
+        if (requests):
+            self.channels.move_to_end(channel_id)
+        else:
+            del self.channels[channel_id]
+        self.num_pending -= 1
+        return request
+
+
+    def _take_matching(self, batch_key:object, limit:int, skip_channel_id:object) -> list:
+        # Takes up to limit waiting requests with the given batch key, the oldest one of each channel (except
+        # skip_channel_id, already in the batch), going through the channels in turn order.
+        taken = []
+        for channel_id in list(self.channels.keys()):
+            if (len(taken) == limit):
+                break
+            if (channel_id == skip_channel_id):
+                continue
+            requests = self.channels[channel_id]
+            request = next((x for x in requests if x.batch_key == batch_key), None)
+            if (request is None):
+                continue
+            requests.remove(request)
+            if (not requests):
+                del self.channels[channel_id]
+            taken.append(request)
+        self.num_pending -= len(taken)
+        return taken
+
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self.not_empty:
+                await self.not_empty.wait_for(lambda: self.num_pending > 0)
+                first = self._next_request()
+
+            # Give requests arriving shortly after this one the chance to join its batch.
+            wait = first.submitted_at + self.batch_window - time.perf_counter()
+            if (wait > 0 and self.max_batch_size > 1):
+                await asyncio.sleep(wait)
+            async with self.not_empty:
+                batch = [first] + self._take_matching(first.batch_key, self.max_batch_size - 1, first.channel_id)
+
+            # Skip requests whose submitter already gave up.
+            batch = [x for x in batch if not x.future.done()]
+            if (not batch):
+                continue
+
+            started_at = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.generate, first.batch_key, [x.args for x in batch])
+            except Exception as e:
+                for request in batch:
+                    if (not request.future.done()):
+                        request.future.set_exception(e)
+            else:
+                for request, result in zip(batch, results):
+                    if (not request.future.done()):
+                        request.future.set_result(result)
+            finished_at = time.perf_counter()
+            self.metrics.log("generate", batch_key=str(first.batch_key), batch_size=len(batch),
+                             queue_seconds=max(started_at - x.submitted_at for x in batch),
+                             generate_seconds=finished_at - started_at, pending=self.num_pending)
+
+
+    async def submit(self, channel_id:object, batch_key:object, *args) -> object:
+        """
+        Queues a request and waits for its result.
+
+        Input:
+            - channel_id: Channel the request came from, used to take turns between channels.
+            - batch_key: Requests with equal batch keys may be generated together.
+            - args: Arguments of the request, passed on to generate.
+
+        Output:
+            - result: The request's result from generate.
+
+        Raises QueueFullError when too many requests are already waiting, and asyncio.TimeoutError when the
+        request isn't answered in time.
+        """
+        if (self.num_pending >= self.max_pending):
+            raise QueueFullError(f"{self.num_pending} requests are already waiting")
+        requests = self.channels.get(channel_id)
+        if (requests is not None and len(requests) >= self.max_pending_per_channel):
+            raise QueueFullError(f"{len(requests)} requests of this channel are already waiting")
+
+        future = asyncio.get_running_loop().create_future()
+        async with self.not_empty:
+            self.channels.setdefault(channel_id, deque()).append(GenerationRequest(channel_id, batch_key, args, future))
+            self.num_pending += 1
+            self.not_empty.notify()
+
+        # shield so a timeout marks the request as abandoned (the worker skips or discards it) instead of cancelling
+        # the future out from under the worker.
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise
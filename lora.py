@@ -0,0 +1,192 @@
+import os
+import torch
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+
+from utils import read_json, write_json
+
+# Names of the layers adapted by default: the attention's input and output projections and the MLP output.
+DEFAULT_TARGET_MODULES = ("c_attn", "c_proj")
+
+
+class LoRALayer(nn.Module):
+    """
+    Low-rank adapter around a frozen linear layer (LoRA: https://arxiv.org/abs/2106.09685).
+
+    Computes base(x) + (x @ A @ B) * alpha / rank. B starts at zero, so a fresh adapter doesn't change the model.
+    Works with both nn.Linear and the transformers Conv1D used by GPT (whose weight is stored transposed).
+    """
+
+    def __init__(self, base:nn.Module, rank:int=8, alpha:float=16, dropout:float=0.0) -> None:
+        """
+        Constructor.
+
+        Input:
+            - base: The layer to adapt (nn.Linear or Conv1D).
+            - rank: Rank of the update.
+            - alpha: Scaling of the update (the update is multiplied by alpha / rank).
+            - dropout: Dropout applied to the input of the update.
+        """
+        super().__init__()
+        self.base = base
+        if (isinstance(base, Conv1D)):
+            in_features, out_features = base.weight.shape
+        else:
+            in_features, out_features = base.in_features, base.out_features
+
+        self.lora_A = nn.Parameter(torch.empty(in_features, rank))
+        self.lora_B = nn.Parameter(torch.zeros(rank, out_features))
+        nn.init.kaiming_uniform_(self.lora_A.T, a=5 ** 0.5)
+        self.scaling = alpha / rank
+        self.dropout = nn.Dropout(dropout)
+        return
+
+
+    def forward(self, x:"torch.Tensor") -> "torch.Tensor":
+        return self.base(x) + (self.dropout(x) @ self.lora_A @ self.lora_B) * self.scaling
+
+
+def add_lora(model:nn.Module, rank:int=8, alpha:float=16, dropout:float=0.0, target_modules:tuple=DEFAULT_TARGET_MODULES,
+             base_vocab_size:int=None) -> nn.Module:
+    """
+    Freezes a model and adds LoRA adapters to its target layers.
+
+    Only the adapters, and the rows of the token embedding at index base_vocab_size and up (the custom tokens
+    added by utils.create_tokenizer, which the pretrained model knows nothing about), are left trainable.
+
+    Input:
+        - model: The model (modified in place).
+        - rank, alpha, dropout: See LoRALayer.
+        - target_modules: Attribute names of the layers to adapt (e.g. "c_attn" matches every block's attn.c_attn).
+        - base_vocab_size: Vocabulary size of the pretrained model before resize_token_embeddings (None to freeze
+                           the whole embedding).
+
+    Output:
+        - model: The same model.
+    """
+    for param in model.parameters():
+        param.requires_grad = False
+
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if (name in target_modules and isinstance(child, (nn.Linear, Conv1D))):
+                setattr(parent, name, LoRALayer(child, rank, alpha, dropout))
+
+    embeddings = model.get_input_embeddings()
+    if (base_vocab_size is not None and base_vocab_size < embeddings.weight.shape[0]):
+        # The embedding matrix can only be trained as a whole, so zero the gradient of the pretrained rows.
+        embeddings.weight.requires_grad = True
+        embeddings.weight.register_hook(lambda grad: torch.cat([torch.zeros_like(grad[:base_vocab_size]), grad[base_vocab_size:]]))
+
+    model.lora_config = {"rank" : rank, "alpha" : alpha, "dropout" : dropout, "target_modules" : list(target_modules),
+                         "base_vocab_size" : base_vocab_size}
+    return model
+
+
+def lora_parameter_groups(model:nn.Module, weight_decay:float=0.01) -> list:
+    """
+    Parameter groups for the optimizer when training LoRA adapters.
+
+    The embedding is excluded from weight decay: AdamW decays every parameter with a gradient, which would
+    otherwise slowly shrink the frozen pretrained rows.
+
+    Input:
+        - model: Model with adapters (see add_lora).
+        - weight_decay: Weight decay of the adapters.
+
+    Output:
+        - param_groups: Parameter groups to pass to the optimizer.
+    """
+    embedding_weight = model.get_input_embeddings().weight
+    adapter_params = [param for param in model.parameters() if param.requires_grad and param is not embedding_weight]
+    param_groups = [{"params" : adapter_params, "weight_decay" : weight_decay}]
+    if (embedding_weight.requires_grad):
+        param_groups.append({"params" : [embedding_weight], "weight_decay" : 0.0})
+    return param_groups
+
+
+def adapter_state(model:nn.Module) -> dict:
+    """
+    The weights that make up an adapter: the LoRA matrices and the custom token embedding rows.
+
+    Input:
+        - model: Model with adapters (see add_lora).
+
+    Output:
+        - state: Dictionary of tensors.
+    """
+    state = {name : param.detach().clone() for name, param in model.named_parameters() if "lora_" in name}
+    base_vocab_size = model.lora_config["base_vocab_size"]
+    if (base_vocab_size is not None):
+        state["new_token_embeddings"] = model.get_input_embeddings().weight[base_vocab_size:].detach().clone()
+    return state
+
+
+def save_adapter(model:nn.Module, adapter_dir:str, base_model_string:str) -> None:
+    """
+    Saves only the adapter of a model (a few MB instead of a full model copy).
+
+    Input:
+        - model: Model with adapters (see add_lora).
+        - adapter_dir: Directory to write adapter.pt and adapter_config.json to.
+        - base_model_string: Name or path of the pretrained base model the adapter was trained on.
+    """
+    os.makedirs(adapter_dir, exist_ok=True)
+    torch.save(adapter_state(model), f"{adapter_dir}/adapter.pt")
+    config = dict(model.lora_config, base_model=base_model_string, vocab_size=model.get_input_embeddings().weight.shape[0])
+    write_json(config, f"{adapter_dir}/adapter_config.json")
+    return
+
+
+def load_adapter_state(adapter_dir:str) -> dict:
+    """
+    Loads a saved adapter's weights.
+
+    Input:
+        - adapter_dir: Directory the adapter was saved to.
+
+    Output:
+        - state: Dictionary of tensors (pass to apply_adapter).
+    """
+    return torch.load(f"{adapter_dir}/adapter.pt", map_location="cpu")
+
+
+def apply_adapter(model:nn.Module, state:dict) -> None:
+    """
+    Swaps an adapter into a model in place. Only copies a few MB, so switching users takes milliseconds.
+
+    Input:
+        - model: Model with adapters of the same configuration (see add_lora / load_model_with_adapter).
+        - state: Adapter weights (see load_adapter_state).
+    """
+    params = dict(model.named_parameters())
+    with torch.no_grad():
+        for name, value in state.items():
+            if (name == "new_token_embeddings"):
+                model.get_input_embeddings().weight[-len(value):].copy_(value)
+            else:
+                params[name].copy_(value)
+    return
+
+
+def load_model_with_adapter(adapter_dir:str) -> nn.Module:
+    """
+    Loads an adapter's base model, adds adapters and swaps the saved adapter in.
+
+    Further adapters trained on the same base (and tokenizer) can be swapped into the returned model with apply_adapter.
+
+    Input:
+        - adapter_dir: Directory the adapter was saved to.
+
+    Output:
+        - model: The model, in eval mode.
+    """
+    from transformers import AutoModelForCausalLM
+
+    config = read_json(f"{adapter_dir}/adapter_config.json")
+    model = AutoModelForCausalLM.from_pretrained(config["base_model"])
+    model.resize_token_embeddings(config["vocab_size"])
+    add_lora(model, config["rank"], config["alpha"], 0.0, tuple(config["target_modules"]), config["base_vocab_size"])
+    apply_adapter(model, load_adapter_state(adapter_dir))
+    model.eval()
+    return model
@@ -0,0 +1,171 @@
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process so far.
+
+    Output:
+        - peak_rss: Peak RSS in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+    if (sys.platform == "darwin"):
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def current_rss_mb() -> float:
+    """
+    Current resident set size of this process (falls back to the peak where /proc isn't available).
+
+    Output:
+        - rss: RSS in megabytes.
+    """
+    try:
+        with open("/proc/self/statm", 'r') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return peak_rss_mb()
+
+
+class MetricsLogger:
+    """
+    Appends metric records to a .jsonl file, one JSON object per line.
+
+    Every record gets an "event" name and the wall clock "time" it was logged at. Logging to None is a no-op,
+    so callers don't need to check whether metrics are enabled.
+    """
+
+    def __init__(self, filename:str=None) -> None:
+        """
+        Constructor.
+
+        Input:
+            - filename: Path of the .jsonl metrics file (appended to), or None to disable logging.
+        """
+        self.filename = filename
+        self.fp = open(filename, 'a') if filename is not None else None
+        return
+
+
+    def log(self, event:str, **values) -> None:
+        """
+        Writes a record.
+
+        Input:
+            - event: Name of the event (e.g. "step", "epoch").
+            - values: Values of the record.
+        """
+        if (self.fp is None):
+            return
+        self.fp.write(json.dumps({"event" : event, "time" : time.time(), **values}) + "\n")
+        self.fp.flush()
+        return
+
+
+    def close(self) -> None:
+        if (self.fp is not None):
+            self.fp.close()
+            self.fp = None
+        return
+
+
+    def __enter__(self) -> "MetricsLogger":
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+        return
+
+
+class PhaseTimer:
+    """
+    Measures consecutive phases of a step (e.g. data, forward, backward, optimizer) with one clock.
+
+    Each call to lap() records the time since the previous lap under the given phase name.
+    """
+
+    def __init__(self, synchronize=None) -> None:
+        """
+        Constructor.
+
+        Input:
+            - synchronize: Function called before reading the clock (e.g. torch.cuda.synchronize), so
+                           asynchronous GPU work is counted in the phase that launched it.
+        """
+        self.synchronize = synchronize
+        self.phases = {}
+        self.last = time.perf_counter()
+        return
+
+
+    def lap(self, phase:str) -> float:
+        if (self.synchronize is not None):
+            self.synchronize()
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+        self.last = now
+        return elapsed
+
+
+    def reset(self) -> dict:
+        """
+        Starts a new step.
+
+        Output:
+            - phases: Seconds spent in each phase of the step that just finished.
+        """
+        phases = self.phases
+        self.phases = {}
+        return phases
+
+
+def summarize_metrics(filename:str, event:str="step") -> dict:
+    """
+    Summarizes the records of one event in a metrics file, for comparing runs.
+
+    Input:
+        - filename: Path of the .jsonl metrics file.
+        - event: Which records to summarize.
+
+    Output:
+        - summary: Dictionary mapping each numeric field to its median (and "peak_rss_mb" to its maximum).
+    """
+    with open(filename, 'r') as fp:
+        records = [x for x in (json.loads(line) for line in fp if line.strip()) if x["event"] == event]
+
+    summary = {"count" : len(records)}
+    fields = sorted({key for record in records for key, value in record.items() if isinstance(value, (int, float)) and not isinstance(value, bool)})
+    for field in fields:
+        if (field in ["time", "epoch", "step"]):
+            continue
+        values = [record[field] for record in records if field in record]
+        summary[field] = max(values) if field == "peak_rss_mb" else float(np.median(values))
+
+    return summary
+
+
+def main():
+    # Usage: python metrics.py baseline_metrics.jsonl [new_metrics.jsonl]
+    baseline = summarize_metrics(sys.argv[1])
+    other = summarize_metrics(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    for field, value in baseline.items():
+        if (other is None or field not in other):
+            print(f"{field:>20}: {value:12.4f}")
+        else:
+            change = (other[field] - value) / value * 100 if value else float("nan")
+            print(f"{field:>20}: {value:12.4f} -> {other[field]:12.4f} ({change:+6.1f}%)")
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,382 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import threading
+import time
+import torch
+from huggingface_hub import try_to_load_from_cache
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from backends import load_model, quantize_int8, EXPORTED_BACKENDS
+from lora import apply_adapter, add_lora, load_adapter_state
+from metrics import MetricsLogger
+from utils import read_json
+
+MODEL_FOLDER = "models/gpt"
+
+
+def model_size_bytes(model:"torch.nn.Module") -> int:
+    """
+    Memory held by a model's parameters and buffers (tied weights are counted once), including the packed
+    weights of int8 quantized layers (see backends.quantize_int8).
+
+    Input:
+        - model: The model.
+
+    Output:
+        - size: Size in bytes.
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    for module in model.modules():
+        if (isinstance(module, torch.ao.nn.quantized.dynamic.Linear)):
+            tensors.extend(x for x in (module.weight(), module.bias()) if x is not None)
+    return sum(x.numel() * x.element_size() for x in tensors)
+
+
+def folder_size_bytes(folder:str) -> int:
+    """
+    Total size of the files in a folder, used to estimate a model's size before loading it.
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+def pretrained_size_bytes(model_string:str) -> int:
+    """
+    Size of a pretrained model's weights (e.g. the base model of LoRA personas), used to estimate its size before
+    loading it.
+
+    Input:
+        - model_string: Folder of the model, or its name on the Hugging Face hub.
+
+    Output:
+        - size: Size in bytes, 0 if the model is neither a folder nor in the Hugging Face cache.
+    """
+    if (os.path.isdir(model_string)):
+        return folder_size_bytes(model_string)
+    for filename in ("model.safetensors", "pytorch_model.bin"):
+        path = try_to_load_from_cache(model_string, filename)
+        if (isinstance(path, str)):
+            return os.path.getsize(path)
+    return 0
+
+
+class Persona:
+    """
+    Everything needed to generate as one user: their tokenizer and model.
+
+    Personas trained with LoRA (see lora.py) share their base model with other personas; their adapter
+    is swapped into it by ModelCache.use, so model is only theirs while it is in use.
+
+    generation_kwargs holds the persona's own generation settings (e.g. a max_new_tokens length cap), read from
+    an optional generation.json in the persona's folder.
+
+    draft_model is the persona's small draft model for speculative decoding (see speculative.py), if one was
+    trained (see fine_tune.create_draft_model).
+    """
+
+    def __init__(self, name:str, tokenizer:"AutoTokenizer", model:"torch.nn.Module"=None, adapter_state:dict=None,
+                 adapter_dir:str=None, lock:"threading.Lock"=None, generation_kwargs:dict=None,
+                 draft_model:"torch.nn.Module"=None) -> None:
+        self.name = name
+        self.tokenizer = tokenizer
+        self.model = model
+        self.adapter_state = adapter_state
+        self.adapter_dir = adapter_dir
+        self.generation_kwargs = generation_kwargs if generation_kwargs is not None else {}
+        self.draft_model = draft_model
+
+        # Held while the model generates, so only one thread at a time uses (or swaps adapters into) it.
+        self.lock = lock if lock is not None else threading.Lock()
+        return
+
+
+class SharedBase:
+    """
+    Base model shared by the LoRA personas trained on it, and which of their adapters is currently applied.
+    """
+
+    def __init__(self, model:"torch.nn.Module") -> None:
+        self.model = model
+        self.active_adapter = None
+        self.lock = threading.Lock()
+        return
+
+
+class ModelCache:
+    """
+    Loads personas on demand and keeps the most recently used ones in memory, within a memory budget.
+
+    A persona is a folder models/gpt/{name}/ with a tokenizer and either a full model or a LoRA adapter,
+    as written by fine_tune.py. Full models, adapters and the base models adapters are applied to are all
+    entries of one LRU cache; when loading an entry would go over the budget, the least recently used
+    entries are evicted first. Loads and evictions are logged to metrics_file (see metrics.py).
+
+    The cache can be used from several threads at once (see use). Models load outside of the cache's lock, so
+    a slow load only holds up the threads waiting for that same model, and entries in use are never evicted.
+    """
+
+    def __init__(self, folder:str=MODEL_FOLDER, memory_budget_mb:float=2048, metrics_file:str=None, backend:str="eager") -> None:
+        """
+        Constructor.
+
+        Input:
+            - folder: Folder containing one folder per persona.
+            - memory_budget_mb: How much memory the cached models may use in total (in MB). A single model
+                                larger than the budget is still loaded, with everything else evicted.
+            - metrics_file: Path of a .jsonl file to log loads and evictions to (None to disable).
+            - backend: How models are run, see backends.BACKENDS. Personas whose model hasn't been exported for
+                       an exported backend (and LoRA personas, which can't be) fall back to "eager".
+        """
+        self.folder = folder
+        self.backend = backend
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.metrics = MetricsLogger(metrics_file)
+
+        # Maps ("persona", name) or ("base", base model and adapter layout) to 
+        # [entry, size in bytes, time of last use, number of threads using it].
+        self.entries = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+
+        # One lock per key, held while that key loads so it is only loaded once (never removed, there is one per model).
+        self.load_locks = {}
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        return
+
+
+    def available(self) -> list:
+        """
+        Names of the personas that have been trained.
+
+        Output:
+            - names: Sorted list of persona names.
+        """
+        if (not os.path.isdir(self.folder)):
+            return []
+        names = []
+        for name in os.listdir(self.folder):
+            persona_dir = f"{self.folder}/{name}"
+            if (os.path.isdir(f"{persona_dir}/tokenizer") and (os.path.isdir(f"{persona_dir}/model") or os.path.isdir(f"{persona_dir}/adapter"))):
+                names.append(name)
+        return sorted(names)
+
+
+    def _evict(self, needed_bytes:int) -> None:
+        # Evicts least recently used entries until needed_bytes more fit in the budget. Call with self.lock held.
+        for key in list(self.entries.keys()):
+            if (self.cached_bytes + needed_bytes <= self.memory_budget):
+                break
+            if (self.entries[key][3] > 0):
+                continue
+            _, size, last_used, _ = self.entries.pop(key)
+            self.cached_bytes -= size
+            self.num_evictions += 1
+            self.metrics.log("model_evict", kind=key[0], name=key[1], size_mb=size / (1024 * 1024),
+                             idle_seconds=time.monotonic() - last_used, cached_mb=self.cached_bytes / (1024 * 1024))
+        return
+
+
+    def _hit(self, key:tuple) -> list:
+        # Marks a cached entry as recently used and in use. Call with self.lock held.
+        record = self.entries[key]
+        self.num_hits += 1
+        self.entries.move_to_end(key)
+        record[2] = time.monotonic()
+        record[3] += 1
+        return record
+
+
+    def _acquire(self, key:tuple, estimated_bytes:int, load) -> list:
+        # Returns an entry's record, marked as in use (see _release), loading it with load() on a miss.
+        with self.lock:
+            if (key in self.entries):
+                return self._hit(key)
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                # Another thread may have loaded it while this one waited.
+                if (key in self.entries):
+                    return self._hit(key)
+                self.num_misses += 1
+                self._evict(estimated_bytes)
+
+            start = time.perf_counter()
+            entry, size = load()
+            seconds = time.perf_counter() - start
+
+            with self.lock:
+                # The estimate comes from the files on disk, make room for what was actually loaded.
+                self._evict(size)
+                record = [entry, size, time.monotonic(), 1]
+                self.entries[key] = record
+                self.cached_bytes += size
+                self.metrics.log("model_load", kind=key[0], name=key[1], seconds=seconds, size_mb=size / (1024 * 1024),
+                                 cached_mb=self.cached_bytes / (1024 * 1024))
+        return record
+
+
+    def _release(self, *records:list) -> None:
+        # Marks entries returned by _acquire as no longer in use, so they can be evicted again.
+        with self.lock:
+            for record in records:
+                record[3] -= 1
+        return
+
+
+    def _load_base(self, adapter_config:dict) -> tuple:
+        model = AutoModelForCausalLM.from_pretrained(adapter_config["base_model"])
+        model.resize_token_embeddings(adapter_config["vocab_size"])
+        add_lora(model, adapter_config["rank"], adapter_config["alpha"], 0.0, tuple(adapter_config["target_modules"]),
+                 adapter_config["base_vocab_size"])
+        model.eval()
+        if (self.backend == "int8"):
+            model = quantize_int8(model)
+        return SharedBase(model), model_size_bytes(model)
+
+
+    def _load_persona(self, name:str) -> tuple:
+        persona_dir = f"{self.folder}/{name}"
+        tokenizer = AutoTokenizer.from_pretrained(f"{persona_dir}/tokenizer")
+        generation_kwargs = read_json(f"{persona_dir}/generation.json") if os.path.exists(f"{persona_dir}/generation.json") else {}
+
+        # Draft models are small, they are kept with the persona (quantized too with int8, never exported).
+        draft_model = None
+        draft_size = 0
+        if (os.path.isdir(f"{persona_dir}/draft")):
+            draft_model = load_model(f"{persona_dir}/draft", "int8" if self.backend == "int8" else "eager")
+            draft_size = model_size_bytes(draft_model)
+
+        if (os.path.isdir(f"{persona_dir}/adapter")):
+            adapter_state = load_adapter_state(f"{persona_dir}/adapter")
+            size = sum(x.numel() * x.element_size() for x in adapter_state.values())
+            return Persona(name, tokenizer, adapter_state=adapter_state, adapter_dir=f"{persona_dir}/adapter",
+                           generation_kwargs=generation_kwargs, draft_model=draft_model), size + draft_size
+
+        backend = self.backend
+        if (backend in EXPORTED_BACKENDS and not os.path.isdir(f"{persona_dir}/model_{backend}")):
+            print(f"{persona_dir}/model has not been exported to {backend} (see backends.py), using eager instead")
+            backend = "eager"
+        model = load_model(f"{persona_dir}/model", backend)
+        if (backend in EXPORTED_BACKENDS):
+            size = folder_size_bytes(f"{persona_dir}/model_{backend}")
+        else:
+            size = model_size_bytes(model)
+        return Persona(name, tokenizer, model=model, generation_kwargs=generation_kwargs, draft_model=draft_model), size + draft_size
+
+
+    def _persona_files_bytes(self, name:str) -> int:
+        # Size of a persona's model files on disk, the estimate of its size before loading it.
+        persona_dir = f"{self.folder}/{name}"
+        return sum(folder_size_bytes(f"{persona_dir}/{x}") for x in ("model", "draft") if os.path.isdir(f"{persona_dir}/{x}"))
+
+
+    def _base_key(self, adapter_config:dict) -> tuple:
+        # Adapter personas run on a shared base model, identified by the base model and adapter layout.
+        return ("base", f"{adapter_config['base_model']}:{adapter_config['rank']}:{','.join(adapter_config['target_modules'])}")
+
+
+    def _acquire_persona(self, name:str) -> tuple:
+        # Acquires a persona's record and, for adapter personas, the record of the base model it runs on (None otherwise).
+        persona_record = self._acquire(("persona", name), self._persona_files_bytes(name), lambda: self._load_persona(name))
+        persona = persona_record[0]
+        if (persona.adapter_state is None):
+            return persona_record, None
+
+        try:
+            adapter_config = read_json(f"{persona.adapter_dir}/adapter_config.json")
+            base_record = self._acquire(self._base_key(adapter_config), 0, lambda: self._load_base(adapter_config))
+        except BaseException:
+            self._release(persona_record)
+            raise
+        return persona_record, base_record
+
+
+    def estimate_size(self, name:str) -> int:
+        """
+        Memory that using a persona would add to the cache, estimated from the size of its files: its model (0 if it
+        is loaded already) and, for an adapter persona, the base model if that isn't loaded either.
+
+        Input:
+            - name: Name of the persona (see available).
+
+        Output:
+            - size: Estimated size in bytes.
+        """
+        adapter_config_file = f"{self.folder}/{name}/adapter/adapter_config.json"
+        adapter_config = read_json(adapter_config_file) if os.path.exists(adapter_config_file) else None
+        with self.lock:
+            size = self._persona_files_bytes(name) if ("persona", name) not in self.entries else 0
+            if (adapter_config is not None and self._base_key(adapter_config) not in self.entries):
+                size += pretrained_size_bytes(adapter_config["base_model"])
+        return size
+
+
+    @contextmanager
+    def use(self, name:str):
+        """
+        Gets a persona, loading it if it isn't cached, and holds its model for the duration of the with block.
+
+        Safe to call from several threads: threads using the same model (or the same shared base model) take
+        turns, threads using different models run at the same time.
+
+        Input:
+            - name: Name of the persona (see available).
+
+        Output:
+            - persona: The persona, with its model ready to generate.
+        """
+        persona_record, base_record = self._acquire_persona(name)
+        persona = persona_record[0]
+        try:
+            if (base_record is None):
+                with persona.lock:
+                    yield persona
+                return
+
+            base = base_record[0]
+            with base.lock:
+                if (base.active_adapter != name):
+                    apply_adapter(base.model, persona.adapter_state)
+                    base.active_adapter = name
+
+                # The cached persona doesn't keep a reference to the base model, so evicting the base frees it.
+                yield Persona(name, persona.tokenizer, base.model, persona.adapter_state, persona.adapter_dir, base.lock,
+                              persona.generation_kwargs, persona.draft_model)
+        finally:
+            self._release(*[x for x in (persona_record, base_record) if x is not None])
+        return
+
+
+    def get(self, name:str) -> Persona:
+        """
+        Gets a persona, loading it if it isn't cached. Only for single threaded use, see use otherwise.
+
+        Input:
+            - name: Name of the persona (see available).
+
+        Output:
+            - persona: The persona, with its model ready to generate (until the next call to get).
+        """
+        with self.use(name) as persona:
+            return persona
+
+
+    def stats(self) -> dict:
+        """
+        Cache statistics.
+
+        Output:
+            - stats: Dictionary with the cached entries, memory use, hits, misses and evictions.
+        """
+        return {
+            "cached" : [name for _, name in self.entries.keys()],
+            "cached_mb" : self.cached_bytes / (1024 * 1024),
+            "budget_mb" : self.memory_budget / (1024 * 1024),
+            "hits" : self.num_hits,
+            "misses" : self.num_misses,
+            "evictions" : self.num_evictions,
+        }
@@ -1,57 +1,189 @@
-from utils import read_json, load_secrets, BOS, SEP, EOS, IMG_TOKEN, GIF_TOKEN, LINK_TOKEN
-from datetime import timedelta
-from dateutil import parser
+from utils import read_columnar_store, message_columns_path, read_json, write_json_atomic, load_secrets, create_tokenizer, MAX_SEQUENCE_LENGTH, snowflake_to_ms, ColumnarMessages, BOS, SEP, EOS, IMG_TOKEN, GIF_TOKEN, LINK_TOKEN
+from collections import deque
+import numpy as np
+import multiprocessing
+import os
 import re
 import json
+import shutil
 
 FOLDER = "messages"
-emote_re = re.compile("(?=:).+(?=:.*\>)")
 
-def break_into_conversations(full_json : dict, time_delta_threshold:int=10) -> list:
+# Message types that are replies, and so always continue a conversation.
+REPLY_MESSAGE_TYPES = [19]
+mention_re = re.compile("<@([^<>]*)>")
+
+# Tokenizer used by the worker processes of main() to build context windows (set by _init_worker).
+_worker_tokenizer = None
+
+# [BOS], [SEP] and [EOS] added around each context + response pair.
+NUM_FORMAT_TOKENS = 3
+
+# Tokens that are never lower cased.
+SPECIAL_TOKENS = frozenset([GIF_TOKEN, IMG_TOKEN, LINK_TOKEN])
+
+def conversation_ranges(message_ids, message_types, time_delta_threshold:int=10) -> "np.ndarray":
+    """
+    Finds conversation boundaries in one vectorized pass.
+
+    Message times come straight from the snowflake ids, so no timestamp strings are parsed.
+    A new conversation starts at a message that is not a reply and comes more than
+    time_delta_threshold minutes after the previous message.
+
+    Input:
+        - message_ids: Message ids (ints or strings), newest first (the order of the message stores).
+        - message_types: Message types, in the same order.
+        - time_delta_threshold: A threshold for determining how much time can occur between messages 
+                                in the same conversation (in minutes).
+
+    Output:
+        - ranges: Array of shape (num_convos, 2) of [start, stop) positions in chronological order,
+                  where position p is the message at index len(message_ids) - 1 - p.
+    """
+    # Message stores are sorted in reverse order
+    ids = np.asarray(message_ids, dtype=np.uint64)[::-1]
+    types = np.asarray(message_types)[::-1]
+    if (len(ids) == 0):
+        return np.zeros((0, 2), dtype=np.int64)
+
+    gaps = np.diff(snowflake_to_ms(ids))
+
+    # https://discord.com/developers/docs/resources/channel#message-object-message-types
+    is_a_response = np.isin(types[1:], REPLY_MESSAGE_TYPES)
+
+    # New convo conditions: not a reply and at least specified num mins after last message
+    starts = np.flatnonzero((gaps > time_delta_threshold * 60 * 1000) & ~is_a_response) + 1
+    starts = np.concatenate([[0], starts])
+    stops = np.concatenate([starts[1:], [len(ids)]])
+    
+    return np.stack([starts, stops], axis=1)
+
+
+def message_id_columns(full_json) -> tuple:
+    """
+    Gets the id and type columns used by conversation_ranges.
+
+    Input:
+        - full_json: A ColumnarMessages store, or a list of messages newest first.
+
+    Output:
+        - (message_ids, message_types): Arrays of message ids and types.
+    """
+    if (isinstance(full_json, ColumnarMessages)):
+        return full_json.columns["id"], full_json.columns["type"]
+    
+    message_ids = np.fromiter((int(message["id"]) for message in full_json), dtype=np.uint64, count=len(full_json))
+    message_types = np.fromiter((message["type"] for message in full_json), dtype=np.int64, count=len(full_json))
+    return message_ids, message_types
+
+
+def conversation_messages(full_json, start:int, stop:int) -> list:
+    """
+    Materializes one conversation from a range returned by conversation_ranges.
+
+    Input:
+        - full_json: A ColumnarMessages store, or a list of messages newest first.
+        - start, stop: Chronological positions of the conversation.
+
+    Output:
+        - convo: List of messages in the conversation (ordered by time - index 0 is first message)
+    """
+    last_idx = len(full_json) - 1
+    return [full_json[last_idx - position] for position in range(start, stop)]
+
+
+def break_into_conversations(full_json, time_delta_threshold:int=10) -> list:
     """
     Breaks messages into conversations. 
 
-    Takes all messages received and chunks them into conversations. 
+    Takes all messages received and chunks them into conversations. Prefer conversation_ranges 
+    directly when the conversations don't all need to be in memory at once.
 
     Input:
-        - full_json: The full json of all scraped messages. Output of downloader.py
+        - full_json: All scraped messages (a ColumnarMessages store or a list of messages, newest first). 
+                     Output of downloader.py
         - time_delta_threshold: A threshold for determining how much time can occur between messages 
                                 in the same conversation (in minutes).
 
     Output:
-        - convos: A list of convos (each a lists of strings), representing messages 
+        - convos: A list of convos (each a lists of messages), representing messages 
                     in the conversation (ordered by time - index 0 is first message)
     """
-    convos = []
-    current_convo = None 
-    prev_message_time = None 
+    message_ids, message_types = message_id_columns(full_json)
+    ranges = conversation_ranges(message_ids, message_types, time_delta_threshold)
 
-    # Full JSON is sorted in reverse order
-    for mssg_idx in range(len(full_json) - 1, -1, -1):
-        message = full_json[mssg_idx]
-        
-        # https://www.geeksforgeeks.org/create-python-datetime-from-string/
-        curr_msg_timestamp = parser.parse(message["timestamp"])
+    return [conversation_messages(full_json, start, stop) for start, stop in ranges]
 
-        # https://discord.com/developers/docs/resources/channel#message-object-message-types
-        is_a_response = message["type"] in [19]
-        
-        # First Message
-        if (current_convo is None ):
-            current_convo = [message]
-        else:
-            is_awhile_after_last = (curr_msg_timestamp - prev_message_time) > timedelta(minutes=time_delta_threshold)
 
-            # New convo conditions: not a reply and at least specified num mins after last message
-            if (not is_a_response and is_awhile_after_last):
-                convos.append(current_convo)
-                current_convo = [message]
-            else:
-                current_convo.append(message)
+def replace_mentions(content:str, mentions:list) -> str:
+    """
+    Replaces user mentions (<@id>) with @username in a single regex pass.
+
+    Gives exactly the same result as replacing each mention in turn with str.replace. The rare
+    inputs where the order of replacements could matter fall back to doing exactly that.
+
+    Input:
+        - content: Message text.
+        - mentions: Mentioned users (dictionaries with "id" and "username").
+    
+    Output:
+        - content: Message text with mentions replaced.
+    """
+    if (len(mentions) == 0 or "<@" not in content):
+        return content
+
+    # First occurrence wins, like the first str.replace would.
+    id_to_username = {}
+    for mention in mentions:
+        id_to_username.setdefault(f"{mention['id']}", mention['username'])
+
+    def replace(match:"re.Match") -> str:
+        if (match.group(1) in id_to_username):
+            return "@" + id_to_username[match.group(1)]
+        return match.group(0)
+
+    replaced = mention_re.sub(replace, content)
+
+    # Replacing one mention can only create or break another if brackets are involved: a "<" left right before
+    # a replacement, or brackets inside ids/usernames. Replay the replacements one by one in those cases.
+    has_brackets = any(("<" in x or ">" in x) for item in id_to_username.items() for x in item)
+    if (has_brackets or "<@" in replaced):
+        for mention in mentions:
+            content = content.replace(f"<@{mention['id']}>", "@" + mention['username'])
+        return content
+
+    return replaced
+
 
-        prev_message_time = curr_msg_timestamp
+def process_msg_token(token:str) -> str:
+    """
+    Pre-processes a single whitespace separated token of a message.
 
-    return convos
+    Replaces links with the link token, custom emotes (e.g., <:KEKW:1234>) with the format expected (:KEKW:)
+    and lower cases everything else, leaving the special tokens as is.
+
+    Input:
+        - token: A single token of the message.
+    
+    Output:
+        - processed_token: The processed token.
+    """
+    if (token.startswith("https:")):
+        return LINK_TOKEN
+
+    # Emotes look like <:name:id>: keep everything from the first ':' up to and including the last ':' that comes
+    # before the last '>'.
+    first_colon = token.find(":")
+    if (first_colon != -1):
+        last_close = token.rfind(">")
+        if (last_close > first_colon):
+            last_colon = token.rfind(":", first_colon + 1, last_close)
+            if (last_colon != -1):
+                return token[first_colon : last_colon] + ":"
+
+    if (token in SPECIAL_TOKENS):
+        return token
+    return token.lower()
 
 
 def process_msg_text(message:dict) -> str:
@@ -68,41 +200,45 @@ def process_msg_text(message:dict) -> str:
     
     # Empty string implies an image was sent. Consequence of downloader.py's parse_message()
     if (content == ""):
-        content = IMG_TOKEN
-        return content 
+        return IMG_TOKEN
     elif (content.startswith("https://tenor.com/")):
-        content = GIF_TOKEN
-        return content
+        return GIF_TOKEN
 
-    for mention in message["mentions"]:
-        content = content.replace(f"<@{mention['id']}>", "@" + mention['username'])
+    content = replace_mentions(content, message["mentions"])
 
     # Process each word in the message.
     # Replaces emotes with format expected, lower cases text, replaces links with link token. 
-    content_tokens = content.split()
-    for i in range(len(content_tokens)):
-        token = content_tokens[i]
+    processed_msg = " ".join([process_msg_token(token) for token in content.split()])
+    return processed_msg 
 
-        if (token.startswith("https:")):
-            content_tokens[i] = LINK_TOKEN
-        else:
-            emote_val = re.search(emote_re, token)
-            if (emote_val is not None):
-                # regexp for this is annoying. Need to add back in the closing : (e.g., :KEKW:)
-                content_tokens[i] = emote_val.group(0) + ":" 
-            elif(content_tokens[i] not in [GIF_TOKEN, IMG_TOKEN, LINK_TOKEN]):
-                content_tokens[i] = content_tokens[i].lower()
+
+def process_msg_texts(messages:list) -> list:
+    """
+    Batch version of process_msg_text.
+
+    Input:
+        - messages: List of message objects.
     
-    processed_msg = " ".join(content_tokens)
-    return processed_msg 
+    Output:
+        - processed_msgs: List of processed message strings, in the same order.
+    """
+    return [process_msg_text(message) for message in messages]
 
 
-def split_into_user_context(convo:list) -> dict:
+def split_into_user_context(convo:list, tokenizer:"AutoTokenizer"=None, max_length:int=MAX_SEQUENCE_LENGTH, 
+                            max_context_turns:int=None) -> dict:
     """
     Splits a conversation into context + response pairs for model training.
 
+    Without a tokenizer the context is just the previous turn. With a tokenizer the context is a rolling
+    window of previous turns, as many as fit (together with the response) in max_length tokens, so
+    training sequences are never truncated because of the context.
+
     Input:
         - convo: A list of strings representing a conversation. First message is assumed to be index 0.
+        - tokenizer: Tokenizer the model is trained with (see utils.create_tokenizer), used to count tokens.
+        - max_length: Maximum length of a training sequence in tokens.
+        - max_context_turns: Maximum number of previous turns in the context (None for no limit).
 
     Output:
         -  author_data : Dictionary mapping author (str) to list of context response pairs, where the corresponding
@@ -114,9 +250,8 @@ def split_into_user_context(convo:list) -> dict:
     combined_messages = []
     prev_author = None 
     curr_message = ""
-    for message in convo:
+    for message, message_content in zip(convo, process_msg_texts(convo)):
         author = message["author"]["username"]
-        message_content = process_msg_text(message)
 
         if (author == prev_author or prev_author is None ):
             curr_message += message_content + ". "
@@ -134,56 +269,323 @@ def split_into_user_context(convo:list) -> dict:
                 "message" : curr_message
             })
     
+    if (tokenizer is None):
+        max_context_turns = 1
+        
     # Split these messages into context + response pairs.
+    # With a tokenizer, the context is as many of the previous turns as fit in the sequence next to the response.
+    # Token counts are computed once per turn, and the window never holds more turns than fit in max_length tokens.
     author_data = {}
-    prev_context = " "
-    all_prev_context = ""
+    window = deque()
+    window_tokens = 0
     for message in combined_messages:
         author = message["author"]
         message_content = message["message"]
+        num_tokens = len(tokenizer.tokenize(message_content)) if tokenizer is not None else 0
 
         if (author not in author_data):
             author_data[author] = []
+
+        context_budget = max_length - num_tokens - NUM_FORMAT_TOKENS
+        context_turns = []
+        for turn_content, turn_tokens in reversed(window):
+            if (turn_tokens > context_budget or len(context_turns) == max_context_turns):
+                break
+            context_turns.append(turn_content)
+            context_budget -= turn_tokens
+        prev_context = "".join(reversed(context_turns)) if context_turns else " "
         
         # Format for model training: "[BOS] {prompt} [SEP] {response} [EOS]"
         train_string = f"{BOS} " + prev_context + f" {SEP} " + message_content + f" {EOS}"
 
         # Format as jsonl
         author_data[author].append( json.dumps({"context" : prev_context, "response" : message_content, "train" : train_string}) + "\n" )
-        prev_context = message_content
-        all_prev_context += message_content
+
+        window.append((message_content, num_tokens))
+        window_tokens += num_tokens
+        while (window_tokens > max_length - NUM_FORMAT_TOKENS):
+            window_tokens -= window.popleft()[1]
     
     return author_data
 
 
-def main():
-    secrets = load_secrets()
-    user_to_id = secrets["users"]
-    
-    # File with all messages scraped using downloader.py
-    base_message = FOLDER + "/all_messages.json"
-    all_msgs_json = read_json(base_message)
+def process_shard(shard_idx:int, channel_name:str, ranges:"np.ndarray", shard_folder:str, folder:str=FOLDER) -> list:
+    """
+    Processes one shard of conversations, streaming each author's lines to their own file in the shard's folder.
+
+    Runs in a worker process. The message store is memory-mapped, so a worker only ever holds one 
+    conversation in memory.
+
+    Input:
+        - shard_idx: Index of the shard (its lines end up in this position when shards are merged).
+        - channel_name: Channel the conversations belong to.
+        - ranges: Conversation ranges (output of conversation_ranges) to process.
+        - shard_folder: Folder the shards are written to.
+        - folder: Folder the message stores are read from.
+
+    Output:
+        - authors: Authors with at least one line in this shard.
+    """
+    all_msgs_json = read_columnar_store(channel_name, folder)
+    out_folder = f"{shard_folder}/{shard_idx:06d}"
+    os.makedirs(out_folder, exist_ok=True)
+
+    author_fps = {}
+    try:
+        for start, stop in ranges:
+            convo = conversation_messages(all_msgs_json, start, stop)
+            for author, data in split_into_user_context(convo, _worker_tokenizer).items():
+                if (author not in author_fps):
+                    author_fps[author] = open(f"{out_folder}/{author}.jsonl", 'w')
+                author_fps[author].writelines(data)
+    finally:
+        for fp in author_fps.values():
+            fp.close()
+
+    return list(author_fps.keys())
+
+
+def _process_shard_args(args:tuple) -> list:
+    return process_shard(*args)
+
 
-    convos = break_into_conversations(all_msgs_json, user_to_id)
+def _init_worker(model_string:str) -> None:
+    # Each worker loads the tokenizer once, rather than once per shard.
+    global _worker_tokenizer
+    _worker_tokenizer = create_tokenizer(model_string) if model_string is not None else None
+    return 
 
-    all_author_data = {}
-    for convo in convos:
-        author_data = split_into_user_context(convo)
 
-        for author, data in author_data.items():
-            if (author not in all_author_data):
-                all_author_data[author] = data 
-            else:
-                all_author_data[author] += data
+def channel_conversation_ranges(channel_name:str, manifest_channel:dict=None, folder:str=FOLDER) -> tuple:
+    """
+    Finds the conversations of a channel that still need to be processed.
+
+    Messages only ever get added after the newest one (downloader.py's sync), so every conversation before the
+    trailing one recorded in the manifest is final. The trailing conversation may have grown since, so it is 
+    processed again along with everything after it. If older messages were added (the backwards scrape was
+    still running last time) the whole channel is processed again.
+
+    A channel without a columnar store (not downloaded yet, or removed) is skipped. It is left out of the
+    new manifest, so its old lines are dropped and it is processed from scratch once its store is back.
+
+    Input:
+        - channel_name: Name of the channel.
+        - manifest_channel: The channel's entry in the manifest of the last run (None to process everything).
+        - folder: Folder the message stores are read from.
+
+    Output:
+        - (ranges, channel_state): Conversation ranges to process, and the channel's entry for the new manifest.
+    """
+    if (not os.path.exists(message_columns_path(channel_name, folder))):
+        print(f"Skipping {channel_name}, it has no message store in {folder} (run downloader.py first)")
+        return np.zeros((0, 2), dtype=np.int64), None
+
+    message_ids, message_types = message_id_columns(read_columnar_store(channel_name, folder))
+    ranges = conversation_ranges(message_ids, message_types)
+    if (len(ranges) == 0):
+        return ranges, None
+
+    # Message stores are sorted in reverse order
+    start_ids = np.asarray(message_ids[::-1])[ranges[:, 0]]
+    channel_state = {"oldest_message_id" : str(message_ids[-1]), "trailing_start_id" : str(start_ids[-1])}
+
+    if (manifest_channel is not None and manifest_channel["oldest_message_id"] == channel_state["oldest_message_id"]):
+        ranges = ranges[start_ids >= int(manifest_channel["trailing_start_id"])]
+
+    return ranges, channel_state
+
+
+def plan_shards(channel_ranges:list, convos_per_shard:int) -> list:
+    """
+    Splits conversations into shards of consecutive conversations.
+
+    Input:
+        - channel_ranges: List of (channel_name, ranges) tuples, in output order.
+        - convos_per_shard: Maximum number of conversations per shard.
+
+    Output:
+        - shards: List of (channel_name, ranges) tuples. Processing them in order is equivalent to 
+                  processing every conversation of every channel in order.
+    """
+    shards = []
+    for channel_name, ranges in channel_ranges:
+        for shard_start in range(0, len(ranges), convos_per_shard):
+            shards.append((channel_name, ranges[shard_start : shard_start + convos_per_shard]))
     
-    # Write each author's data to their own .jsonl file.
+    return shards
+
+
+def _copy_bytes(src_fp:"io.BufferedReader", dst_fp:"io.BufferedWriter", num_bytes:int, chunk_size:int=1 << 20) -> None:
+    # Like shutil.copyfileobj, but stops after num_bytes.
+    while (num_bytes > 0):
+        chunk = src_fp.read(min(chunk_size, num_bytes))
+        if (len(chunk) == 0):
+            raise ValueError(f"{src_fp.name} is shorter than its manifest says, run with full_rebuild=True")
+        dst_fp.write(chunk)
+        num_bytes -= len(chunk)
+    return 
+
+
+def merge_shards(shard_folder:str, channel_shards:list, authors:set, out_folder:str, old_segments:dict) -> dict:
+    """
+    Rewrites each author's .jsonl file from the lines kept from the last run and the new shard files.
+
+    Lines are ordered by channel, then by conversation start, so an incremental run writes the same
+    files as a full rebuild. Within a channel the lines of its closed conversations come first, then
+    the lines of its trailing conversation (which the next run drops and processes again).
+
+    Input:
+        - shard_folder: Folder the shards were written to.
+        - channel_shards: List of (channel_name, closed_shard_idxs, trailing_shard_idxs) tuples, in output order.
+        - authors: Every author that appears in a shard.
+        - out_folder: Folder for the final {author}.jsonl files.
+        - old_segments: The manifest's author_segments of the last run ({author : {channel_name : [offset, closed_bytes]}}).
+                        Only the closed lines of channels in channel_shards are kept.
+
+    Output:
+        - segments: The author_segments for the new manifest.
+    """
+    def copy_shards(shard_idxs:range, author:str, out_fp:"io.BufferedWriter") -> None:
+        for shard_idx in shard_idxs:
+            shard_filename = f"{shard_folder}/{shard_idx:06d}/{author}.jsonl"
+            if (os.path.exists(shard_filename)):
+                with open(shard_filename, 'rb') as shard_fp:
+                    shutil.copyfileobj(shard_fp, out_fp)
+
     # NOTE: discord usernames can have periods in them. Deal with that as you need to.
-    for author, all_data in all_author_data.items():
-        with open(FOLDER + f"/user_messages/{author}.jsonl", 'w') as fp:
-            fp.writelines(all_data)
+    segments = {}
+    for author in sorted(authors | set(old_segments.keys())):
+        author_filename = f"{out_folder}/{author}.jsonl"
+        author_old_segments = old_segments.get(author, {})
+        author_segments = {}
+        old_fp = open(author_filename, 'rb') if (len(author_old_segments) > 0) else None
+        try:
+            with open(author_filename + ".tmp", 'wb') as out_fp:
+                for channel_name, closed_shard_idxs, trailing_shard_idxs in channel_shards:
+                    offset = out_fp.tell()
+                    if (channel_name in author_old_segments):
+                        old_offset, old_closed_bytes = author_old_segments[channel_name]
+                        old_fp.seek(old_offset)
+                        _copy_bytes(old_fp, out_fp, old_closed_bytes)
+                    copy_shards(closed_shard_idxs, author, out_fp)
+                    closed_bytes = out_fp.tell() - offset
+                    copy_shards(trailing_shard_idxs, author, out_fp)
+                    if (out_fp.tell() > offset):
+                        author_segments[channel_name] = [offset, closed_bytes]
+        finally:
+            if (old_fp is not None):
+                old_fp.close()
+
+        # Authors left without any lines (their channels are gone) don't keep an empty file.
+        if (len(author_segments) == 0):
+            os.remove(author_filename + ".tmp")
+            if (os.path.exists(author_filename)):
+                os.remove(author_filename)
+            continue
+        os.replace(author_filename + ".tmp", author_filename)
+        segments[author] = author_segments
+
+    return segments
+
+
+def process_and_merge(channel_ranges:list, out_folder:str, old_segments:dict, pool:"multiprocessing.Pool", 
+                      convos_per_shard:int) -> dict:
+    """
+    Processes conversations on the pool and merges the output into the per-author .jsonl files.
+
+    Input:
+        - channel_ranges: List of (channel_name, ranges) tuples, in output order. The last conversation
+                          of each channel is its trailing conversation.
+        - out_folder: Folder of the per-author .jsonl files.
+        - old_segments: See merge_shards.
+        - pool: Worker pool.
+        - convos_per_shard: Number of conversations per shard.
+
+    Output:
+        - segments: The author_segments for the new manifest (see merge_shards).
+    """
+    # Trailing conversations get shards of their own, so their lines can be told apart from the closed ones.
+    shards = []
+    channel_shards = []
+    for channel_name, ranges in channel_ranges:
+        closed_shards = plan_shards([(channel_name, ranges[:-1])], convos_per_shard)
+        trailing_shards = plan_shards([(channel_name, ranges[-1:])], convos_per_shard)
+        closed_shard_idxs = range(len(shards), len(shards) + len(closed_shards))
+        trailing_shard_idxs = range(closed_shard_idxs.stop, closed_shard_idxs.stop + len(trailing_shards))
+        channel_shards.append((channel_name, closed_shard_idxs, trailing_shard_idxs))
+        shards += closed_shards + trailing_shards
+
+    shard_folder = out_folder + "/shards"
+    shutil.rmtree(shard_folder, ignore_errors=True)
+    os.makedirs(shard_folder)
+
+    shard_args = [(shard_idx, channel_name, ranges, shard_folder) for shard_idx, (channel_name, ranges) in enumerate(shards)]
+    authors = set()
+    for shard_authors in pool.imap_unordered(_process_shard_args, shard_args):
+        authors.update(shard_authors)
+
+    segments = merge_shards(shard_folder, channel_shards, authors, out_folder, old_segments)
+    shutil.rmtree(shard_folder)
+    return segments
+
+
+def main(num_workers:int=None, convos_per_shard:int=2000, full_rebuild:bool=False, model_string:str="openai-gpt"):
+    """
+    Preprocesses every channel's messages into one .jsonl file of training data per author.
+
+    Conversations are sharded across a process pool. Each worker streams its output to per-author
+    shard files, which are then merged in shard order, so the output doesn't depend on the number of 
+    workers and memory use doesn't depend on the size of the corpus.
+
+    A manifest of what was processed is kept next to the output, so later runs only process the
+    conversations that are new (or may have changed) and merge them into the per-author files,
+    which end up the same as after a full rebuild.
+
+    Input:
+        - num_workers: Number of worker processes (defaults to the number of cores).
+        - convos_per_shard: Number of conversations per shard.
+        - full_rebuild: Ignore the manifest and process every conversation again.
+        - model_string: Pretrained model whose tokenizer sizes the context windows (None for previous-turn-only context).
+    """
+    secrets = load_secrets()
+    out_folder = FOLDER + "/user_messages"
+    manifest_filename = out_folder + "/manifest.json"
+    os.makedirs(out_folder, exist_ok=True)
+
+    manifest = {"channels" : {}, "author_segments" : {}}
+    if (not full_rebuild and os.path.exists(manifest_filename)):
+        manifest = read_json(manifest_filename)
+
+        # Output files removed by hand can't be merged into, output made for another tokenizer can't be mixed in, and
+        # manifests of older versions only recorded where the trailing conversations start.
+        if ("author_segments" not in manifest or manifest.get("model_string") != model_string
+            or not all(os.path.exists(f"{out_folder}/{author}.jsonl") for author in manifest["author_segments"])):
+            return main(num_workers, convos_per_shard, True, model_string)
+
+    # Columnar message stores written by downloader.py (one per channel), memory-mapped rather than parsed.
+    # Conversations never span channels, so each channel is broken into conversations separately.
+    channel_ranges = []
+    new_manifest = {"channels" : {}, "author_segments" : {}, "model_string" : model_string}
+    for channel_name in secrets["channels"]:
+        ranges, channel_state = channel_conversation_ranges(channel_name, manifest["channels"].get(channel_name))
+        if (channel_state is None):
+            continue
+
+        # A channel processed from scratch can't keep lines it wrote before, so it forces a full rebuild.
+        if (channel_name in manifest["channels"] and manifest["channels"][channel_name]["oldest_message_id"] != channel_state["oldest_message_id"]):
+            return main(num_workers, convos_per_shard, True, model_string)
+
+        new_manifest["channels"][channel_name] = channel_state
+        channel_ranges.append((channel_name, ranges))
+
+    # Last run's lines are kept up to each channel's trailing conversation, which is processed again.
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(model_string,)) as pool:
+        new_manifest["author_segments"] = process_and_merge(channel_ranges, out_folder, manifest["author_segments"], 
+                                                            pool, convos_per_shard)
+
+    write_json_atomic(new_manifest, manifest_filename)
 
 
 
 if (__name__ == "__main__"):
     main()
-
@@ -0,0 +1,257 @@
+import asyncio
+import time
+
+
+# Discord's documented global limit is 50 requests per second across all routes.
+GLOBAL_REQUESTS_PER_SECOND = 50
+
+
+class RateLimitedError(Exception):
+    """
+    Raised when a request keeps getting 429'd after the maximum number of retries.
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    Token bucket for a single Discord rate limit bucket.
+
+    Discord reports the state of a bucket on every response through the X-RateLimit-* headers:
+    https://discord.com/developers/docs/topics/rate-limits#header-format
+
+    Until the first response is seen the bucket allows one request at a time: its single token only comes
+    back with that response (update) or when the request fails (release). After that it is driven entirely by
+    what the server reports rather than by a guess.
+    """
+
+    def __init__(self) -> None:
+        self.limit = 1
+        self.remaining = 1
+
+        # Not known until the first response, the token isn't refilled on a timer before then.
+        self.reset_at = float("inf")
+
+        # Set whenever the bucket's state changes, to wake up a request waiting for a token.
+        self.changed = asyncio.Event()
+        self.lock = asyncio.Lock()
+        return
+
+
+    async def acquire(self) -> None:
+        """
+        Waits until the bucket has a token, then takes it.
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if (self.remaining <= 0 and now >= self.reset_at):
+                    self.remaining = self.limit
+
+                if (self.remaining > 0):
+                    self.remaining -= 1
+                    return
+
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), self.reset_at - now if self.reset_at != float("inf") else None)
+                except asyncio.TimeoutError:
+                    pass
+
+
+    def update(self, headers:"dict") -> None:
+        """
+        Syncs the bucket with the X-RateLimit-* headers of a response.
+
+        Input:
+            - headers: Response headers.
+        """
+        if ("X-RateLimit-Remaining" not in headers):
+            # The route reports no limit: once its first response is in, don't hold requests back.
+            if (self.reset_at == float("inf")):
+                self.reset_at = time.monotonic()
+                self.changed.set()
+            return
+
+        self.limit = int(headers.get("X-RateLimit-Limit", self.limit))
+        self.remaining = int(headers["X-RateLimit-Remaining"])
+        if ("X-RateLimit-Reset-After" in headers):
+            self.reset_at = time.monotonic() + float(headers["X-RateLimit-Reset-After"])
+        elif (self.reset_at == float("inf")):
+            self.reset_at = time.monotonic()
+        self.changed.set()
+        return
+
+
+    def release(self) -> None:
+        """
+        Gives back the token of a request that got no response (e.g. a connection error) before the first response
+        was seen, so the bucket isn't held forever. Does nothing once the server drives the bucket.
+        """
+        if (self.reset_at == float("inf")):
+            self.remaining = min(self.remaining + 1, self.limit)
+            self.changed.set()
+        return
+
+
+    def block(self, retry_after:float) -> None:
+        """
+        Empties the bucket until retry_after seconds from now (used after a 429).
+
+        Input:
+            - retry_after: Seconds until the bucket can be used again.
+        """
+        self.remaining = 0
+        self.reset_at = time.monotonic() + retry_after
+        self.changed.set()
+        return
+
+
+class GlobalLimiter:
+    """
+    Continuously refilling token bucket shared by every request, plus the pause requested by a global 429.
+    """
+
+    def __init__(self, requests_per_second:float=GLOBAL_REQUESTS_PER_SECOND) -> None:
+        self.rate = requests_per_second
+        self.tokens = requests_per_second
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+        return
+
+
+    async def acquire(self) -> None:
+        """
+        Waits until a request is allowed under the global limit, then takes a token.
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if (now < self.blocked_until):
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if (self.tokens >= 1):
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+    def block(self, retry_after:float) -> None:
+        """
+        Pauses all requests for retry_after seconds (used after a global 429).
+
+        Input:
+            - retry_after: Seconds until requests can be sent again.
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        return
+
+
+class RateLimiter:
+    """
+    Per-route rate limit scheduler for the discord API.
+
+    Routes are identified by the caller (e.g. "GET /channels/{channel_id}/messages") together with
+    their major parameter (the channel ID), since Discord rate limits each channel separately.
+    Once the server tells us which bucket a route belongs to (X-RateLimit-Bucket), routes that share
+    a bucket also share a TokenBucket.
+    """
+
+    def __init__(self, max_retries:int=10, requests_per_second:float=GLOBAL_REQUESTS_PER_SECOND) -> None:
+        """
+        Constructor.
+
+        Input:
+            - max_retries: How many times a request is retried after being rate limited.
+            - requests_per_second: Global request budget across all routes.
+        """
+        self.max_retries = max_retries
+        self.global_limiter = GlobalLimiter(requests_per_second)
+        self.route_to_bucket_hash = {}
+        self.buckets = {}
+
+        # Counters, useful for spotting misbehaving rate limit handling.
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        return
+
+
+    def get_bucket(self, route:str, major:str) -> TokenBucket:
+        """
+        Finds (or creates) the TokenBucket for a route + major parameter.
+
+        Input:
+            - route: Route template (e.g. "GET /channels/{channel_id}/messages").
+            - major: Value of the major parameter (e.g. the channel ID).
+
+        Output:
+            - bucket: The TokenBucket.
+        """
+        bucket_key = (self.route_to_bucket_hash.get(route, route), major)
+        if (bucket_key not in self.buckets):
+            self.buckets[bucket_key] = TokenBucket()
+        return self.buckets[bucket_key]
+
+
+    def _learn_bucket(self, route:str, major:str, bucket:TokenBucket, headers:"dict") -> None:
+        # Alias the route to the bucket hash the server reported, keeping the state we already have. Every major
+        # parameter seen on the route so far moves over, not just this one.
+        bucket_hash = headers.get("X-RateLimit-Bucket")
+        if (bucket_hash is None or self.route_to_bucket_hash.get(route) == bucket_hash):
+            return
+        self.route_to_bucket_hash[route] = bucket_hash
+        for key in [key for key in self.buckets if key[0] == route]:
+            self.buckets.setdefault((bucket_hash, key[1]), self.buckets.pop(key))
+        self.buckets.setdefault((bucket_hash, major), bucket)
+        return
+
+
+    async def request(self, session:"aiohttp.ClientSession", method:str, url:str, route:str, major:str, **kwargs) -> object:
+        """
+        Sends a request once the rate limits allow it, retrying when the server answers with a 429.
+
+        Input:
+            - session: Pooled aiohttp session used to send the request.
+            - method: HTTP method.
+            - url: Full URL of the request.
+            - route: Route template used to pick the rate limit bucket.
+            - major: Value of the major parameter of the route.
+            - kwargs: Passed on to session.request (e.g. params, headers).
+
+        Output:
+            - res_json: Decoded JSON body of the response.
+        """
+        for _ in range(self.max_retries + 1):
+            bucket = self.get_bucket(route, major)
+            await self.global_limiter.acquire()
+            await bucket.acquire()
+
+            self.num_requests += 1
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    self._learn_bucket(route, major, bucket, response.headers)
+                    bucket.update(response.headers)
+
+                    if (response.status != 429):
+                        response.raise_for_status()
+                        return await response.json()
+
+                    # https://discord.com/developers/docs/topics/rate-limits#exceeding-a-rate-limit
+                    self.num_rate_limited += 1
+                    body = await response.json(content_type=None)
+                    retry_after = float(response.headers.get("Retry-After", body.get("retry_after", 1)))
+                    if (body.get("global", False) or response.headers.get("X-RateLimit-Global") == "true"):
+                        self.global_limiter.block(retry_after)
+                    else:
+                        bucket.block(retry_after)
+            except BaseException:
+                # Including cancellation: a request that never got its response mustn't keep a new bucket's token.
+                bucket.release()
+                raise
+
+        raise RateLimitedError(f"Still rate limited after {self.max_retries} retries: {method} {url}")
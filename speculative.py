@@ -0,0 +1,111 @@
+import torch
+
+from backends import ExportedCausalLM
+from inference import next_token_probs
+
+
+def last_logits(model:object, input_ids:"torch.Tensor", num_positions:int) -> "torch.Tensor":
+    """
+    Logits of the last positions of a sequence, without computing the output layer for the rest of it.
+
+    Input:
+        - model: A transformers causal LM or a backends.ExportedCausalLM.
+        - input_ids: Token ids, shape (1, sequence).
+        - num_positions: How many of the last positions to return logits for.
+
+    Output:
+        - logits: Shape (num_positions, vocab).
+    """
+    with torch.no_grad():
+        if (isinstance(model, ExportedCausalLM)):
+            return model.logits(input_ids, torch.ones_like(input_ids))[0, -num_positions : ].float()
+        return model(input_ids=input_ids, logits_to_keep=num_positions).logits[0].float()
+
+
+def speculative_generate(model:object, draft_model:object, input_ids:list, max_new_tokens:int=200, num_draft_tokens:int=4,
+                         min_new_tokens:int=0, do_sample:bool=False, temperature:float=1.0, top_k:int=0, top_p:float=1.0,
+                         eos_token_id:list=None, stats:dict=None, **kwargs) -> list:
+    """
+    Generates a reply with speculative decoding: the small draft model proposes num_draft_tokens tokens one at a
+    time and the model checks all of them in a single forward pass, keeping the longest prefix it agrees with
+    plus one token of its own.
+
+    The result follows the model's own distribution (after temperature, top_k and top_p, see
+    inference.next_token_probs): a drafted token x is kept with probability min(1, p(x) / q(x)), where p and q are
+    the model's and the draft model's probabilities, and the first rejected one is replaced by a sample from
+    max(0, p - q) (Leviathan et al., "Fast Inference from Transformers via Speculative Decoding"). Greedy
+    generation gives exactly the tokens generate would.
+
+    Neither model keeps keys/values (GPT 1 can't), so every forward pass re-encodes the whole sequence. This is
+    what makes it pay off: checking num_draft_tokens + 1 positions costs about as much as generating one token.
+
+    Input:
+        - model: Model the reply is generated from (a transformers causal LM or a backends.ExportedCausalLM).
+        - draft_model: Smaller model with the same tokenizer (see fine_tune.create_draft_model).
+        - input_ids: Token ids of the prompt.
+        - max_new_tokens, min_new_tokens, do_sample, temperature, top_k, top_p, eos_token_id: As in generate.
+        - num_draft_tokens: Tokens drafted per forward pass of the model.
+        - stats: Optional dictionary to add the number of "drafted" and "accepted" tokens to.
+        - kwargs: Other generate settings, ignored.
+
+    Output:
+        - reply_ids: Token ids generated, including the stop token if one was generated.
+    """
+    eos_token_id = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id or [])
+    input_ids = list(input_ids)
+    reply_ids = []
+
+    def probs(logits:"torch.Tensor", first_step:int) -> "torch.Tensor":
+        # Distribution of the next token of each row of logits, row i being generation step first_step + i.
+        num_banned = min(max(min_new_tokens - first_step, 0), len(logits))
+        if (num_banned > 0 and eos_token_id):
+            logits = logits.clone()
+            logits[ : num_banned, eos_token_id] = float("-inf")
+        if (not do_sample):
+            return torch.nn.functional.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+        return next_token_probs(logits, temperature, top_k, top_p)
+
+    def pick(token_probs:"torch.Tensor") -> int:
+        return int(torch.multinomial(token_probs, 1)) if do_sample else int(token_probs.argmax())
+
+    while (len(reply_ids) < max_new_tokens):
+        # Draft tokens, leaving room for the model's own token.
+        draft_ids = []
+        draft_probs = []
+        for _ in range(min(num_draft_tokens, max_new_tokens - len(reply_ids) - 1)):
+            logits = last_logits(draft_model, torch.tensor([input_ids + draft_ids]), 1)
+            token_probs = probs(logits, len(reply_ids) + len(draft_ids))[0]
+            draft_ids.append(pick(token_probs))
+            draft_probs.append(token_probs)
+            if (draft_ids[-1] in eos_token_id):
+                break
+
+        # One pass of the model gives its distribution at every drafted position and the one after.
+        target_probs = probs(last_logits(model, torch.tensor([input_ids + draft_ids]), len(draft_ids) + 1), len(reply_ids))
+        new_ids = []
+        for i, token in enumerate(draft_ids):
+            p = target_probs[i]
+            q = draft_probs[i]
+            if (float(torch.rand(())) * float(q[token]) < float(p[token])):
+                new_ids.append(token)
+                continue
+
+            # Rejected: sample from what the model gives more probability to than the draft model did.
+            residual = (p - q).clamp(min=0)
+            new_ids.append(pick(residual / residual.sum() if residual.sum() > 0 else p))
+            break
+        else:
+            new_ids.append(pick(target_probs[len(draft_ids)]))
+
+        if (stats is not None):
+            stats["drafted"] = stats.get("drafted", 0) + len(draft_ids)
+            stats["accepted"] = stats.get("accepted", 0) + len(new_ids) - 1
+
+        # A drafted stop token that was accepted ends the reply, as does the model's own.
+        for token in new_ids:
+            reply_ids.append(token)
+            input_ids.append(token)
+            if (token in eos_token_id):
+                return reply_ids
+
+    return reply_ids
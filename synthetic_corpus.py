@@ -0,0 +1,211 @@
+import json
+import os
+import random
+import sys
+import time
+
+from utils import append_to_columnar, message_columns_path, message_store_paths, DISCORD_EPOCH, load_emotes
+
+# Emote names used when custom/emotes.txt is empty.
+DEFAULT_EMOTES = [":KEKW:", ":pog:", ":sadge:", ":monkaS:", ":pepehands:"]
+
+# Words messages are made of, most common first (word i is picked with weight 1 / (i + 1), like real text).
+WORDS = ("i the you it to a and that is lol what no yeah this in of so like just me not do it's he we but was "
+         "for have on be my are they if get know at think gonna good with one can oh time why got how all she "
+         "there now go game see up out about really wait man bro did play then too guys when someone tonight "
+         "dude right need want yes thing back still people even ok nice because actually maybe sure lmao fr "
+         "idk tomorrow server match ranked lost won again queue later work class food pizza sleep week love").split()
+WORD_WEIGHTS = [1 / (i + 1) for i in range(len(WORDS))]
+
+FIRST_NAMES = ["matthew", "alex", "sam", "jordan", "taylor", "casey", "riley", "morgan", "jamie", "drew", "quinn", "avery",
+               "parker", "reese", "skyler", "rowan", "emery", "finley", "hayden", "logan"]
+# Copypasta people keep pasting (sometimes with small edits), which dedup.py should find.
+COPYPASTA = ["what the heck did you just say about me you little gamer i will have you know i graduated top of my class in the ranked queue",
+             "i sexually identify as a pizza ever since i was a boy i dreamed of sleeping through class and eating pizza every week",
+             "this is the story of a man who lost every ranked match of the week and still said gg to the whole server every time"]
+LINKS = ["https://www.youtube.com/watch?v={}", "https://twitter.com/someone/status/{}", "https://www.reddit.com/r/games/comments/{}",
+         "https://store.steampowered.com/app/{}", "https://github.com/someone/project/issues/{}"]
+
+
+def make_authors(num_authors:int, rng:"random.Random") -> list:
+    """
+    Creates users in the author schema of downloader.py's parse_message().
+
+    Input:
+        - num_authors: How many users to create.
+        - rng: Random number generator.
+
+    Output:
+        - authors: List of {"id", "username", "global_name"} dictionaries.
+    """
+    authors = []
+    for i in range(num_authors):
+        first_name = FIRST_NAMES[i % len(FIRST_NAMES)]
+        username = f"{first_name}{rng.randint(0, 999)}" if i >= len(FIRST_NAMES) or rng.random() < 0.5 else first_name
+        authors.append({
+            "id" : str(rng.randint(10**17, 10**18 - 1)),
+            "username" : username,
+            "global_name" : username.capitalize() if rng.random() < 0.8 else None,
+        })
+    return authors
+
+
+def make_content(rng:"random.Random", emotes:list, authors:list) -> tuple:
+    """
+    Creates the content of one message: mostly short lower case chat, with images (empty content), tenor GIFs,
+    copypasta, spam, links, custom emotes and mentions mixed in.
+
+    Input:
+        - rng: Random number generator.
+        - emotes: Emote names (e.g. ":KEKW:").
+        - authors: Users that can be mentioned.
+
+    Output:
+        - content: Text of the message.
+        - mentions: Users mentioned in it.
+    """
+    kind = rng.random()
+    if (kind < 0.03):
+        return "", []
+    elif (kind < 0.07):
+        words = "-".join(rng.choices(WORDS, WORD_WEIGHTS, k=rng.randint(1, 4)))
+        return f"https://tenor.com/view/{words}-gif-{rng.randint(10**6, 10**8)}", []
+    elif (kind < 0.08):
+        words = rng.choice(COPYPASTA).split()
+        if (rng.random() < 0.3):
+            words[rng.randrange(len(words))] = rng.choice(WORDS)
+        return " ".join(words), []
+    elif (kind < 0.085):
+        # Spam: one word over and over.
+        return " ".join([rng.choice(WORDS)] * rng.randint(5, 30)), []
+
+    num_words = max(1, int(rng.lognormvariate(1.6, 0.8)))
+    tokens = rng.choices(WORDS, WORD_WEIGHTS, k=num_words)
+    if (rng.random() < 0.15):
+        tokens[0] = tokens[0].capitalize()
+
+    mentions = []
+    if (rng.random() < 0.06):
+        mentioned = rng.choice(authors)
+        mentions.append(mentioned)
+        tokens.insert(rng.randint(0, len(tokens)), f"<@{mentioned['id']}>")
+    if (rng.random() < 0.04):
+        tokens.append(rng.choice(LINKS).format(rng.randint(10**6, 10**9)))
+    for _ in range(rng.choice([0] * 10 + [1, 1, 2])):
+        tokens.insert(rng.randint(0, len(tokens)), f"<:{rng.choice(emotes).strip(':')}:{rng.randint(10**17, 10**18 - 1)}>")
+    if (rng.random() < 0.2):
+        tokens[-1] += rng.choice(["?", "!", ".", "...", "!!"])
+
+    return " ".join(tokens), mentions
+
+
+def make_channel_messages(num_messages:int, num_authors:int=12, channel_index:int=0, seed:int=0,
+                          start_ms:int=1650000000000) -> list:
+    """
+    Creates a synthetic channel history in the exact schema of downloader.py's parse_message(), newest first
+    (the order the API returns and the message stores keep them in).
+
+    Chat comes in sessions: messages follow each other by seconds to a few minutes, with sessions hours to days
+    apart, so pre_process_text.break_into_conversations finds conversations of realistic lengths. A few authors
+    write most of the messages, often several in a row, and some messages are replies (type 19), which can come
+    long after the message they answer.
+
+    Input:
+        - num_messages: How many messages to create.
+        - num_authors: How many users write in the channel.
+        - channel_index: Index of the channel, mixed into the snowflakes so ids are unique across channels.
+        - seed: Seed of the random number generator, the same seed gives the same messages.
+        - start_ms: Unix time (ms) of the first message.
+
+    Output:
+        - messages: List of message dictionaries.
+    """
+    rng = random.Random(seed * 1000003 + channel_index)
+    emotes = [x for x in load_emotes() if x] or DEFAULT_EMOTES
+    authors = make_authors(num_authors, rng)
+
+    # Activity follows a power law: the first few authors write most of the messages.
+    author_weights = [1 / (i + 1) ** 1.2 for i in range(num_authors)]
+
+    messages = []
+    timestamp_ms = start_ms
+    author = rng.choices(authors, author_weights)[0]
+    session_left = 0
+    for i in range(num_messages):
+        message_type = 0
+        if (session_left == 0):
+            # Between sessions: 20 minutes to two days of silence.
+            session_left = max(1, int(rng.expovariate(1 / 40)))
+            timestamp_ms += int(rng.uniform(20 * 60, 48 * 60 * 60) * 1000)
+            if (i > 0 and rng.random() < 0.1):
+                message_type = 19
+        else:
+            timestamp_ms += int(min(rng.expovariate(1 / 45), 15 * 60) * 1000) + 1
+            if (rng.random() < 0.08):
+                message_type = 19
+        session_left -= 1
+
+        # Users often split what they say over several messages.
+        if (rng.random() > 0.35):
+            author = rng.choices(authors, author_weights)[0]
+
+        content, mentions = make_content(rng, emotes, authors)
+        if (message_type == 19 and messages):
+            replied_to = messages[rng.randint(max(0, len(messages) - 10), len(messages) - 1)]["author"]
+            if (replied_to["id"] != author["id"] and rng.random() < 0.7):
+                mentions = mentions + [replied_to]
+
+        reactions = {}
+        if (rng.random() < 0.05):
+            for emote in rng.sample(emotes, min(len(emotes), rng.randint(1, 2))):
+                reactions[emote.strip(":")] = rng.randint(1, 5)
+
+        snowflake = ((timestamp_ms - DISCORD_EPOCH) << 22) | (channel_index << 12) | (i % 4096)
+        messages.append({
+            "id" : str(snowflake),
+            "content" : content,
+            "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp_ms / 1000)) + f".{timestamp_ms % 1000:03d}000+00:00",
+            "type" : message_type,
+            "author" : dict(author),
+            "mentions" : [dict(x) for x in mentions],
+            "mention_everyone" : rng.random() < 0.002,
+            "reactions" : reactions,
+        })
+
+    messages.reverse()
+    return messages
+
+
+def write_channel(messages:list, channel_name:str, folder:str="messages") -> int:
+    """
+    Writes messages as a channel's .jsonl message store and its columnar copy, like downloader.py does.
+
+    Input:
+        - messages: Messages, newest first (see make_channel_messages).
+        - channel_name: Name of the channel.
+        - folder: Folder the message stores are written to.
+
+    Output:
+        - num_messages: Number of messages in the columnar store afterwards.
+    """
+    os.makedirs(folder, exist_ok=True)
+    store_filename, _ = message_store_paths(channel_name, folder)
+    with open(store_filename, 'w') as fp:
+        for message in messages:
+            fp.write(json.dumps(message) + "\n")
+    return append_to_columnar(messages, message_columns_path(channel_name, folder))
+
+
+def main():
+    # Usage: python synthetic_corpus.py <channel_name> [num_messages] [seed]
+    if (len(sys.argv) < 2):
+        print("Usage: python synthetic_corpus.py <channel_name> [num_messages] [seed]")
+        return
+    num_messages = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    messages = make_channel_messages(num_messages, seed=seed)
+    print(f"Wrote {write_channel(messages, sys.argv[1])} messages to {message_columns_path(sys.argv[1])}")
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,37 @@
+import numpy as np
+import torch
+from transformers import OpenAIGPTConfig, OpenAIGPTLMHeadModel
+
+from fine_tune import PackedDataset, TokenCacheDataset, enable_packed_attention, pad_to_longest
+from utils import write_json
+
+
+def write_token_cache(cache_dir:str, examples:list) -> None:
+    # Same files as fine_tune.build_token_cache, without a tokenizer.
+    offsets = np.cumsum([0] + [len(x) for x in examples])
+    np.concatenate(examples).astype(np.int32).tofile(f"{cache_dir}/tokens.bin")
+    np.save(f"{cache_dir}/offsets.npy", offsets)
+    write_json({"num_examples" : len(examples), "num_tokens" : int(offsets[-1])}, f"{cache_dir}/meta.json")
+
+
+def test_packed_examples_get_their_unpacked_loss(tmp_path):
+    # Every example of a packed batch (two blocks, the shorter one padded) has the loss it has when trained alone.
+    examples = [[1, 5, 6, 7, 2], [1, 8, 9, 2], [1, 10, 11, 12, 13, 14, 2]]
+    write_token_cache(str(tmp_path), examples)
+    dataset = PackedDataset(TokenCacheDataset(str(tmp_path)), block_size=10)
+    assert dataset.blocks == [(0, 2), (2, 3)]
+
+    torch.manual_seed(0)
+    model = OpenAIGPTLMHeadModel(OpenAIGPTConfig(vocab_size=20, n_positions=16, n_embd=16, n_layer=2, n_head=2)).eval()
+    enable_packed_attention(model)
+    batch = pad_to_longest([dataset[0], dataset[1]], pad_token_id=0)
+    packed_labels = batch.pop("labels")
+
+    starts = [(0, 0), (0, 5), (1, 0)]
+    for example, (row, start) in zip(examples, starts):
+        labels = torch.full_like(packed_labels, -100)
+        labels[row, start : start + len(example)] = packed_labels[row, start : start + len(example)]
+        with torch.no_grad():
+            packed_loss = model(**batch, labels=labels).loss
+            unpacked_loss = model(input_ids=torch.tensor([example]), labels=torch.tensor([example])).loss
+        torch.testing.assert_close(packed_loss, unpacked_loss)
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+
+from conversation import ConversationCache
+from inference import InferenceScheduler
+
+
+def test_requests_of_a_channel_are_not_batched_together():
+    # Two messages from the same channel to the same persona, queued behind a busy worker, are answered one at a
+    # time: the second reply is generated from a context that includes the first reply (like MimicBot.__respond).
+    conversations = ConversationCache()
+    busy = threading.Event()
+    release = threading.Event()
+    batches = []
+    contexts = {}
+
+    def generate(name:str, requests:list) -> list:
+        if (name == "busy"):
+            busy.set()
+            release.wait()
+            return [[] for _ in requests]
+
+        batches.append([channel_id for channel_id, _ in requests])
+        replies = []
+        for channel_id, message_ids in requests:
+            conversation = conversations.get(channel_id, name, 0)
+            conversation.add_turn(message_ids)
+            contexts[message_ids[0]] = conversation.context_ids()
+            reply_ids = [x + 100 for x in message_ids]
+            conversation.add_turn(reply_ids)
+            replies.append(reply_ids)
+        return replies
+
+    async def run() -> list:
+        scheduler = InferenceScheduler(generate, num_workers=1, batch_window=0)
+        await scheduler.start()
+        try:
+            blocker = asyncio.create_task(scheduler.submit("other", "busy", "other", [0]))
+            await asyncio.to_thread(busy.wait)
+            first = asyncio.create_task(scheduler.submit(1, "alice", 1, [1]))
+            second = asyncio.create_task(scheduler.submit(1, "alice", 1, [2]))
+            await asyncio.sleep(0)
+            release.set()
+            return await asyncio.gather(blocker, first, second)
+        finally:
+            await scheduler.stop()
+
+    _, first_reply, second_reply = asyncio.run(run())
+    assert batches == [[1], [1]]
+    assert first_reply == [101]
+    assert second_reply == [102]
+    assert contexts[2] == [0, 1, 101, 2]
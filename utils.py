@@ -1,5 +1,10 @@
 # utils.py
+import functools
 import json 
+import os
+import shutil
+from datetime import datetime, timedelta, timezone
+import numpy as np
 
 # Custom tokens
 SEP = "[SEP]"
@@ -10,9 +15,60 @@ IMG_TOKEN = "[IMG]"
 GIF_TOKEN = "[GIF]"
 LINK_TOKEN = "[LINK]"
 
-# Load emotes file
-with open("custom/emotes.txt", 'r') as fp:
-    VALID_EMOTES = [x.strip() for x in fp.readlines()]
+# Longest training sequence (in tokens) fed to the model.
+MAX_SEQUENCE_LENGTH = 512
+
+# Columnar message store: one fixed-width array per field, one row per message (newest first).
+# Variable length fields (content, mentions, reactions) live in append-only heaps, addressed by start + length.
+# The arrays and authors.json of each version of the store are written to a new rows-{version} directory, which
+# version.json (written last) points to, together with the number of rows and the heap sizes they reference.
+HEAP_FILES = ("content.bin", "mentions.bin", "reactions.bin")
+MESSAGE_COLUMNS = {
+    "id" : np.uint64,
+    "author" : np.uint32,
+    "timestamp" : np.int64,
+    "type" : np.uint8,
+    "mention_everyone" : np.bool_,
+    "content_start" : np.int64,
+    "content_length" : np.uint32,
+    "mention_start" : np.int64,
+    "mention_count" : np.uint32,
+    "reactions_start" : np.int64,
+    "reactions_length" : np.uint32,
+}
+
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Discord's epoch (first second of 2015) in milliseconds. Snowflakes store milliseconds since then.
+# https://discord.com/developers/docs/reference#snowflakes
+DISCORD_EPOCH = 1420070400000
+
+# Custom emotes added to the tokenizer's vocabulary, one per line (see the README's custom data section).
+EMOTES_FILE = "custom/emotes.txt"
+
+
+@functools.lru_cache(maxsize=None)
+def load_emotes(emotes_filename : str = EMOTES_FILE) -> list:
+    """
+    Reads the emotes file, once: later calls return the same list (which shouldn't be modified).
+
+    Read on first use rather than when utils is imported, so scripts that don't need the emotes don't need the file.
+
+    Input:
+        - emotes_filename: Path to the emotes file.
+
+    Output:
+        - emotes: List of emote names (e.g. ":KEKW:").
+    """
+    with open(emotes_filename, 'r') as fp:
+        return [x.strip() for x in fp.readlines()]
+
+
+def __getattr__(name : str):
+    # utils.VALID_EMOTES is still available, read by load_emotes the first time it is accessed.
+    if (name == "VALID_EMOTES"):
+        return load_emotes()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def read_json(json_filename : str) -> dict:
@@ -64,6 +120,416 @@ def read_jsonl(filename : str) -> list:
     return jsonl_data
 
 
+def iter_jsonl(filename : str):
+    """
+    Lazily iterates over a .jsonl file one record at a time.
+
+    Unlike read_jsonl, memory use does not grow with the size of the file.
+
+    Input:
+        - filename: Filename of .jsonl file to read.
+    
+    Output:
+        - Generator yielding one dictionary per line of the file.
+    """
+    with open(filename, 'r') as fp:
+        for line in fp:
+            if (line.strip() != ""):
+                yield json.loads(line)
+
+
+def write_json_atomic(json_dict : dict, out_file : str) -> None:
+    """
+    Writes a JSON file so that readers (or a restart after a crash) never see a half-written file.
+
+    Input:
+        - json_dict: Python dictionary representing JSON contents.
+        - out_file: Filename to write json_dict contents to.
+    
+    Output:
+        - None. (writes to file)
+    """
+    tmp_file = out_file + ".tmp"
+    with open(tmp_file, 'w') as out_fp:
+        out_fp.write(json.dumps(json_dict, indent=4))
+        out_fp.flush()
+        os.fsync(out_fp.fileno())
+    os.replace(tmp_file, out_file)
+
+    return 
+
+
+def snowflake_to_ms(snowflakes : "np.ndarray") -> "np.ndarray":
+    """
+    Extracts creation times from discord snowflake ids.
+
+    Input:
+        - snowflakes: Array of snowflake ids (uint64).
+    
+    Output:
+        - timestamps: Array of unix times in milliseconds (int64).
+    """
+    return (np.asarray(snowflakes, dtype=np.uint64) >> np.uint64(22)).astype(np.int64) + DISCORD_EPOCH
+
+
+def message_store_paths(channel_name : str, folder : str = "messages") -> tuple:
+    """
+    Paths of the append-only message store and its scrape checkpoint for a channel.
+
+    Input:
+        - channel_name: Name of the channel (key in the "channels" section of the secrets file).
+        - folder: Folder the message stores are written to.
+    
+    Output:
+        - (store_filename, checkpoint_filename): The .jsonl message store and the .json checkpoint file.
+    """
+    return (f"{folder}/{channel_name}.jsonl", f"{folder}/{channel_name}.checkpoint.json")
+
+
+def message_columns_path(channel_name : str, folder : str = "messages") -> str:
+    """
+    Path of the columnar copy of a channel's message store.
+
+    Input:
+        - channel_name: Name of the channel.
+        - folder: Folder the message stores are written to.
+    
+    Output:
+        - columns_dir: Directory holding the columnar store.
+    """
+    return f"{folder}/{channel_name}.columns"
+
+
+def _append_heap(filename : str, data : bytes) -> int:
+    # Appends to a heap file, returning the offset the data was written at.
+    with open(filename, 'ab') as fp:
+        start = fp.tell()
+        fp.write(data)
+    return start
+
+
+def _columns_version(columns_dir : str) -> tuple:
+    # The current version of a columnar store (None if there is none yet) and the directory of its rows.
+    # Stores written before versioning keep their rows at the top level, without a version.json.
+    version_file = columns_dir + "/version.json"
+    if (not os.path.exists(version_file)):
+        return None, columns_dir
+    version = read_json(version_file)
+    return version, f"{columns_dir}/{version['rows_dir']}"
+
+
+def _iso_to_ms(timestamp : str) -> int:
+    # Integer arithmetic so milliseconds round-trip exactly (float timestamps can be off by one).
+    return (datetime.fromisoformat(timestamp) - UNIX_EPOCH) // timedelta(milliseconds=1)
+
+
+def append_to_columnar(messages, columns_dir : str, chunk_size : int = 100000) -> int:
+    """
+    Adds messages to a columnar message store, creating the store if it doesn't exist yet.
+
+    Messages are consumed in chunks: content, mentions and reactions are appended to their heaps
+    chunk by chunk, then the fixed-width columns are merged with the existing rows, deduplicated 
+    by message id and re-sorted newest first.
+
+    The update is atomic: the new rows are written to a new directory and only become the store's rows when
+    version.json is replaced, last. After a crash the store is still the previous version (heaps are only ever
+    appended to, so the previous rows' offsets stay valid; what was appended after them is ignored).
+
+    Input:
+        - messages: Iterable of messages in the schema of downloader.py's parse_message().
+        - columns_dir: Directory of the columnar store.
+        - chunk_size: Number of messages held in memory at once.
+    
+    Output:
+        - num_messages: Number of messages in the store afterwards.
+    """
+    os.makedirs(columns_dir, exist_ok=True)
+    version, rows_dir = _columns_version(columns_dir)
+    authors_file = rows_dir + "/authors.json"
+    authors = read_json(authors_file) if os.path.exists(authors_file) else []
+    author_to_idx = {author["id"] : idx for idx, author in enumerate(authors)}
+
+    def author_idx(user : dict) -> int:
+        if (user["id"] not in author_to_idx):
+            author_to_idx[user["id"]] = len(authors)
+            authors.append({"id" : user["id"], "username" : user["username"], "global_name" : user.get("global_name")})
+        return author_to_idx[user["id"]]
+
+    def write_chunk(chunk : list) -> dict:
+        rows = {name : [] for name in MESSAGE_COLUMNS}
+        content_heap = bytearray()
+        mention_heap = []
+        reactions_heap = bytearray()
+        for message in chunk:
+            content = message["content"].encode("utf-8")
+            reactions = json.dumps(message["reactions"]).encode("utf-8") if message.get("reactions") else b""
+            mention_ids = [author_idx(mention) for mention in message["mentions"]]
+
+            rows["id"].append(int(message["id"]))
+            rows["author"].append(author_idx(message["author"]))
+            rows["timestamp"].append(_iso_to_ms(message["timestamp"]))
+            rows["type"].append(message["type"])
+            rows["mention_everyone"].append(message["mention_everyone"])
+            rows["content_start"].append(len(content_heap))
+            rows["content_length"].append(len(content))
+            rows["mention_start"].append(len(mention_heap))
+            rows["mention_count"].append(len(mention_ids))
+            rows["reactions_start"].append(len(reactions_heap))
+            rows["reactions_length"].append(len(reactions))
+            content_heap += content
+            mention_heap += mention_ids
+            reactions_heap += reactions
+
+        columns = {name : np.array(rows[name], dtype=dtype) for name, dtype in MESSAGE_COLUMNS.items()}
+        columns["content_start"] += _append_heap(columns_dir + "/content.bin", bytes(content_heap))
+        columns["mention_start"] += _append_heap(columns_dir + "/mentions.bin", np.array(mention_heap, dtype="<u4").tobytes()) // 4
+        columns["reactions_start"] += _append_heap(columns_dir + "/reactions.bin", bytes(reactions_heap))
+        return columns
+
+    # New rows come first so they win when an id repeats.
+    column_chunks = []
+    chunk = []
+    for message in messages:
+        chunk.append(message)
+        if (len(chunk) == chunk_size):
+            column_chunks.append(write_chunk(chunk))
+            chunk = []
+    column_chunks.append(write_chunk(chunk))
+    if (os.path.exists(rows_dir + "/id.npy")):
+        column_chunks.append({name : np.load(f"{rows_dir}/{name}.npy") for name in MESSAGE_COLUMNS})
+
+    columns = {name : np.concatenate([x[name] for x in column_chunks]) for name in MESSAGE_COLUMNS}
+    _, unique_idx = np.unique(columns["id"], return_index=True)
+    order = unique_idx[::-1]
+
+    new_version = {
+        "version" : version["version"] + 1 if version is not None else 1,
+        "num_messages" : len(order),
+        "heap_sizes" : {name : os.path.getsize(f"{columns_dir}/{name}") for name in HEAP_FILES},
+    }
+    new_version["rows_dir"] = f"rows-{new_version['version']}"
+    new_rows_dir = f"{columns_dir}/{new_version['rows_dir']}"
+    shutil.rmtree(new_rows_dir, ignore_errors=True)
+    os.makedirs(new_rows_dir)
+    write_json(authors, new_rows_dir + "/authors.json")
+    for name in MESSAGE_COLUMNS:
+        np.save(f"{new_rows_dir}/{name}.npy", columns[name][order])
+    write_json_atomic(new_version, columns_dir + "/version.json")
+
+    # The previous rows are no longer referenced.
+    if (version is not None):
+        shutil.rmtree(rows_dir, ignore_errors=True)
+    else:
+        for filename in [f"{name}.npy" for name in MESSAGE_COLUMNS] + ["authors.json"]:
+            if (os.path.exists(f"{columns_dir}/{filename}")):
+                os.remove(f"{columns_dir}/{filename}")
+
+    return len(order)
+
+
+def convert_json_to_columnar(json_filename : str, columns_dir : str) -> int:
+    """
+    Converts a JSON list of messages (the old messages.json written by downloader.py) into a columnar store.
+
+    Input:
+        - json_filename: Path to the JSON file.
+        - columns_dir: Directory of the columnar store.
+    
+    Output:
+        - num_messages: Number of messages in the store afterwards.
+    """
+    return append_to_columnar(read_json(json_filename), columns_dir)
+
+
+def compact_message_store(channel_name : str, folder : str = "messages") -> int:
+    """
+    Brings the columnar copy of a channel's .jsonl message store up to date.
+
+    Only the part of the .jsonl store written since the last compaction is read.
+
+    Input:
+        - channel_name: Name of the channel.
+        - folder: Folder the message stores are written to.
+    
+    Output:
+        - num_messages: Number of messages in the columnar store afterwards.
+    """
+    store_filename, _ = message_store_paths(channel_name, folder)
+    columns_dir = message_columns_path(channel_name, folder)
+    meta_file = columns_dir + "/meta.json"
+    meta = read_json(meta_file) if os.path.exists(meta_file) else {"source_offset" : 0, "num_messages" : 0}
+
+    # Only complete lines are read. A partially written trailing line is picked up by the next compaction.
+    def new_messages(fp):
+        for line in fp:
+            if (not line.endswith(b"\n")):
+                break
+            meta["source_offset"] += len(line)
+            if (line.strip()):
+                yield json.loads(line)
+
+    with open(store_filename, 'rb') as fp:
+        fp.seek(meta["source_offset"])
+        meta["num_messages"] = append_to_columnar(new_messages(fp), columns_dir)
+    write_json_atomic(meta, meta_file)
+
+    return meta["num_messages"]
+
+
+class ColumnarMessages:
+    """
+    Memory-mapped reader for a columnar message store.
+
+    Columns are exposed as read-only numpy arrays in self.columns (e.g. self.columns["id"]) for column-wise scans.
+    Indexing returns individual messages in the schema of downloader.py's parse_message(), newest first, so
+    this can be used anywhere a list of messages from the JSON store was used.
+
+    The store's version.json is checked against what is on disk (number of rows of every column, heap sizes),
+    so a damaged store raises a ValueError when opened instead of returning wrong messages.
+    """
+
+    def __init__(self, columns_dir : str) -> None:
+        """
+        Constructor.
+
+        Input:
+            - columns_dir: Directory of the columnar store.
+        """
+        self.columns_dir = columns_dir
+        version, rows_dir = _columns_version(columns_dir)
+        self.columns = {name : np.load(f"{rows_dir}/{name}.npy", mmap_mode='r') for name in MESSAGE_COLUMNS}
+        self.authors = read_json(rows_dir + "/authors.json")
+
+        # Heaps may have been appended to since (by an update that didn't finish), only the part of this version is mapped.
+        heap_sizes = version["heap_sizes"] if version is not None else {name : os.path.getsize(f"{columns_dir}/{name}") for name in HEAP_FILES}
+        if (version is not None):
+            lengths = {name : len(column) for name, column in self.columns.items() if len(column) != version["num_messages"]}
+            if (lengths):
+                raise ValueError(f"{columns_dir} should have {version['num_messages']} rows, but has columns of lengths {lengths}")
+        self.content_heap = self._map_heap("content.bin", np.uint8, heap_sizes["content.bin"])
+        self.mention_heap = self._map_heap("mentions.bin", np.dtype("<u4"), heap_sizes["mentions.bin"])
+        self.reactions_heap = self._map_heap("reactions.bin", np.uint8, heap_sizes["reactions.bin"])
+        return 
+
+
+    def _map_heap(self, filename : str, dtype : "np.dtype", size : int) -> "np.ndarray":
+        # Maps the first size bytes of a heap (np.memmap can't map an empty file).
+        path = f"{self.columns_dir}/{filename}"
+        if (os.path.getsize(path) < size):
+            raise ValueError(f"{path} should be at least {size} bytes, but is {os.path.getsize(path)}")
+        if (size == 0):
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(size // np.dtype(dtype).itemsize,))
+
+
+    def __len__(self) -> int:
+        return len(self.columns["id"])
+
+
+    def content(self, idx : int) -> str:
+        """
+        Reads the content of a single message from the string heap.
+
+        Input:
+            - idx: Row of the message.
+        
+        Output:
+            - content: Message content.
+        """
+        start = self.columns["content_start"][idx]
+        return self.content_heap[start : start + self.columns["content_length"][idx]].tobytes().decode("utf-8")
+
+
+    def mentions(self, idx : int) -> list:
+        start = self.columns["mention_start"][idx]
+        return [self.authors[author_idx] for author_idx in self.mention_heap[start : start + self.columns["mention_count"][idx]]]
+
+
+    def message(self, idx : int) -> dict:
+        """
+        Rebuilds a single message.
+
+        Input:
+            - idx: Row of the message.
+        
+        Output:
+            - message: The message, in the schema of downloader.py's parse_message().
+        """
+        timestamp = datetime.fromtimestamp(int(self.columns["timestamp"][idx]) / 1000, tz=timezone.utc)
+        reactions_start = self.columns["reactions_start"][idx]
+        reactions = self.reactions_heap[reactions_start : reactions_start + self.columns["reactions_length"][idx]].tobytes()
+
+        return {
+            "id" : str(self.columns["id"][idx]),
+            "content" : self.content(idx),
+            "timestamp" : timestamp.isoformat(timespec="microseconds"),
+            "type" : int(self.columns["type"][idx]),
+            "author" : dict(self.authors[self.columns["author"][idx]]),
+            "mentions" : [dict(mention) for mention in self.mentions(idx)],
+            "mention_everyone" : bool(self.columns["mention_everyone"][idx]),
+            "reactions" : json.loads(reactions) if reactions else {},
+        }
+
+
+    def __getitem__(self, idx : int) -> dict:
+        if (idx < 0):
+            idx += len(self)
+        if (idx < 0 or idx >= len(self)):
+            raise IndexError(idx)
+        return self.message(idx)
+
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.message(idx)
+
+
+def read_columnar_store(channel_name : str, folder : str = "messages") -> ColumnarMessages:
+    """
+    Opens the columnar copy of a channel's message store (see compact_message_store).
+
+    Input:
+        - channel_name: Name of the channel.
+        - folder: Folder the message stores are written to.
+    
+    Output:
+        - messages: Memory-mapped ColumnarMessages reader.
+    """
+    return ColumnarMessages(message_columns_path(channel_name, folder))
+
+
+@functools.lru_cache(maxsize=None)
+def create_tokenizer(model_string : str) -> "AutoTokenizer":
+    """
+    Helper function to create tokenizer and add any new vocab. 
+
+    The tokenizer is created once per model_string, later calls return the same (shared) tokenizer.
+
+    Input:
+        - model_string: The name of the pretrained model whose tokenizer should be loaded.
+    """
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_string)
+
+    # https://stackoverflow.com/questions/76198051/how-to-add-new-tokens-to-an-existing-huggingface-tokenizer
+    # Added in the order of the emotes file, so the same file always gives the same token ids.
+    vocab = tokenizer.get_vocab()
+    new_vocab = [IMG_TOKEN, GIF_TOKEN, LINK_TOKEN] + load_emotes()
+    tokenizer.add_tokens([x for x in dict.fromkeys(new_vocab) if x not in vocab])
+
+    # We can add these special tokens to the vocabulary and the embeddings of the model:
+    tokenizer.add_special_tokens({
+        'pad_token': PAD, 
+        'sep_token' : SEP, 
+        'bos_token' : BOS,
+        'eos_token' : EOS
+    })
+
+    return tokenizer
+
+
 def load_secrets(secret_filename:str="custom/secrets.json") -> dict:
     """
     Helper to load the secrets file. 